@@ -1,4 +1,2 @@
 # -*- coding: utf-8 -*-
 from .app import create_app
-
-app = create_app()
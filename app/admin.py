@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+from flask import Flask, flash, redirect, request
+
+from app.ext import db, login_manager
+from app.utils import get_min_id_at, get_unix_time_tuple
+
+__all__ = ["LazyAdminApp", "create_admin_app"]
+
+ADMIN_URL_PREFIX = "/admin"
+
+
+def _login_url() -> str:
+    # 管理后台挂载在 ADMIN_URL_PREFIX 下，登录页在主应用中
+    script_root = request.script_root[:-len(ADMIN_URL_PREFIX)]
+    return f"{script_root}/auth/admin_login/"
+
+
+class _TTLCache(object):
+    """ 带过期时间的 LRU 缓存，保存管理后台的行数统计与分页位置
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: "OrderedDict[typing.Hashable, typing.Tuple[float, typing.Any]]"
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key: typing.Hashable, value: typing.Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+def _sid_bound(date: datetime.datetime, seconds: int = 0) -> int:
+    return get_min_id_at(
+        int(
+            get_unix_time_tuple(
+                date=date + datetime.timedelta(seconds=seconds),
+                millisecond=True
+            )
+        )
+    )
+
+
+def _format_millis(view, context, model, name) -> str:
+    millis = getattr(model, name)
+    if not millis:
+        return ""
+    return datetime.datetime.fromtimestamp(int(millis) / 1000
+                                          ).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _format_content(view, context, model, name) -> str:
+    content: str = getattr(model, name) or ""
+    limit: int = view.content_preview
+    if len(content) <= limit:
+        return content
+    return content[:limit] + "..."
+
+
+def _scalable_view_class(
+    base: typing.Type, config: typing.Mapping[str, typing.Any]
+) -> typing.Type:
+    """ 适用于大表的只读列表视图
+    - 行数：不带过滤条件时使用数据库的估算值(PostgreSQL/MySQL)，带过滤条件时最多统计
+      ADMIN_COUNT_LIMIT 行，结果缓存 ADMIN_COUNT_CACHE_SECONDS 秒
+    - 分页：固定按照 sid 倒序，记录每一页最后一行的 sid，下一页使用 `sid < 上一页最后的 sid`
+      走索引定位，不使用 offset；缓存过期时退化为 offset
+    - 过滤：只提供当前表上有索引的过滤条件，时间范围转换为 sid 范围；
+      通过 get_filters() 与 filter.apply 过滤，不依赖 flask_admin 的私有方法
+    """
+    from flask_admin.contrib.sqla import filters
+    from sqlalchemy import func, text
+
+    class SidTimeBetweenFilter(filters.DateTimeBetweenFilter):
+
+        def apply(self, query, value, alias=None):
+            start, end = value
+            return query.filter(
+                self.column >= _sid_bound(start),
+                self.column < _sid_bound(end, seconds=1),
+            )
+
+    class SidTimeGreaterFilter(filters.DateTimeGreaterFilter):
+
+        def apply(self, query, value, alias=None):
+            return query.filter(self.column >= _sid_bound(value, seconds=1))
+
+    class SidTimeSmallerFilter(filters.DateTimeSmallerFilter):
+
+        def apply(self, query, value, alias=None):
+            return query.filter(self.column < _sid_bound(value))
+
+    class ScalableModelView(base):
+        can_create = False
+        can_edit = False
+        can_delete = False
+        can_view_details = True
+        can_set_page_size = False
+        column_display_pk = False
+        column_sortable_list: typing.Tuple[str, ...] = ()
+        column_default_sort = ("sid", True)
+        page_size = 50
+
+        def __init__(self, model, session, **kwargs) -> None:
+            self.count_limit: int = config["ADMIN_COUNT_LIMIT"]
+            self.content_preview: int = config["ADMIN_CONTENT_PREVIEW"]
+            self._counts = _TTLCache(config["ADMIN_COUNT_CACHE_SECONDS"])
+            self._pages = _TTLCache(config["ADMIN_COUNT_CACHE_SECONDS"])
+            super().__init__(model, session, **kwargs)
+            self.list_filters: typing.List[typing.Any] = self.get_filters() or []
+
+        @staticmethod
+        def time_filters(column, name: str) -> typing.List[typing.Any]:
+            return [
+                SidTimeBetweenFilter(column, name),
+                SidTimeGreaterFilter(column, name),
+                SidTimeSmallerFilter(column, name),
+            ]
+
+        def estimate_table_rows(self) -> typing.Optional[int]:
+            """ 数据库统计信息中的行数估算值，不支持的数据库返回 None
+            """
+            table = self.model.__tablename__
+            dialect = self.session.get_bind().dialect.name
+            if dialect == "postgresql":
+                sql = "SELECT reltuples::bigint FROM pg_class WHERE relname = :t"
+            elif dialect == "mysql":
+                sql = (
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t"
+                )
+            else:
+                return None
+            rows = self.session.execute(text(sql), {"t": table}).scalar()
+            return int(rows) if rows is not None and rows >= 0 else None
+
+        def get_cached_count(self, filters_key: typing.Tuple, query) -> int:
+            count = self._counts.get(filters_key)
+            if count is not None:
+                return count
+            if not filters_key:
+                count = self.estimate_table_rows()
+            if count is None:
+                limited = query.with_entities(self.model.sid).limit(
+                    self.count_limit
+                ).subquery()
+                count = self.session.query(func.count()).select_from(
+                    limited
+                ).scalar()
+            self._counts.put(filters_key, count)
+            return count
+
+        def get_list(
+            self,
+            page,
+            sort_column,
+            sort_desc,
+            search,
+            filters,
+            execute=True,
+            page_size=None
+        ):
+            query = self.get_query()
+            for index, _, value in filters or ():
+                flt = self.list_filters[index]
+                query = flt.apply(query, flt.clean(value))
+            filters_key = tuple(tuple(f) for f in filters or ())
+            count = self.get_cached_count(filters_key, query)
+
+            page = page or 0
+            page_size = self.page_size if page_size is None else page_size
+            query = query.order_by(self.model.sid.desc())
+            if page_size:
+                last_sid = self._pages.get((filters_key, page - 1)
+                                          ) if page else None
+                if last_sid is not None:
+                    query = query.filter(self.model.sid < last_sid)
+                elif page:
+                    query = query.offset(page * page_size)
+                query = query.limit(page_size)
+            if not execute:
+                return count, query
+            data = query.all()
+            if data and page_size:
+                self._pages.put((filters_key, page), data[-1].sid)
+            return count, data
+
+    return ScalableModelView
+
+
+def create_admin_app(app: Flask) -> Flask:
+    """ 创建管理后台应用
+    管理后台是一个独立的 Flask 应用，挂载在主应用的 /admin 下，与主应用共享配置、
+    数据模型与登录状态；flask_admin 只在这里导入，没有访问管理后台时不会加载。
+    默认与主应用共用数据库连接池，配置 ADMIN_SQLALCHEMY_ENGINE_OPTIONS 时管理后台
+    使用自己的连接池。
+    """
+    from flask_login import current_user
+    from flask_admin import Admin, AdminIndexView
+    from flask_admin.contrib.sqla import ModelView
+    from flask_admin.actions import action
+    from flask_admin.contrib.sqla import filters
+    from app.model import User, ChatGPTKey, ChatRecord, Conversation, ChatAuth
+
+    admin_app = Flask(__name__)
+    admin_app.config.update(app.config)
+    admin_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+        **app.config["ADMIN_SQLALCHEMY_ENGINE_OPTIONS"],
+    }
+    db.init_app(app=admin_app)
+    if not app.config["ADMIN_SQLALCHEMY_ENGINE_OPTIONS"]:
+        # init_app 总会为新应用创建 engine，在建立连接之前替换为主应用的 engine；
+        # Flask-SQLAlchemy 3.x 的 db.engines 返回的就是当前应用保存 engine 的字典
+        with app.app_context():
+            main_engines = dict(db.engines)
+        with admin_app.app_context():
+            engines = db.engines
+            for engine in engines.values():
+                engine.dispose()
+            engines.clear()
+            engines.update(main_engines)
+    login_manager.init_app(app=admin_app)
+
+    def is_admin() -> bool:
+        return current_user.is_authenticated and current_user.identifier == admin_app.config[
+            "ADMIN_USER_IDENTIFIER"]
+
+    class AuthAdminIndexView(AdminIndexView):
+
+        def is_accessible(self):
+            return is_admin()
+
+        def inaccessible_callback(self, name, **kwargs):
+            return redirect(_login_url())
+
+    class AuthModelView(ModelView):
+
+        def is_accessible(self):
+            return is_admin()
+
+        def inaccessible_callback(self, name, **kwargs):
+            return redirect(_login_url())
+
+    admin = Admin(
+        admin_app,
+        name="ChatGPT用户管理",
+        template_mode="bootstrap3",
+        index_view=AuthAdminIndexView(url="/")
+    )
+
+    admin.add_view(AuthModelView(User, db.session))
+
+    class ChatGPTKeyView(AuthModelView):
+        column_formatters = {"last_checked_at": _format_millis}
+
+        @action("probe", "检测", "检测选中的 key?")
+        def action_probe(self, ids: typing.List[str]) -> None:
+            prober = app.extensions["gpt_key_prober"]
+            keys = [
+                (k.chatkey_id, k.content, k.is_live)
+                for k in ChatGPTKey.query.filter(
+                    ChatGPTKey.chatkey_id.in_([int(i) for i in ids])
+                )
+            ]
+            results = prober.probe([content for _, content, _ in keys])
+            prober.save(keys, results)
+            dead = len([r for r in results if r.definitive and not r.is_live])
+            flash(f"检测了 {len(keys)} 个 key，其中 {dead} 个不可用")
+
+    admin.add_view(ChatGPTKeyView(ChatGPTKey, db.session))
+
+    ScalableModelView = _scalable_view_class(AuthModelView, admin_app.config)
+
+    class ChatRecordView(ScalableModelView):
+        column_list = (
+            "sid", "user_id", "conversation", "role", "content", "create_at"
+        )
+        column_formatters = {
+            "content": _format_content,
+            "create_at": _format_millis,
+        }
+        column_filters = [
+            filters.IntEqualFilter(ChatRecord.user_id, "用户ID"),
+            filters.IntEqualFilter(ChatRecord.conversation, "会话ID"),
+            *ScalableModelView.time_filters(ChatRecord.sid, "创建时间"),
+        ]
+
+    class ConversationView(ScalableModelView):
+        column_list = ("sid", "cov_id", "identifier", "user_id", "create_at")
+        column_formatters = {"create_at": _format_millis}
+        column_filters = [
+            filters.IntEqualFilter(Conversation.user_id, "用户ID"),
+            filters.FilterEqual(Conversation.identifier, "会话标识符"),
+            *ScalableModelView.time_filters(Conversation.sid, "创建时间"),
+        ]
+
+    class ChatAuthView(ScalableModelView):
+        can_edit = True
+        column_list = ("sid", "user_idf", "tier", "began_at", "end_at")
+        column_formatters = {
+            "began_at": _format_millis,
+            "end_at": _format_millis,
+        }
+        column_filters = [
+            filters.FilterEqual(ChatAuth.user_idf, "用户标识符"),
+            *ScalableModelView.time_filters(ChatAuth.sid, "创建时间"),
+        ]
+
+    admin.add_view(ChatRecordView(ChatRecord, db.session))
+    admin.add_view(ConversationView(Conversation, db.session))
+    admin.add_view(ChatAuthView(ChatAuth, db.session))
+
+    @admin_app.route("/upstreams/")
+    def upstreams():
+        """ 当前进程的上游统计与熔断器状态
+        """
+        if not is_admin():
+            return redirect(_login_url())
+        from app.response import response_succ
+        return response_succ(body=app.extensions["gpt_router"].status())
+
+    return admin_app
+
+
+class LazyAdminApp(object):
+    """ 第一次访问 /admin 时才创建管理后台的 WSGI 应用
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        self.admin_app: typing.Optional[Flask] = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ: typing.Dict[str, typing.Any],
+                 start_response: typing.Callable) -> typing.Iterable[bytes]:
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    self.admin_app = create_admin_app(self.app)
+        return self.admin_app(environ, start_response)
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import os
+import time
 import typing
-from flask import Flask, redirect, url_for
+import contextlib
+import click
+from flask import Flask
 from flask.cli import AppGroup
-from flask_admin import Admin
-from flask_migrate import Migrate
 
 from app.response import response_error
+from app.utils import configure_id_generator, is_cooperative
+from app.utils import get_unix_time_tuple
 from app.ext import login_manager, db
 
 __all__ = ["create_app"]
@@ -19,6 +22,10 @@ def __config_default_config(app: Flask) -> None:
             "SECRET_KEY": "dev",
             "FLASK_ADMIN_SWATCH": "cerulean",
             "ADMIN_USER_IDENTIFIER": "admin_identifier",
+            "ADMIN_SQLALCHEMY_ENGINE_OPTIONS": {},
+            "ADMIN_COUNT_CACHE_SECONDS": 60,
+            "ADMIN_COUNT_LIMIT": 10000,
+            "ADMIN_CONTENT_PREVIEW": 80,
     # GPT
     # fake organization and api key
             "GPT_ORGANIZATION": "fake_organization",
@@ -26,6 +33,71 @@ def __config_default_config(app: Flask) -> None:
             "GPT_MODEL": "gpt-3.5-turbo",
             "GPT_MAX_TOKENS": 2048,
             "GPT_TEMPERATURE": 0.2,
+    # Upstream, model -> [base url or {"name", "api_base", "api_type", "api_version", "deployments", "keys", "stream_usage"}]
+            "GPT_UPSTREAMS": {},
+            "GPT_BATCH_MAX_PROMPTS": 100,
+            "GPT_BATCH_CONCURRENCY": 8,
+            "GPT_CONVERSATION_CACHE_SIZE": 100000,
+    # WebSocket，空闲超过这个秒数后关闭连接
+            "GPT_WS_IDLE_TIMEOUT": 300,
+            "SOCK_SERVER_OPTIONS": {
+                "max_message_size": 1024 * 1024,
+                "ping_interval": 25,
+            },
+    # 请求参数限制，超出时在查询数据库与挑选 key 之前返回错误
+    # MAX_CONTENT_LENGTH 限制所有请求体，包括没有 Content-Length 的请求与表单
+            "MAX_CONTENT_LENGTH": 4 * 1024 * 1024,
+            "GPT_MAX_BODY_BYTES": 1024 * 1024,
+            "GPT_BATCH_MAX_BODY_BYTES": 4 * 1024 * 1024,
+            "GPT_MAX_MESSAGES": 100,
+            "GPT_MAX_PROMPT_LENGTH": 32000,
+    # Idempotency-Key，结果保存在数据库中：结果保存的秒数、重复请求等待原请求的最长秒数
+    # (也是原请求占用 key 的最长秒数)与等待时查询结果的间隔秒数
+            "GPT_IDEMPOTENCY_TTL": 600,
+            "GPT_IDEMPOTENCY_WAIT": 120,
+            "GPT_IDEMPOTENCY_POLL_INTERVAL": 0.2,
+    # 批量授权，每个分块一次批量更新与一次批量插入
+            "GPT_AUTH_BATCH_MAX_GRANTS": 10000,
+            "GPT_AUTH_BATCH_CHUNK_SIZE": 500,
+    # Key prober, api base 为 None 时使用默认模型的第一个上游，间隔为 0 时不在后台检测
+            "GPT_KEY_PROBE_API_BASE": None,
+            "GPT_KEY_PROBE_CONCURRENCY": 32,
+            "GPT_KEY_PROBE_TIMEOUT": 5,
+            "GPT_KEY_PROBE_INTERVAL": 600,
+    # Near-duplicate prompt cache
+            "GPT_SIMCACHE_ENABLED": True,
+            "GPT_SIMCACHE_THRESHOLD": 0.95,
+            "GPT_SIMCACHE_MAX_ENTRIES": 100000,
+            "GPT_SIMCACHE_MAX_TEMPERATURE": 0.3,
+    # Background jobs
+            "GPT_JOB_WORKERS": 4,
+            "GPT_JOB_STALE_SECONDS": 300,
+            "GPT_JOB_MAX_WAIT": 30,
+            "GPT_JOB_POLL_INTERVAL": 0.5,
+            "GPT_UPSTREAM_TIMEOUT": 10,
+            "GPT_UPSTREAM_CONNECT_TIMEOUT": 3.05,
+    # 上游与 key 的熔断器：窗口内请求数不少于 MIN_REQUESTS 且失败率(慢请求算作失败)
+    # 达到 ERROR_RATE 时打开，OPEN_SECONDS 后放行 HALF_OPEN_CALLS 个试探请求
+            "GPT_BREAKER_ENABLED": True,
+            "GPT_BREAKER_WINDOW": 60,
+            "GPT_BREAKER_MIN_REQUESTS": 10,
+            "GPT_BREAKER_ERROR_RATE": 0.5,
+            "GPT_BREAKER_SLOW_CALL_SECONDS": 8,
+            "GPT_BREAKER_OPEN_SECONDS": 30,
+            "GPT_BREAKER_HALF_OPEN_CALLS": 2,
+    # 客户端断开时取消上游请求，开启后询问接口使用流式请求，间隔为检查连接的最小秒数
+            "GPT_ABORT_ON_DISCONNECT": True,
+            "GPT_DISCONNECT_CHECK_INTERVAL": 0.5,
+            "GPT_UPSTREAM_EWMA_ALPHA": 0.3,
+            "GPT_UPSTREAM_ERROR_PENALTY": 10.0,
+            "GPT_UPSTREAM_EXPLORE_RATIO": 0.05,
+            "GPT_UPSTREAM_MAX_ATTEMPTS": 2,
+    # 上游共享的 keep-alive 连接池，DNS 缓存只用于上游连接，秒数为 0 时不缓存
+            "GPT_HTTP_POOL_CONNECTIONS": 16,
+            "GPT_HTTP_POOL_MAXSIZE": 64,
+            "GPT_HTTP_MAX_RETRIES": 2,
+            "GPT_HTTP_DNS_TTL": 300,
+            "GPT_HTTP_WARMUP_CONNECTIONS": 2,
 
     # DB
             "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
@@ -36,6 +108,71 @@ def __config_default_config(app: Flask) -> None:
             "SQLALCHEMY_ENGINE_OPTIONS": {
                 "pool_pre_ping": True,
             },
+    # 每个请求的 SQL 统计：超过 SLOW_QUERY_SECONDS 的语句记录日志，同一条语句在一个请求中
+    # 执行 NPLUS1_THRESHOLD 次以上时提示 N+1，SERVER_TIMING 为 True 时返回 Server-Timing 头
+            "SQL_QUERY_STATS_ENABLED": True,
+            "SQL_SLOW_QUERY_SECONDS": 0.5,
+            "SQL_NPLUS1_THRESHOLD": 10,
+            "SQL_SERVER_TIMING": False,
+    # gevent 协程 worker 下，连接池大小 = min(协程并发数, 上限)
+            "GPT_WORKER_CONNECTIONS": int(
+                os.environ.get("GPT_WORKER_CONNECTIONS", 100)
+            ),
+            "GPT_DB_POOL_MAX_SIZE": 20,
+
+    # 用量统计按天汇总使用的时区
+            "USAGE_UTC_OFFSET_HOURS": 8,
+            "USAGE_MAX_DAYS": 366,
+
+    # Rate limit，按用户/IP 计数，默认保存在进程内存，多进程共享时配置 redis://
+            "RATELIMIT_ENABLED": True,
+            "RATELIMIT_STORAGE_URI": "memory://",
+            "RATELIMIT_STRATEGY": "moving-window",
+            "RATELIMIT_HEADERS_ENABLED": False,
+            "RATELIMIT_SWALLOW_ERRORS": True,
+            "RATELIMIT_IN_MEMORY_FALLBACK_ENABLED": True,
+    # blueprint -> 限制，ChatAuth.tier -> {blueprint -> 限制}
+            "RATELIMIT_BLUEPRINTS": {
+                "gpt": "120/minute",
+                "auth": "30/minute",
+            },
+            "RATELIMIT_TIERS": {},
+            "RATELIMIT_TIER_CACHE_SECONDS": 60,
+    # 验证成功的 token 按用户计数的缓存秒数，未验证的 token 按 IP 计数
+            "RATELIMIT_TOKEN_CACHE_SECONDS": 300,
+
+    # 请求采样：请求头 X-Profile 等于 PROFILER_TOKEN 时采样，
+    # 或者按照 SAMPLE_RATE 随机采样；ENDPOINTS 为 None 时不限制 endpoint，
+    # 结果保存在 instance_path/PROFILER_DIR。TOKEN 为空且 SAMPLE_RATE 为 0 时完全关闭
+            "PROFILER_TOKEN": None,
+            "PROFILER_SAMPLE_RATE": 0.0,
+            "PROFILER_INTERVAL": 0.005,
+            "PROFILER_ENDPOINTS": None,
+            "PROFILER_DIR": "profiles",
+
+    # 响应压缩：按 Accept-Encoding 在 ALGORITHMS 中选择(br/zstd 需要安装可选依赖)，
+    # 小于 MIN_SIZE 字节的响应不压缩；流式响应每个分块 flush，使用较低的级别；
+    # 接口标记为不会变化的响应缓存压缩结果，只压缩一次，使用最高的级别
+            "COMPRESS_ENABLED": True,
+            "COMPRESS_ALGORITHMS": ["br", "zstd", "gzip"],
+            "COMPRESS_MIMETYPES": [
+                "application/json",
+                "application/x-ndjson",
+                "text/event-stream",
+                "text/html",
+                "text/plain",
+            ],
+            "COMPRESS_MIN_SIZE": 1024,
+            "COMPRESS_LEVELS": {"br": 4, "zstd": 3, "gzip": 6},
+            "COMPRESS_STREAM_LEVELS": {"br": 1, "zstd": 1, "gzip": 1},
+            "COMPRESS_CACHE_LEVELS": {"br": 11, "zstd": 19, "gzip": 9},
+            "COMPRESS_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+
+    # 可排序ID的 worker 编号(0-1023)，为 None 时使用进程号，不同机器之间可能重复；
+    # gunicorn 下由 post_fork 按照 GUNICORN_WORKER_ID_BASE + worker.age 设置 GPT_WORKER_ID，
+    # 见 gunicorn.conf.py
+            "WORKER_ID": int(os.environ["GPT_WORKER_ID"])
+            if os.environ.get("GPT_WORKER_ID") else None,
 
     # Web Port & Address
             "WEB_PORT": 5000,
@@ -50,10 +187,110 @@ def __config_default_config(app: Flask) -> None:
         pass
 
 
+# 启动时不导入，第一次使用时才导入的模块
+LAZY_MODULES = [
+    "flask_admin.contrib.sqla", "flask_migrate", "openai", "passlib.hash"
+]
+
+
+class _StartupTimer(object):
+    """ 记录启动过程中每个阶段的耗时
+    """
+
+    def __init__(self) -> None:
+        self.phases: typing.List[typing.Tuple[str, float]] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - began))
+
+
+class _LazyMigrateGroup(click.Group):
+    """ flask db 命令组
+    flask_migrate 会导入 alembic，只有真正执行 flask db 子命令时才加载
+    """
+
+    def __init__(self, app: Flask, **kwargs: typing.Any) -> None:
+        super().__init__(**kwargs)
+        self.app = app
+        self._group: typing.Optional[click.Group] = None
+
+    def _load(self) -> click.Group:
+        if self._group is None:
+            from flask_migrate import Migrate
+            from flask_migrate.cli import db as migrate_group
+            Migrate(self.app, db, command="db")
+            self._group = migrate_group
+        return self._group
+
+    def list_commands(self, ctx: click.Context) -> typing.List[str]:
+        return self._load().list_commands(ctx)
+
+    def get_command(self, ctx: click.Context,
+                    cmd_name: str) -> typing.Optional[click.Command]:
+        return self._load().get_command(ctx, cmd_name)
+
+
+def _cold_import_ms(module: str) -> float:
+    """ 在新的解释器中测量模块的导入耗时，flask 与 sqlalchemy 视为已经导入
+    """
+    import subprocess
+    import sys
+    output = subprocess.run(
+        [
+            sys.executable, "-X", "importtime", "-c",
+            f"import flask, flask_sqlalchemy; import {module}"
+        ],
+        capture_output=True,
+        text=True,
+    ).stderr
+    for line in output.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+    return 0.0
+
+
+def __config_cooperative(app: Flask) -> None:
+    """ gevent 协程 worker 下按照协程并发数设置数据库连接池
+    一个 worker 进程同时处理 GPT_WORKER_CONNECTIONS 个请求，请求只在读写记录时占用连接，
+    等待上游回答时不占用，所以连接池不需要与并发数一样大，以 GPT_DB_POOL_MAX_SIZE 为上限；
+    SQLALCHEMY_ENGINE_OPTIONS 中显式配置的值优先。
+    """
+    app.config["GPT_COOPERATIVE"] = is_cooperative()
+    if not app.config["GPT_COOPERATIVE"]:
+        return
+    from sqlalchemy.engine import make_url
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite" and url.database in (
+        None, "", ":memory:"
+    ):
+        # 内存数据库只有一个连接
+        return
+    pool_size = min(
+        app.config["GPT_WORKER_CONNECTIONS"], app.config["GPT_DB_POOL_MAX_SIZE"]
+    )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": pool_size,
+        "max_overflow": pool_size,
+        **app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+    }
+    print(f"cooperative worker, db pool size: {pool_size}")
+
+
 def __config_database(app: Flask) -> None:
     # db
+    from app import querystats
+
     db.init_app(app=app)
-    migrate = Migrate(app, db, command="db")
+    querystats.init_app(app=app)
+    app.cli.add_command(
+        _LazyMigrateGroup(app, name="db", help="Perform database migrations.")
+    )
 
     db_cli = AppGroup("database", help="Database commands. (db)")
 
@@ -70,90 +307,142 @@ def __config_database(app: Flask) -> None:
         if not database_exists(db_url):
             create_database(db_url)
 
+    @db_cli.command("create-admin")
+    def create_admin():
+        """Create the admin user if it does not exist."""
+        from app.model import User
+        with app.app_context():
+            admin_identifier = app.config["ADMIN_USER_IDENTIFIER"]
+            admin = db.session.query(User.id).filter_by(
+                identifier=admin_identifier
+            ).all()
+            if admin:
+                print(f"admin user already exists {admin}")
+                return
+            name = "admin"
+            email = app.config.get("ADMIN_USER_EMAIL")
+            if not email:
+                print("ADMIN_USER_EMAIL is not configured")
+                return
+            password = app.config["ADMIN_USER_PASSWORD"]
+            new_password = User.transform_password(password)
+            print(f"will create user {name} with password {password}")
+            admin = User(email=email, password=new_password)
+            admin.identifier = admin_identifier
+            db.session.add(admin)
+            db.session.commit()
+
     app.cli.add_command(db_cli)
 
 
 def __setup_admin(app: Flask) -> None:
-    # admin
-    from flask import redirect, url_for, current_app
-    from flask_login import current_user
-    from flask_admin import AdminIndexView
-    from flask_admin.contrib.sqla import ModelView
-    from app.model import User, ChatGPTKey
-
-    class AuthAdminIndexView(AdminIndexView):
+    # admin, 第一次访问 /admin 时才创建
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from app.admin import LazyAdminApp, ADMIN_URL_PREFIX
 
-        def is_accessible(self):
-
-            return current_user.is_authenticated and current_user.identifier == current_app.config[
-                "ADMIN_USER_IDENTIFIER"]
-
-        def inaccessible_callback(self, name, **kwargs):
-            return redirect(url_for("auth.admin_login"))
-
-    class AuthModelView(ModelView):
-
-        def is_accessible(self):
-            return current_user.is_authenticated and current_user.identifier == current_app.config[
-                "ADMIN_USER_IDENTIFIER"]
-
-        def inaccessible_callback(self, name, **kwargs):
-            return redirect(url_for("auth.admin_login"))
-
-    admin = Admin(
-        app,
-        name="ChatGPT用户管理",
-        template_mode="bootstrap3",
-        index_view=AuthAdminIndexView()
+    app.wsgi_app = DispatcherMiddleware(
+        app.wsgi_app, {ADMIN_URL_PREFIX: LazyAdminApp(app)}
     )
 
-    admin.add_view(AuthModelView(User, db.session))
-    admin.add_view(AuthModelView(ChatGPTKey, db.session))
-
 
 def __setup_blueprint(app: Flask) -> None:
     # blueprint
     from app import gpt
     from app import auth
+    from app import ratelimit
 
     gpt.init_app(app=app)
     app.register_blueprint(gpt.bp)
     app.register_blueprint(auth.bp)
+    app.register_blueprint(gpt.ws_bp)
+    ratelimit.init_app(app=app, blueprints=[gpt.bp, auth.bp, gpt.ws_bp])
     # login
     login_manager.init_app(app=app)
 
-    @app.get("/admin/")
-    def admin_index():
-        return redirect(url_for("admin.index"))
-
     app.url_map.strict_slashes = False
 
-    def create_admin_user_if_needed():
-        from app.model import User
-        with app.app_context():
-            from sqlalchemy import inspect
-            insp = inspect(db.engine)
-            tables = insp.get_table_names(schema="main")
-            if "user" not in tables:
-                print("user table not exists")
-                return
 
-            admin_identifier = app.config["ADMIN_USER_IDENTIFIER"]
-            admin = User.query.filter_by(identifier=admin_identifier).all()
-            if admin:
-                print(f"admin user already exists {admin}")
-                return
-            name = "admin"
-            email = app.config["ADMIN_USER_EMAIL"]
-            password = app.config["ADMIN_USER_PASSWORD"]
-            new_password = User.transform_password(password)
-            print(f"will create user {name} with password {password}")
-            admin = User(email=email, password=new_password)
-            admin.identifier = admin_identifier
-            db.session.add(admin)
-            db.session.commit()
+def __setup_compression(app: Flask) -> None:
+    from app import compress
+
+    compress.init_app(app=app)
+
+
+def __setup_profiler(app: Flask) -> None:
+    from app import profiler
 
-    create_admin_user_if_needed()
+    profiler.init_app(app=app)
+
+
+def __setup_cli(app: Flask) -> None:
+
+    usage_cli = AppGroup("usage", help="Usage rollup commands.")
+
+    @usage_cli.command("rollup")
+    @click.option("--days", default=1, help="Recompute the last N days.")
+    def usage_rollup(days: int):
+        """Recompute usage rollups from chat records."""
+        from app.model import UsageRollup
+        offset = app.config["USAGE_UTC_OFFSET_HOURS"]
+        today = UsageRollup.day_of(
+            int(get_unix_time_tuple(millisecond=True)), offset
+        )
+        rows = UsageRollup.rebuild(
+            start_day=today - days + 1, end_day=today + 1, utc_offset_hours=offset
+        )
+        print(f"usage rollup: {days} days, {rows} rows")
+
+    app.cli.add_command(usage_cli)
+
+    auth_cli = AppGroup("auth", help="Chat auth commands.")
+
+    @auth_cli.command("grant")
+    @click.argument("source", type=click.File("r"), default="-")
+    @click.option("--days", default=30, help="Days for lines without a duration.")
+    @click.option("--verbose", is_flag=True, help="Print the outcome of every line.")
+    def auth_grant(source: typing.TextIO, days: int, verbose: bool):
+        """Grant chat auth in bulk from lines of `identifier[,days]`."""
+        from app.gpt import grant_auths
+        grants: typing.List[typing.Tuple[str, int]] = []
+        for number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            idf, _, line_days = line.partition(",")
+            try:
+                grants.append(
+                    (idf.strip(), int(line_days) if line_days.strip() else days)
+                )
+            except ValueError:
+                raise click.BadParameter(f"line {number}: {line}")
+        report = grant_auths(grants)
+        if verbose:
+            for row in report["results"]:
+                print(f"{row['idf']}\t{row['status']}\t{row['end_at']}")
+        print(
+            ", ".join(
+                f"{name} {count}" for name, count in report.items()
+                if name != "results"
+            )
+        )
+
+    app.cli.add_command(auth_cli)
+
+    from app import bench
+    bench.init_app(app=app)
+
+    @app.cli.command("startup-profile")
+    def startup_profile():
+        """Report import and init time per startup phase."""
+        timer: _StartupTimer = app.extensions["startup_timer"]
+        print("create_app phases:")
+        for name, seconds in timer.phases:
+            print(f"  {name:<24}{seconds * 1000:>10.1f} ms")
+        total = sum(seconds for _, seconds in timer.phases)
+        print(f"  {'total':<24}{total * 1000:>10.1f} ms")
+        print("lazy imports (cold, loaded on first use):")
+        for module in LAZY_MODULES:
+            print(f"  {module:<24}{_cold_import_ms(module):>10.1f} ms")
 
 
 def __setup_login_manager(app: Flask) -> None:
@@ -184,20 +473,28 @@ def __setup_login_manager(app: Flask) -> None:
             print(f"token {token} not found")
             return None
         print(f"token {token} found: {user}")
+        from app.ratelimit import remember_token
+        remember_token(user.get_id())
         return user
 
 
 def create_app(
     test_config: typing.Optional[typing.Dict[str, typing.Any]] = None
 ) -> Flask:
+    timer = _StartupTimer()
     app = Flask(__name__, instance_relative_config=True)
-    __config_default_config(app=app)
-
-    app.config.from_pyfile("config.py", silent=False)
-    if test_config:
-        app.config.from_mapping(test_config)
-    from flask_cors import CORS
-    CORS(app, supports_credentials=True)
+    app.extensions["startup_timer"] = timer
+    with timer.phase("config"):
+        __config_default_config(app=app)
+
+        app.config.from_pyfile("config.py", silent=False)
+        if test_config:
+            app.config.from_mapping(test_config)
+    # 压缩需要在其他 after_request 之前注册，最后执行
+    __setup_compression(app=app)
+    with timer.phase("cors"):
+        from flask_cors import CORS
+        CORS(app, supports_credentials=True)
     # CORS Headers
     @app.after_request
     def after_request(response):
@@ -209,8 +506,16 @@ def create_app(
         )
         return response
 
-    __config_database(app=app)
-    __setup_admin(app=app)
-    __setup_blueprint(app=app)
-    __setup_login_manager(app=app)
+    configure_id_generator(app.config["WORKER_ID"])
+    with timer.phase("database"):
+        __config_cooperative(app=app)
+        __config_database(app=app)
+    with timer.phase("admin"):
+        __setup_admin(app=app)
+    with timer.phase("blueprint"):
+        __setup_blueprint(app=app)
+    with timer.phase("login_manager"):
+        __setup_login_manager(app=app)
+    __setup_profiler(app=app)
+    __setup_cli(app=app)
     return app
@@ -3,13 +3,23 @@ import typing
 import datetime
 from flask import request, Blueprint, redirect, url_for, render_template, g
 from app.ext import login_manager, db
-from app.utils import get_random_num, parse_params
+from app.schema import Field, Schema, validate_params
+from app.utils import get_random_num
 from flask_login import login_required, login_user, logout_user, current_user
 from app.model import User
 from app.response import response_succ, response_error
+from app.response import make_etag, response_not_modified, with_etag
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
+LOGIN_SCHEMA = Schema(
+    {
+        "email": Field(str, max_length=64),
+        "password": Field(str, max_length=128),
+    },
+    max_bytes=4096,
+)
+
 
 @bp.route("/logout/", methods=["GET", "POST"])
 def logout():
@@ -32,10 +42,11 @@ def uid():
 
 
 @bp.route("/login/", methods=["POST"])
+@validate_params(LOGIN_SCHEMA)
 def login():
     """登录接口
     """
-    params = parse_params(request)
+    params = g.params
     email = params.get("email")
     if not email:
         return response_error(error_code=400, msg='邮箱不能为空')
@@ -67,10 +78,15 @@ def login():
 @login_required
 def info():
     """用户信息接口
-
+    ETag 由返回的字段计算，If-None-Match 一致时返回 304
     """
     user: User = current_user
-    return response_succ(body=user.to_json())
+    etag = make_etag(
+        "info", user.id, user.identifier, user.email, user.create_at
+    )
+    if (not_modified := response_not_modified(etag)) is not None:
+        return not_modified
+    return with_etag(response_succ(body=user.to_json()), etag)
 
 
 @bp.route('/admin_login/', methods=['GET'])
@@ -90,4 +106,4 @@ def admin_login_form():
         return redirect(url_for('auth.admin_login'))
     login_user(u, remember=True, duration=datetime.timedelta(days=15))
 
-    return redirect(url_for('admin.index'))
+    return redirect(f"{request.script_root}/admin/")
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+import itertools
+import json
+import random
+import statistics
+import subprocess
+import time
+import typing
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from app.ext import db
+from app.utils import get_min_id_at, get_unix_time_tuple
+
+__all__ = ["seed_dataset", "run_benchmarks", "compare_results"]
+
+# 生成的内容使用的词表，长度与中文对话接近即可
+_WORDS = [
+    "你好", "请问", "如何", "为什么", "可以", "帮我", "写一段", "代码", "解释",
+    "翻译", "总结", "这篇", "文章", "数据库", "索引", "性能", "优化", "谢谢",
+    "python", "flask", "sql", "gpt", "example", "error", "log", "test",
+]
+_MODELS = ["gpt-3.5-turbo", "gpt-3.5-turbo", "gpt-3.5-turbo", "gpt-4"]
+_TIERS = [None, None, None, "pro"]
+_DAY_MILLIS = 24 * 3600 * 1000
+# 生成的 sid 在同一毫秒内用主键区分，主键唯一所以多次生成的数据也不会冲突
+_SID_SEQUENCE_MASK = (1 << 22) - 1
+
+
+def _content(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _sid(millis: int, n: int) -> int:
+    return get_min_id_at(millis) + (n & _SID_SEQUENCE_MASK)
+
+
+def _next_id(column: typing.Any) -> int:
+    return (db.session.query(func.max(column)).scalar() or 0) + 1
+
+
+def _insert(table: typing.Any, rows: typing.List[typing.Dict[str, typing.Any]]) -> None:
+    if rows:
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+
+
+def _sync_sequences() -> None:
+    """ 显式写入主键之后，Postgres 需要把序列推进到当前最大值
+    """
+    if db.engine.dialect.name != "postgresql":
+        return
+    from app.model import ChatAuth, ChatRecord, Conversation, User
+    for sequence, column in (
+        ("user_id_seq", User.id),
+        ("conv_id_seq", Conversation.cov_id),
+        ("chat_id_seq", ChatRecord.chat_id),
+        ("auth_id_seq", ChatAuth.auth_id),
+    ):
+        maximum = db.session.query(func.max(column)).scalar()
+        if maximum:
+            db.session.execute(
+                db.text("SELECT setval(:sequence, :maximum)"),
+                {"sequence": sequence, "maximum": maximum},
+            )
+    db.session.commit()
+
+
+def seed_dataset(
+    users: int,
+    records: int,
+    skew: float = 1.1,
+    turns_per_conversation: int = 5,
+    auth_ratio: float = 0.3,
+    days: int = 90,
+    batch_size: int = 5000,
+    seed: int = 0,
+    echo: typing.Callable[[str], None] = print,
+) -> typing.Dict[str, int]:
+    """ 批量生成测试数据，需要在 app context 中调用，SQLite 与 Postgres 都可以使用
+    每个用户的聊天数量服从 Zipf 分布(skew 越大越集中在少数用户)，聊天按问题+回答成对生成，
+    平均每 turns_per_conversation 轮开始一个新会话，时间均匀分布在最近 days 天内。
+    使用 Core 的批量插入，不经过 ORM；相同的参数与 seed 生成相同的数据。
+
+    Return:
+        生成的行数 {"users", "conversations", "records", "auths"}
+    """
+    from app.model import ChatAuth, ChatRecord, Conversation, User
+    rng = random.Random(seed)
+    password = User.transform_password("bench")
+    now = int(get_unix_time_tuple(millisecond=True))
+    began_at = now - days * _DAY_MILLIS
+    turns = records // 2
+
+    first_user = _next_id(User.id)
+    first_conversation = _next_id(Conversation.cov_id)
+    first_chat = _next_id(ChatRecord.chat_id)
+
+    # 第一遍只决定每一轮属于哪个会话，并统计会话的最终状态
+    weights = list(
+        itertools.accumulate(1.0 / (rank + 1)**skew for rank in range(users))
+    )
+    user_order = list(range(users))
+    rng.shuffle(user_order)
+    turn_conversations = array.array("q")
+    # 会话序号 -> [用户序号, 消息数量, 第一轮的序号, 最后一轮的序号]
+    conversations: typing.List[typing.List[int]] = []
+    current: typing.Dict[int, int] = {}
+    for turn in range(turns):
+        user = user_order[bisect.bisect_left(weights, rng.random() * weights[-1])]
+        index = current.get(user)
+        if index is None or rng.random() < 1.0 / turns_per_conversation:
+            index = len(conversations)
+            conversations.append([user, 0, turn, turn])
+            current[user] = index
+        conversations[index][1] += 2
+        conversations[index][3] = turn
+        turn_conversations.append(index)
+
+    def turn_millis(turn: int) -> int:
+        return began_at + (turn * days * _DAY_MILLIS) // max(turns, 1)
+
+    rows: typing.List[typing.Dict[str, typing.Any]] = []
+    for user in range(users):
+        user_id = first_user + user
+        create_at = began_at - rng.randrange(days * _DAY_MILLIS)
+        rows.append(
+            {
+                "id": user_id,
+                "identifier": "%032x" % rng.getrandbits(128),
+                "email": f"bench{user_id}@example.com",
+                "password": password,
+                "token": "%032x" % rng.getrandbits(128),
+                "create_at": create_at,
+                "sid": _sid(create_at, user_id),
+            }
+        )
+        if len(rows) >= batch_size:
+            _insert(User.__table__, rows)
+            rows = []
+    _insert(User.__table__, rows)
+    echo(f"users: {users}")
+
+    auths = 0
+    rows = []
+    for user in range(users):
+        if rng.random() >= auth_ratio:
+            continue
+        start = began_at + rng.randrange(days * _DAY_MILLIS)
+        rows.append(
+            {
+                "auth_id": None,
+                "user_idf": None,
+                "began_at": start,
+                "end_at": start + rng.randrange(1, 365) * _DAY_MILLIS,
+                "tier": rng.choice(_TIERS),
+                "sid": None,
+                "user_index": user,
+            }
+        )
+        auths += 1
+    # 授权关联的是用户标识符，按照用户序号查出来
+    identifiers = dict(
+        db.session.query(User.id, User.identifier).filter(
+            User.id >= first_user
+        )
+    )
+    first_auth = _next_id(ChatAuth.auth_id)
+    for i, row in enumerate(rows):
+        row["auth_id"] = first_auth + i
+        row["sid"] = _sid(row["began_at"], row["auth_id"])
+        row["user_idf"] = identifiers[first_user + row.pop("user_index")]
+    for i in range(0, len(rows), batch_size):
+        _insert(ChatAuth.__table__, rows[i:i + batch_size])
+    echo(f"auths: {auths}")
+
+    # 每一轮的内容只由 seed 与轮次决定，会话的预览可以单独生成最后一轮的回答
+    def contents(turn: int) -> typing.Tuple[str, str]:
+        turn_rng = random.Random(seed * 1000003 + turn)
+        prompt = _content(turn_rng, turn_rng.randint(3, 30))
+        answer = _content(turn_rng, turn_rng.randint(10, 200))
+        return prompt, answer
+
+    # 先插入会话，Postgres 会检查聊天记录的外键
+    rows = []
+    for index, (user, count, first_turn, last_turn) in enumerate(conversations):
+        created = turn_millis(first_turn)
+        last_active_at = turn_millis(last_turn)
+        rows.append(
+            {
+                "cov_id": first_conversation + index,
+                "identifier": "%032x" % rng.getrandbits(128),
+                "user_id": first_user + user,
+                "create_at": created,
+                "sid": _sid(created, first_conversation + index),
+                "message_count": count,
+                "last_message": contents(last_turn)[1][:Conversation.PREVIEW_LENGTH],
+                "last_active_at": last_active_at,
+                "last_sid": _sid(last_active_at, first_chat + last_turn * 2 + 1),
+            }
+        )
+        if len(rows) >= batch_size:
+            _insert(Conversation.__table__, rows)
+            rows = []
+    _insert(Conversation.__table__, rows)
+    echo(f"conversations: {len(conversations)}")
+
+    rows = []
+    for turn in range(turns):
+        index = turn_conversations[turn]
+        user_id = first_user + conversations[index][0]
+        millis = turn_millis(turn)
+        model = _MODELS[turn % len(_MODELS)]
+        prompt, answer = contents(turn)
+        for offset, (role, content) in enumerate(((1, prompt), (0, answer))):
+            n = turn * 2 + offset
+            rows.append(
+                {
+                    "chat_id": first_chat + n,
+                    "user_id": user_id,
+                    "conversation": first_conversation + index,
+                    "content": content,
+                    "role": role,
+                    "create_at": millis,
+                    "sid": _sid(millis, first_chat + n),
+                    "model": model,
+                    "tokens": len(content) if role == 0 else None,
+                    "status": ChatRecord.STATUS_OK,
+                }
+            )
+        if len(rows) >= batch_size:
+            _insert(ChatRecord.__table__, rows)
+            rows = []
+            if (turn * 2) // 100000 != (turn * 2 + 2) // 100000:
+                echo(f"records: {turn * 2 + 2}/{turns * 2}")
+    _insert(ChatRecord.__table__, rows)
+    echo(f"records: {turns * 2}")
+    _sync_sequences()
+    return {
+        "users": users,
+        "conversations": len(conversations),
+        "records": turns * 2,
+        "auths": auths,
+    }
+
+
+class _Sample(typing.NamedTuple):
+    user_id: int
+    token: str
+    identifier: str
+    conversation: str
+    before: int
+
+
+def _samples(rng: random.Random, count: int) -> typing.List[_Sample]:
+    """ 挑选基准测试使用的参数：一半来自聊天最多的用户，一半随机
+    重度用户的查询最慢，随机用户反映大多数请求
+    """
+    from app.model import Conversation, User
+    heavy = [
+        row[0] for row in db.session.query(Conversation.user_id).group_by(
+            Conversation.user_id
+        ).order_by(func.sum(Conversation.message_count).desc()).limit(count // 2)
+    ]
+    max_user = db.session.query(func.max(User.id)).scalar() or 0
+    user_ids = heavy + [rng.randint(1, max_user) for _ in range(count - len(heavy))]
+    samples: typing.List[_Sample] = []
+    for user_id in user_ids:
+        user = db.session.query(User.token, User.identifier).filter(
+            User.id == user_id
+        ).first()
+        conversation = db.session.query(
+            Conversation.identifier, Conversation.last_sid
+        ).filter(Conversation.user_id == user_id).first()
+        if user is None or conversation is None:
+            continue
+        samples.append(
+            _Sample(
+                user_id=user_id,
+                token=user.token or "",
+                identifier=user.identifier,
+                conversation=conversation.identifier,
+                before=conversation.last_sid + 1,
+            )
+        )
+    return samples
+
+
+def _benchmarks() -> typing.Dict[str, typing.Callable[[_Sample], typing.Any]]:
+    """ 名称 -> 查询函数，名称是结果文件的 key，修改后无法与之前的结果比较
+    """
+    from app.model import ChatAuth, ChatRecord, Conversation, User
+    now = int(get_unix_time_tuple(millisecond=True))
+
+    return {
+        "user.token_lookup":
+            lambda s: User.query.filter_by(token=s.token).first(),
+        "chat_record.records_by_user_first_page":
+            lambda s: ChatRecord.get_records_by_user_before_time(
+                user_id=s.user_id, page=0, limit=20
+            ),
+        "chat_record.records_by_user_offset_page":
+            lambda s: ChatRecord.get_records_by_user_before_time(
+                user_id=s.user_id, page=10, limit=20
+            ),
+        "chat_record.records_by_user_before_sid":
+            lambda s: ChatRecord.get_records_by_user_before_time(
+                user_id=s.user_id, page=0, limit=20, before=s.before
+            ),
+        "chat_record.user_records_in_time_7d":
+            lambda s: ChatRecord.get_user_records_in_time(
+                user_id=s.user_id,
+                start_time=now - 7 * _DAY_MILLIS,
+                end_time=now,
+            ),
+        "conversation.by_identifier":
+            lambda s: Conversation.get_conversation_by_identifier(s.conversation),
+        "conversation.by_user":
+            lambda s: Conversation.get_conversations_by_user(
+                user_id=s.user_id, limit=20
+            ),
+        "chat_auth.by_user_idf":
+            lambda s: ChatAuth.get_auth_by_user_idf(s.identifier),
+    }
+
+
+def run_benchmarks(
+    iterations: int = 200,
+    samples: int = 50,
+    seed: int = 0,
+    only: typing.Optional[typing.List[str]] = None,
+) -> typing.Dict[str, typing.Any]:
+    """ 依次计时每个模型查询函数，需要在 app context 中调用
+    每次调用之后清空 session，避免命中 identity map；结果可以保存为 JSON 与其他提交比较
+
+    Return:
+        {"commit", "dialect", "rows", "iterations", "results": {名称: 统计}}
+    """
+    from app.model import ChatAuth, ChatRecord, Conversation, User
+    rng = random.Random(seed)
+    params = _samples(rng, samples)
+    if not params:
+        raise click.ClickException("no data, run `flask bench seed` first")
+    results: typing.Dict[str, typing.Dict[str, float]] = {}
+    for name, query in _benchmarks().items():
+        if only and name not in only:
+            continue
+        for sample in params[:5]:
+            query(sample)
+            db.session.rollback()
+        timings: typing.List[float] = []
+        rows = 0
+        for i in range(iterations):
+            sample = params[i % len(params)]
+            began = time.perf_counter()
+            result = query(sample)
+            timings.append((time.perf_counter() - began) * 1000)
+            rows += len(result) if isinstance(result, list) else int(result is not None)
+            db.session.rollback()
+            db.session.expunge_all()
+        timings.sort()
+        results[name] = {
+            "mean_ms": round(statistics.fmean(timings), 4),
+            "p50_ms": round(timings[len(timings) // 2], 4),
+            "p95_ms": round(timings[min(int(len(timings) * 0.95), len(timings) - 1)], 4),
+            "max_ms": round(timings[-1], 4),
+            "rows": round(rows / len(timings), 2),
+        }
+    return {
+        "commit": _git_commit(),
+        "dialect": db.engine.dialect.name,
+        "rows": {
+            "users": db.session.query(func.count(User.id)).scalar(),
+            "conversations": db.session.query(func.count(Conversation.cov_id)).scalar(),
+            "records": db.session.query(func.count(ChatRecord.chat_id)).scalar(),
+            "auths": db.session.query(func.count(ChatAuth.auth_id)).scalar(),
+        },
+        "iterations": iterations,
+        "results": results,
+    }
+
+
+def _git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(
+    baseline: typing.Dict[str, typing.Any], current: typing.Dict[str, typing.Any]
+) -> typing.List[str]:
+    """ 两次结果的 p50 对比，每个查询一行
+    """
+    lines = [
+        f"{'query':<44}{'base p50':>10}{'p50':>10}{'change':>10}"
+    ]
+    for name, result in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            lines.append(f"{name:<44}{'-':>10}{result['p50_ms']:>10.3f}{'new':>10}")
+            continue
+        change = (result["p50_ms"] - base["p50_ms"]) / base["p50_ms"] * 100 if base["p50_ms"] else 0.0
+        lines.append(
+            f"{name:<44}{base['p50_ms']:>10.3f}{result['p50_ms']:>10.3f}{change:>+9.1f}%"
+        )
+    return lines
+
+
+def init_app(app: Flask) -> None:
+    bench_cli = AppGroup("bench", help="Synthetic data and query benchmarks.")
+
+    @bench_cli.command("seed")
+    @click.option("--users", default=100000, help="Number of users.")
+    @click.option("--records", default=2000000, help="Number of chat records.")
+    @click.option("--skew", default=1.1, help="Zipf exponent of records per user.")
+    @click.option("--days", default=90, help="Spread records over the last N days.")
+    @click.option("--batch-size", default=5000, help="Rows per INSERT.")
+    @click.option("--seed", "seed", default=0, help="Random seed.")
+    def seed(users: int, records: int, skew: float, days: int, batch_size: int,
+             seed: int):
+        """Bulk-load a synthetic dataset into the configured database."""
+        began = time.perf_counter()
+        stats = seed_dataset(
+            users=users,
+            records=records,
+            skew=skew,
+            days=days,
+            batch_size=batch_size,
+            seed=seed,
+        )
+        print(f"bench seed: {stats} in {time.perf_counter() - began:.1f}s")
+
+    @bench_cli.command("run")
+    @click.option("--iterations", default=200, help="Calls per query.")
+    @click.option("--samples", default=50, help="Distinct users to query.")
+    @click.option("--only", multiple=True, help="Only run these queries.")
+    @click.option("--output", type=click.Path(), help="Write results as JSON.")
+    @click.option(
+        "--compare", type=click.File("r"), help="Compare with a previous JSON."
+    )
+    def run(iterations: int, samples: int, only: typing.Tuple[str, ...],
+            output: typing.Optional[str], compare: typing.Optional[typing.TextIO]):
+        """Time every model query helper against the current data."""
+        report = run_benchmarks(
+            iterations=iterations, samples=samples, only=list(only) or None
+        )
+        print(
+            f"commit {report['commit']}, {report['dialect']}, rows {report['rows']}"
+        )
+        print(f"{'query':<44}{'mean':>10}{'p50':>10}{'p95':>10}{'rows':>8}")
+        for name, result in report["results"].items():
+            print(
+                f"{name:<44}{result['mean_ms']:>10.3f}{result['p50_ms']:>10.3f}"
+                f"{result['p95_ms']:>10.3f}{result['rows']:>8}"
+            )
+        if compare is not None:
+            print("\n".join(compare_results(json.load(compare), report)))
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+    app.cli.add_command(bench_cli)
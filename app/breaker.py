@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import typing
+from collections import deque
+
+__all__ = ["CircuitOpenError", "CircuitBreaker", "BreakerRegistry"]
+
+
+class CircuitOpenError(Exception):
+    """ 熔断器打开，请求没有发出
+
+    Args:
+        name: 熔断器名称
+        retry_after: 距离下一次允许试探的秒数
+    """
+
+    def __init__(self, name: str, retry_after: float = 0.0) -> None:
+        super().__init__(f"circuit {name} is open")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """ 一个上游或者一个 key 的熔断器
+    关闭状态下统计最近 window 秒内的请求，请求数量不少于 min_requests 且失败率
+    (慢请求也算作失败)不低于 error_rate 时打开；打开 open_seconds 秒内直接拒绝请求，
+    之后进入半开状态，最多同时放行 half_open_calls 个试探请求，
+    试探全部成功后关闭，任意一个失败时重新打开。
+
+    Args:
+        name: 熔断器名称，用于日志与展示
+        window: 统计失败率的时间窗口秒数
+        min_requests: 窗口内至少有多少个请求才会打开
+        error_rate: 打开的失败率
+        slow_call_seconds: 超过这个耗时的请求算作失败，为空时不统计慢请求
+        open_seconds: 打开之后多久进入半开状态
+        half_open_calls: 半开状态放行的试探请求数量
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 60,
+        min_requests: int = 10,
+        error_rate: float = 0.5,
+        slow_call_seconds: typing.Optional[float] = None,
+        open_seconds: float = 30,
+        half_open_calls: int = 2,
+    ) -> None:
+        self.name = name
+        self.window = window
+        self.min_requests = max(min_requests, 1)
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(half_open_calls, 1)
+        self.state = self.CLOSED
+        # 打开的次数与打开期间拒绝的请求数量
+        self.opened = 0
+        self.rejected = 0
+        self._calls: typing.Deque[typing.Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._calls and self._calls[0][0] < now - self.window:
+            _, failed = self._calls.popleft()
+            self._failures -= failed
+
+    def _open(self, now: float) -> None:
+        self.state = self.OPEN
+        self.opened += 1
+        self._opened_at = now
+        self._calls.clear()
+        self._failures = 0
+        print(f"circuit breaker {self.name} open")
+
+    def _close(self) -> None:
+        self.state = self.CLOSED
+        self._calls.clear()
+        self._failures = 0
+        print(f"circuit breaker {self.name} closed")
+
+    def retry_after(self, now: typing.Optional[float] = None) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(self._opened_at + self.open_seconds - now, 0.0)
+
+    def available(self) -> bool:
+        """ 现在是否可能放行请求，不占用半开状态的试探名额
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return self.retry_after() <= 0
+            if self.state == self.HALF_OPEN:
+                return self._trials < self.half_open_calls
+            return True
+
+    def allow(self) -> bool:
+        """ 申请发出一个请求，放行之后必须调用 record 或者 release
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.retry_after() > 0:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trials = 0
+                self._successes = 0
+            if self.state == self.HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    return False
+                self._trials += 1
+            return True
+
+    def release(self) -> None:
+        """ 放行的请求没有发出或者中途取消，不计入统计
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record(self, ok: bool, latency: float = 0.0) -> None:
+        failed = not ok or (
+            self.slow_call_seconds is not None
+            and latency >= self.slow_call_seconds
+        )
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if failed:
+                    self._open(now)
+                    return
+                self._successes += 1
+                if self._successes >= self.half_open_calls:
+                    self._close()
+                return
+            if self.state == self.OPEN:
+                # 打开之前发出的请求，结果不再影响状态
+                return
+            self._calls.append((now, failed))
+            self._failures += failed
+            self._expire(now)
+            total = len(self._calls)
+            if total >= self.min_requests and self._failures >= total * self.error_rate:
+                self._open(now)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "state": self.state,
+                "requests": len(self._calls),
+                "failures": self._failures,
+                "retry_after": round(self.retry_after(), 3),
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+class BreakerRegistry(object):
+    """ 按名称创建、保存熔断器，所有熔断器使用相同的参数
+    """
+
+    def __init__(self, **options: typing.Any) -> None:
+        self.options = options
+        self._breakers: typing.Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    name, CircuitBreaker(name, **self.options)
+                )
+        return breaker
+
+    def reset(self, name: typing.Optional[str] = None) -> None:
+        with self._lock:
+            if name is None:
+                self._breakers.clear()
+            else:
+                self._breakers.pop(name, None)
+
+    def to_json(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.to_json() for breaker in breakers}
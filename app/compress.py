@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+import typing
+import zlib
+from collections import OrderedDict
+
+from flask import Flask, Response, current_app, g, request
+
+try:
+    import brotli
+except ImportError:    # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:    # pragma: no cover
+    zstandard = None
+
+__all__ = [
+    "available_encodings", "negotiate", "StreamCompressor", "CompressedCache",
+    "compress", "cache_response", "get_cache"
+]
+
+
+def available_encodings() -> typing.List[str]:
+    """ 当前环境可以使用的压缩算法，brotli 与 zstandard 是可选依赖
+    """
+    encodings = ["gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def negotiate(
+    accept_encodings: typing.Any, preferred: typing.List[str]
+) -> typing.Optional[str]:
+    """ 按照 Accept-Encoding 的 q 值选择压缩算法，q 值相同时按照 preferred 的顺序
+
+    Args:
+        accept_encodings: request.accept_encodings
+        preferred: 服务端可以使用的算法，越靠前越优先
+    """
+    best: typing.Optional[str] = None
+    best_quality = 0.0
+    for encoding in preferred:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """ 一次压缩完整的响应
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StreamCompressor(object):
+    """ 流式响应的压缩，每个分块压缩之后立即 flush，客户端收到分块就可以解压，
+    不会因为压缩缓冲而推迟 ndjson 的每一行
+    """
+
+    def __init__(self, encoding: str, level: int) -> None:
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        if self.encoding == "zstd":
+            return self._compressor.compress(data) + self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressedCache(object):
+    """ (算法, 响应内容的摘要) -> 压缩结果的进程内 LRU 缓存，按照压缩结果的总字节数淘汰
+    以内容摘要为 key，内容变化时自然不会命中，不需要失效；
+    只缓存接口标记为不会再变化的响应(例如按 sid 向前翻页的聊天记录)。
+
+    Args:
+        max_bytes: 最多缓存的压缩结果字节数
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[typing.Tuple[str, bytes], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(encoding: str, data: bytes) -> typing.Tuple[str, bytes]:
+        return encoding, hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key: typing.Tuple[str, bytes]) -> typing.Optional[bytes]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, key: typing.Tuple[str, bytes], payload: bytes) -> None:
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = payload
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def get_cache() -> CompressedCache:
+    return current_app.extensions["compress_cache"]
+
+
+def cache_response() -> None:
+    """ 在视图中调用，表示当前响应的内容不会再变化，压缩结果可以缓存
+    """
+    g.compress_cacheable = True
+
+
+def _stream(
+    chunks: typing.Iterable[typing.Any], compressor: StreamCompressor
+) -> typing.Iterator[bytes]:
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            payload = compressor.compress(chunk)
+            if payload:
+                yield payload
+        yield compressor.finish()
+    finally:
+        # 客户端断开时 WSGI 服务器关闭响应，原来的生成器需要随之关闭
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def init_app(app: Flask) -> None:
+    """ 按照 Accept-Encoding 压缩 COMPRESS_MIMETYPES 中的响应
+    需要在其他修改响应内容的 after_request 之前注册，after_request 按注册的相反顺序执行，
+    这样压缩总是最后一步
+    """
+    if not app.config["COMPRESS_ENABLED"]:
+        return
+    encodings = available_encodings()
+    preferred = [e for e in app.config["COMPRESS_ALGORITHMS"] if e in encodings]
+    mimetypes = set(app.config["COMPRESS_MIMETYPES"])
+    min_size: int = app.config["COMPRESS_MIN_SIZE"]
+    levels: typing.Dict[str, int] = app.config["COMPRESS_LEVELS"]
+    stream_levels: typing.Dict[str, int] = app.config["COMPRESS_STREAM_LEVELS"]
+    cache_levels: typing.Dict[str, int] = app.config["COMPRESS_CACHE_LEVELS"]
+    cache = app.extensions["compress_cache"] = CompressedCache(
+        max_bytes=app.config["COMPRESS_CACHE_MAX_BYTES"]
+    )
+
+    @app.after_request
+    def compress_response(response: Response) -> Response:
+        if (
+            response.mimetype not in mimetypes or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate(request.accept_encodings, preferred)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            compressor = StreamCompressor(encoding, stream_levels[encoding])
+            response.response = _stream(response.response, compressor)
+            response.headers.pop("Content-Length", None)
+            response.headers["Content-Encoding"] = encoding
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        if g.get("compress_cacheable"):
+            # 缓存的结果只压缩一次，使用更高的压缩级别
+            key = CompressedCache.key(encoding, data)
+            payload = cache.get(key)
+            if payload is None:
+                payload = compress(data, encoding, cache_levels[encoding])
+                cache.put(key, payload)
+        else:
+            payload = compress(data, encoding, levels[encoding])
+        response.set_data(payload)
+        response.headers["Content-Encoding"] = encoding
+        return response
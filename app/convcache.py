@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import threading
+import typing
+from collections import OrderedDict
+
+from flask import Flask, current_app
+
+__all__ = ["ConversationRef", "ConversationCache", "get_cache"]
+
+
+class ConversationRef(typing.NamedTuple):
+    cov_id: int
+    user_id: int
+
+
+class ConversationCache(object):
+    """ 会话标识符 -> (cov_id, user_id) 的进程内 LRU 缓存
+    会话创建之后标识符与所属用户不会再变化，所以缓存不需要过期，
+    多轮对话直接从缓存得到 cov_id 并校验所属用户，不需要查询数据库。
+
+    Args:
+        max_entries: 最多缓存的会话数量
+    """
+
+    def __init__(self, max_entries: int = 100000) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, ConversationRef]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, identifier: str) -> typing.Optional[ConversationRef]:
+        with self._lock:
+            ref = self._entries.get(identifier)
+            if ref is not None:
+                self._entries.move_to_end(identifier)
+            return ref
+
+    def put(self, identifier: str, cov_id: int, user_id: int) -> ConversationRef:
+        ref = ConversationRef(cov_id=cov_id, user_id=user_id)
+        with self._lock:
+            self._entries[identifier] = ref
+            self._entries.move_to_end(identifier)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return ref
+
+
+def get_cache() -> ConversationCache:
+    return current_app.extensions["gpt_conversations"]
+
+
+def init_app(app: Flask) -> None:
+    app.extensions["gpt_conversations"] = ConversationCache(
+        max_entries=app.config["GPT_CONVERSATION_CACHE_SIZE"]
+    )
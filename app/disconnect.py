@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import select
+import socket
+import time
+import typing
+
+__all__ = ["get_client_socket", "is_disconnected", "DisconnectWatcher"]
+
+# 不同 WSGI 服务器在 environ 中保存客户端连接的位置
+_SOCKET_KEYS = ("gunicorn.socket", "gunicorn.sock", "werkzeug.socket")
+
+
+def get_client_socket(
+    environ: typing.Mapping[str, typing.Any]
+) -> typing.Optional[socket.socket]:
+    """ 从 WSGI environ 中取出客户端连接，服务器不提供时返回 None
+    """
+    for key in _SOCKET_KEYS:
+        sock = environ.get(key)
+        if sock is not None:
+            return sock
+    return None
+
+
+def is_disconnected(sock: socket.socket) -> bool:
+    """ 客户端是否已经断开连接
+    连接可读且读到 EOF 时认为已经断开；可读但是有数据(例如 keep-alive 的下一个请求)时认为仍然连接
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # 不支持 MSG_PEEK 的连接(例如 TLS)，无法判断
+        return False
+    except OSError:
+        return True
+
+
+class DisconnectWatcher(object):
+    """ 检查客户端是否断开，最多每 interval 秒检查一次连接
+
+    Args:
+        sock: 客户端连接
+        interval: 两次检查的最小间隔秒数
+    """
+
+    def __init__(self, sock: socket.socket, interval: float = 0.5) -> None:
+        self.sock = sock
+        self.interval = interval
+        self.disconnected = False
+        self._checked_at = 0.0
+
+    def __call__(self) -> bool:
+        if self.disconnected:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at >= self.interval:
+            self._checked_at = now
+            self.disconnected = is_disconnected(self.sock)
+        return self.disconnected
+
+    @staticmethod
+    def from_environ(
+        environ: typing.Mapping[str, typing.Any], interval: float = 0.5
+    ) -> typing.Optional["DisconnectWatcher"]:
+        sock = get_client_socket(environ)
+        if sock is None:
+            return None
+        return DisconnectWatcher(sock, interval=interval)
@@ -1,17 +1,129 @@
 # -*- coding: utf-8 -*-
 import os
+import json
+import hashlib
+import math
+import datetime
+import time
 import typing
-from random import choice
-from openai import ChatCompletion
-from flask import Flask, Blueprint, current_app, request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Blueprint, Response, current_app, g, make_response, request
+from flask import stream_with_context
+from sqlalchemy import insert
 from flask_login import login_required, current_user
-import openai
+from app import router
+from app import httpclient
+from app import jobs
+from app import simcache
+from app import convcache
+from app import keyprobe
+from app import idempotency
+from app import compress
+from app import ratelimit
 from app.ext import db
-from app.utils import parse_params, get_unix_time_tuple
-from app.response import response_error, response_succ
+from app.disconnect import DisconnectWatcher
+from app.schema import Field, Schema, validate_params
+from app.utils import get_unix_time_tuple
+from app.response import make_etag, response_error, response_not_modified
+from app.response import response_succ, with_etag
 from app.model import ChatRecord, User, Conversation, ChatGPTKey, ChatAuth
+from app.model import ChatJob, UsageRollup
 
 bp = Blueprint("gpt", __name__, url_prefix="/gpt")
+# WebSocket 路由需要可选依赖 flask-sock: `poetry install -E websocket`
+ws_bp = Blueprint("gpt_ws", __name__, url_prefix="/gpt")
+
+MESSAGE_SCHEMA = Schema({
+    "role": Field(str, required=True, choices=("system", "user", "assistant")),
+    "content": Field(str, required=True, max_length="GPT_MAX_PROMPT_LENGTH"),
+    "name": Field(str, max_length=64),
+})
+COMPLETION_FIELDS = {
+    "messages": Field(
+        list, max_length="GPT_MAX_MESSAGES", items=Field(MESSAGE_SCHEMA)
+    ),
+    "model": Field(str, max_length=64),
+    "max_token": Field(int, minimum=1),
+    "temperature": Field(float, minimum=0, maximum=2),
+}
+COMPETION_SCHEMA = Schema(
+    {
+        **COMPLETION_FIELDS,
+        "conversation": Field(str, max_length=32),
+    },
+    max_bytes="GPT_MAX_BODY_BYTES",
+)
+BATCH_SCHEMA = Schema(
+    {
+        **COMPLETION_FIELDS,
+        "prompts": Field(
+            list,
+            max_length="GPT_BATCH_MAX_PROMPTS",
+            items=Field(
+                (str, Schema(COMPLETION_FIELDS)),
+                max_length="GPT_MAX_PROMPT_LENGTH"
+            ),
+        ),
+    },
+    max_bytes="GPT_BATCH_MAX_BODY_BYTES",
+)
+AUTH_BATCH_SCHEMA = Schema(
+    {
+        "days": Field(int, default=1, minimum=1),
+        "grants": Field(
+            list,
+            required=True,
+            max_length="GPT_AUTH_BATCH_MAX_GRANTS",
+            items=Field(
+                Schema(
+                    {
+                        "idf": Field(str, required=True, max_length=32),
+                        "days": Field(int, minimum=1),
+                    }
+                )
+            ),
+        ),
+    },
+    max_bytes="GPT_BATCH_MAX_BODY_BYTES",
+)
+JOB_SCHEMA = Schema({"wait": Field(float, minimum=0)}, max_bytes=0)
+CHAT_RECORDS_SCHEMA = Schema(
+    {
+        "limit": Field(int, default=10, minimum=0),
+        "page": Field(int, default=0, minimum=0),
+        "before": Field(int, minimum=0),
+    },
+    max_bytes="GPT_MAX_BODY_BYTES",
+)
+CONVERSATIONS_SCHEMA = Schema(
+    {
+        "limit": Field(int, default=20, minimum=1),
+        "before": Field(int, minimum=0),
+    },
+    max_bytes="GPT_MAX_BODY_BYTES",
+)
+USAGE_SCHEMA = Schema(
+    {
+        "start": Field(str, max_length=10),
+        "end": Field(str, max_length=10),
+    },
+    max_bytes="GPT_MAX_BODY_BYTES",
+)
+SOCKET_MESSAGE_SCHEMA = Schema({
+    "type": Field(str, required=True, choices=("auth", "ask")),
+    "token": Field(str, max_length=64),
+    "content": Field(str, max_length="GPT_MAX_PROMPT_LENGTH"),
+    "model": Field(str, max_length=64),
+    "max_token": Field(int, minimum=1),
+    "temperature": Field(float, minimum=0, maximum=2),
+})
+AUTH_SCHEMA = Schema(
+    {
+        "idf": Field(str, max_length=32),
+        "days": Field(int, default=1, minimum=1),
+    },
+    max_bytes=0,
+)
 
 
 def __get_default_params_from_params(params: typing.Dict[str, typing.Any]):
@@ -25,118 +137,807 @@ def __get_default_params_from_params(params: typing.Dict[str, typing.Any]):
     return model, max_token, temperature
 
 
-@bp.route("/competion/", methods=["POST"])
-@login_required
-def create_competion():
-    user: User = current_user
-    params = parse_params(request)
-    messages: typing.List[typing.Dict[str, str]] = params.get("messages") or []
-    conversation_idf = params.get("conversation")
+def __pick_api_key(user: User) -> typing.Optional[ChatGPTKey]:
+    """ 为用户挑选一个 key，优先使用用户自己的 key
+    """
+    api_key: typing.Optional[ChatGPTKey] = None
 
-    model, max_token, temperature = __get_default_params_from_params(params)
+    if current_app.config["TESTING"]:
+        # fill test api key
+        api_key = ChatGPTKey.get_test_key(user=user)
+
+    if user_key := ChatGPTKey.get_user_key_if_could(user):
+        api_key = user_key
+
+    if not api_key:
+        api_key = ChatGPTKey.get_avaliable_key(
+            exclude=router.get_router().open_keys()
+        )
+    return api_key
+
+
+def __pick_api_keys(user: User, limit: int) -> typing.List[ChatGPTKey]:
+    """ 为批量请求挑选多个 key，用户自己有 key 时只使用用户的 key
+    """
+    if user_key := ChatGPTKey.get_user_key_if_could(user):
+        return [user_key]
+    if current_app.config["TESTING"]:
+        return [ChatGPTKey.get_test_key(user=user)]
+    return ChatGPTKey.get_avaliable_keys(
+        limit=limit, exclude=router.get_router().open_keys()
+    )
+
+
+class Completion(typing.NamedTuple):
+    content: str
+    tokens: int
 
+
+def __estimate_tokens(
+    messages: typing.List[typing.Dict[str, str]], content: str
+) -> int:
+    """ 上游没有返回用量时估算 token 数量：中日韩字符按 1 个 token，
+    其他字符按 4 个字符 1 个 token，每条消息另加 4 个 token 的格式开销
+    """
+    def count(text: str) -> int:
+        wide = sum(1 for c in text if ord(c) >= 0x2E80)
+        return wide + (len(text) - wide + 3) // 4
+
+    prompt = sum(count(m.get("content") or "") + 4 for m in messages)
+    return prompt + count(content) + 4
+
+
+def __request_completion(
+    model: str,
+    messages: typing.List[typing.Dict[str, str]],
+    max_token: int,
+    temperature: float,
+    api_key: str,
+    on_delta: typing.Optional[typing.Callable[[str], None]] = None,
+    is_aborted: typing.Optional[typing.Callable[[], bool]] = None,
+) -> typing.Optional[Completion]:
+    """ 请求上游并返回去掉首尾空白的回答与消耗的 token，上游没有返回结果时返回 None
+    传入 on_delta 或者 is_aborted 时使用流式请求：收到每个片段时调用 on_delta，
+    is_aborted 返回 True 时关闭上游连接并抛出 CompletionAborted。
+    流式请求使用上游在最后返回的用量，上游不支持时按照内容估算 token 数量
+    """
+    if current_app.config["TESTING"]:
+        content = f"测试内容: 我是{messages[-1].get('content')}问题的回答"
+        if on_delta is not None:
+            on_delta(content)
+        return Completion(content=content, tokens=0)
+    if on_delta is not None or is_aborted is not None:
+        parts: typing.List[str] = []
+        usages: typing.List[typing.Dict[str, typing.Any]] = []
+        stream = router.get_router().stream_chat_completion(
+            model=model,
+            messages=messages,
+            max_tokens=max_token,
+            temperature=temperature,
+            api_key=api_key,
+            timeout=current_app.config["GPT_UPSTREAM_TIMEOUT"],
+            on_usage=usages.append,
+        )
+        try:
+            for delta in stream:
+                if is_aborted is not None and is_aborted():
+                    raise CompletionAborted()
+                parts.append(delta)
+                if on_delta is not None:
+                    on_delta(delta)
+        finally:
+            stream.close()
+        content = "".join(parts).strip()
+        if not content:
+            return None
+        tokens = int(usages[-1].get("total_tokens") or 0) if usages else 0
+        return Completion(
+            content=content,
+            tokens=tokens or __estimate_tokens(messages, content),
+        )
+    resp = router.get_router().create_chat_completion(
+        model=model,
+        messages=messages,
+        max_tokens=max_token,
+        temperature=temperature,
+        api_key=api_key,
+        timeout=current_app.config["GPT_UPSTREAM_TIMEOUT"],
+    )
+
+    choices = resp["choices"]
+    if not choices or len(choices) == 0:
+        return None
+    print(f"回答内容: choices: {choices}")
+    first_choices: dict = choices[0]
+    message: dict = first_choices["message"]
+    content: str = message["content"]
+    usage: dict = resp.get("usage") or {}
+    return Completion(
+        content=content.strip(), tokens=int(usage.get("total_tokens") or 0)
+    )
+
+
+def __record_usage(
+    user_id: int,
+    model: str,
+    prompts: typing.Iterable[str] = (),
+    answers: typing.Iterable[str] = (),
+    tokens: int = 0,
+) -> None:
+    """ 累加今天的用量汇总，与聊天记录在同一个事务中提交
+    """
+    prompts, answers = list(prompts), list(answers)
+    day = UsageRollup.day_of(
+        int(get_unix_time_tuple(millisecond=True)),
+        current_app.config["USAGE_UTC_OFFSET_HOURS"]
+    )
+    UsageRollup.add(
+        user_id=user_id,
+        day=day,
+        model=model,
+        message_count=len(prompts) + len(answers),
+        prompt_chars=sum(len(p) for p in prompts),
+        completion_chars=sum(len(a) for a in answers),
+        tokens=tokens,
+    )
+
+
+def __check_messages(
+    messages: typing.List[typing.Dict[str, str]]
+) -> typing.Optional[str]:
+    """ 检查询问内容，不合法时返回错误信息
+    """
     if not messages or len(messages) == 0:
-        return response_error(error_code=400, msg="messages is empty")
+        return "messages is empty"
     last_message = messages[-1]
     last_prompt = last_message.get("content")
     if not last_prompt:
-        return response_error(error_code=400, msg="prompt is empty")
+        return "prompt is empty"
+    return None
 
-    print(f"询问内容: {last_prompt}")
 
-    conversation = Conversation.get_conversation_by_identifier(
-        conversation_idf
+class CompletionError(Exception):
+    """ 询问失败，携带返回给客户端的错误码与错误信息
+    retry_after: 上游被熔断(503)时，建议客户端重试的秒数
+    """
+
+    def __init__(
+        self,
+        error_code: int,
+        msg: str,
+        retry_after: typing.Optional[float] = None
+    ) -> None:
+        super().__init__(msg)
+        self.error_code = error_code
+        self.msg = msg
+        self.retry_after = retry_after
+
+
+class CompletionAborted(CompletionError):
+    """ 客户端已经断开连接，中止询问
+    """
+
+    def __init__(self) -> None:
+        super().__init__(error_code=400, msg="客户端已断开连接")
+
+
+def __completion_error(e: CompletionError):
+    """ 询问失败的响应，上游被熔断时返回 HTTP 503 与 Retry-After，客户端与代理可以直接识别
+    """
+    if e.error_code != 503:
+        return response_error(error_code=e.error_code, msg=e.msg)
+    response = make_response(
+        response_error(error_code=503, msg=e.msg, http_code=503)
     )
-    if not conversation:
-        conversation = Conversation(user=user, identifier=conversation_idf)
-        db.session.add(conversation)
+    response.headers["Retry-After"] = str(max(math.ceil(e.retry_after or 0), 1))
+    return response
 
-    api_key: typing.Optional[ChatGPTKey] = None
 
-    if current_app.config["TESTING"]:
-        # fill test api key
-        api_key = ChatGPTKey.get_test_key(user=user)
+def __resolve_conversation(
+    user: User, identifier: typing.Optional[str]
+) -> typing.Tuple[int, str]:
+    """ 根据标识符得到会话的 cov_id，会话不存在时创建
+    缓存命中时不查询数据库；会话属于其他用户时拒绝
 
-    if user_key := ChatGPTKey.get_user_key_if_could(user):
-        api_key = user_key
+    Returns:
+        (cov_id, identifier)
+    Raises:
+        CompletionError: 会话不属于当前用户
+    """
+    cache = convcache.get_cache()
+    ref = cache.get(identifier) if identifier else None
+    if ref is None and identifier:
+        owner = Conversation.get_owner_by_identifier(identifier)
+        if owner:
+            ref = cache.put(identifier, *owner)
+    if ref is None:
+        cov_id, user_id, identifier = Conversation.create_or_get(
+            user=user, identifier=identifier
+        )
+        ref = cache.put(identifier, cov_id, user_id)
+    if ref.user_id != user.id:
+        raise CompletionError(error_code=403, msg="会话不存在")
+    return ref.cov_id, identifier
 
-    if not api_key:
-        keys = ChatGPTKey.get_avaliable_key()
-        k: ChatGPTKey = choice(keys)
-        if k:
-            api_key = k.content
 
+def complete_chat(
+    user: User,
+    messages: typing.List[typing.Dict[str, str]],
+    conversation_idf: typing.Optional[str],
+    model: str,
+    max_token: int,
+    temperature: float,
+    on_delta: typing.Optional[typing.Callable[[str], None]] = None,
+    is_aborted: typing.Optional[typing.Callable[[], bool]] = None,
+) -> typing.Dict[str, typing.Any]:
+    """ 完成一轮对话：记录问题、请求上游、记录回答
+    需要在 app context 中调用，请求接口、后台任务与 WebSocket 共用
+
+    Args:
+        on_delta: 流式返回回答的片段，命中缓存时一次返回全部内容
+        is_aborted: 客户端是否已经断开，断开时取消上游请求、立即释放 key，
+            问题记录标记为中止，不写入回答
+
+    Returns:
+        返回给客户端的报文内容
+    Raises:
+        CompletionError: 没有可用的 key 或者上游请求失败
+    """
+    import openai
+    last_prompt = messages[-1].get("content")
+    print(f"询问内容: {last_prompt}")
+
+    cov_id, conversation_idf = __resolve_conversation(
+        user, conversation_idf
+    )
+    user_id: int = user.id
+
+    cache = simcache.get_cache()
+    if cache is None or not simcache.is_cacheable(messages, temperature):
+        cache = None
+    elif (cached := cache.get(model, last_prompt)) is not None:
+        print(f"命中相似问题缓存: {last_prompt}")
+        prompt_record = ChatRecord(
+            user=user,
+            content=last_prompt,
+            conversation=cov_id,
+            response_chat=None,
+            model=model,
+        )
+        db.session.add(prompt_record)
+        db.session.add(
+            ChatRecord(
+                user=user,
+                content=cached,
+                conversation=cov_id,
+                response_chat=prompt_record,
+                model=model,
+                tokens=0,
+            )
+        )
+        Conversation.add_messages([(cov_id, 2, cached)])
+        __record_usage(
+            user_id, model, prompts=[last_prompt], answers=[cached]
+        )
+        db.session.commit()
+        if on_delta is not None:
+            on_delta(cached)
+        return {
+            "conversation": conversation_idf,
+            "content": cached,
+        }
+
+    upstream_router = router.get_router()
+    if not upstream_router.is_available(model):
+        # 上游被熔断时直接失败，不占用 key，也不等待上游超时
+        raise CompletionError(
+            error_code=503,
+            msg="上游服务暂时不可用，请稍后再试",
+            retry_after=upstream_router.retry_after(model),
+        )
+    api_key = __pick_api_key(user)
     if not api_key:
-        return response_error(error_code=400, msg="当前服务繁忙，请稍后再试")
+        raise CompletionError(error_code=400, msg="当前服务繁忙，请稍后再试")
 
     prompt_record = ChatRecord(
         user=user,
         content=last_prompt,
-        conversation=conversation,
-        response_chat=None
+        conversation=cov_id,
+        response_chat=None,
+        model=model,
     )
     api_key.occupy_uid = user.id
+    # 提交之后属性会过期，提前取出，避免等待上游期间重新查询并占用数据库连接
+    api_key_content = api_key.content
     db.session.add(prompt_record)
+    Conversation.add_messages([(cov_id, 1, last_prompt)])
+    __record_usage(user_id, model, prompts=[last_prompt])
     db.session.commit()
     try:
-        content_striped: str
-        if current_app.config["TESTING"]:
-            content_striped = f"测试内容: 我是{last_prompt}问题的回答"
-        else:
-            resp = ChatCompletion.create(
-                api_key=api_key,
-                model=model,
-                messages=messages,
-                max_tokens=max_token,
-                temperature=temperature,
-                timeout=10,
-            )
-
-            choices = resp["choices"]
-            if not choices or len(choices) == 0:
-                return response_error(error_code=400, msg="当前服务繁忙，请稍后再试")
-            print(f"回答内容: choices: {choices}")
-            first_choices: dict = choices[0]
-            message: dict = first_choices["message"]
-            content: str = message["content"]
-            content_striped = content.strip()
+        completion = __request_completion(
+            model=model,
+            messages=messages,
+            max_token=max_token,
+            temperature=temperature,
+            api_key=api_key_content,
+            on_delta=on_delta,
+            is_aborted=is_aborted,
+        )
+        if completion is None:
+            raise CompletionError(error_code=400, msg="当前服务繁忙，请稍后再试")
+        content_striped = completion.content
+        if cache is not None:
+            cache.put(model, last_prompt, content_striped)
 
         resp_record = ChatRecord(
             user=user,
             content=content_striped,
-            conversation=conversation,
-            response_chat=prompt_record
+            conversation=cov_id,
+            response_chat=prompt_record,
+            model=model,
+            tokens=completion.tokens,
         )
         db.session.add(resp_record)
+        Conversation.add_messages([(cov_id, 1, content_striped)])
+        __record_usage(
+            user_id,
+            model,
+            answers=[content_striped],
+            tokens=completion.tokens
+        )
         db.session.commit()
-        return response_succ(
-            body={
-                "conversation": conversation.identifier,
-                "content": content_striped,
-            }
+        return {
+            "conversation": conversation_idf,
+            "content": content_striped,
+        }
+    except CompletionAborted:
+        print(f"客户端断开，中止询问: {last_prompt}")
+        ChatRecord.mark_aborted(prompt_record.chat_id)
+        # 更新会话的 last_sid，聊天记录的 ETag 随之变化
+        Conversation.add_messages([(cov_id, 0, last_prompt)])
+        raise
+    except CompletionError:
+        raise
+    except router.CircuitOpenError as e:
+        print(f"CircuitOpenError: {e}")
+        raise CompletionError(
+            error_code=503,
+            msg="上游服务暂时不可用，请稍后再试",
+            retry_after=e.retry_after,
         )
     except openai.error.RateLimitError as e:
         print(f"RateLimitError: {e}")
-        return response_error(error_code=400, msg="当前服务繁忙，请稍后再试")
+        raise CompletionError(error_code=400, msg="当前服务繁忙，请稍后再试")
     except Exception as e:
         print(f"exception: {e}")
-        return response_error(error_code=400, msg="请稍后再试")
+        raise CompletionError(error_code=400, msg="请稍后再试")
     finally:
         api_key.occupy_uid = None
         db.session.commit()
 
 
-@bp.route("/chat_records/", methods=["POST"])
+def __disconnect_watcher() -> typing.Optional[DisconnectWatcher]:
+    """ 当前请求的客户端断开检测，关闭或者 WSGI 服务器不提供连接时返回 None
+    """
+    if not current_app.config["GPT_ABORT_ON_DISCONNECT"]:
+        return None
+    return DisconnectWatcher.from_environ(
+        request.environ,
+        interval=current_app.config["GPT_DISCONNECT_CHECK_INTERVAL"]
+    )
+
+
+@bp.route("/competion/", methods=["POST"])
+@validate_params(COMPETION_SCHEMA)
+@login_required
+def create_competion():
+    user: User = current_user
+    params = g.params
+    messages: typing.List[typing.Dict[str, str]] = params.get("messages") or []
+    conversation_idf = params.get("conversation")
+
+    model, max_token, temperature = __get_default_params_from_params(params)
+
+    if error_msg := __check_messages(messages):
+        return response_error(error_code=400, msg=error_msg)
+
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is not None:
+        return __idempotent_competion(user, idempotency_key, params)
+
+    try:
+        body = complete_chat(
+            user=user,
+            messages=messages,
+            conversation_idf=conversation_idf,
+            model=model,
+            max_token=max_token,
+            temperature=temperature,
+            is_aborted=__disconnect_watcher(),
+        )
+    except CompletionError as e:
+        return __completion_error(e)
+    return response_succ(body=body)
+
+
+def __idempotent_competion(user: User, idempotency_key: str,
+                           params: typing.Dict[str, typing.Any]):
+    """ 带 Idempotency-Key 的请求
+    同一个用户的同一个 key 只请求一次上游，结果保存在数据库中，多个 worker 进程共享：
+    结果保存 GPT_IDEMPOTENCY_TTL 秒，重试时直接返回保存的结果；
+    原请求还在处理时，重复的请求等待原请求结束。
+    同一个 key 的请求参数不同时返回错误。
+    """
+    idempotency_key = idempotency_key.strip()
+    if not idempotency_key or len(idempotency_key) > 255:
+        return response_error(error_code=400, msg="Idempotency-Key 不合法")
+    store = idempotency.get_store()
+    fingerprint = hashlib.sha256(
+        json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    deadline = time.monotonic() + current_app.config["GPT_IDEMPOTENCY_WAIT"]
+
+    while True:
+        entry, is_owner = store.begin(user.id, idempotency_key, fingerprint)
+        if entry.fingerprint != fingerprint:
+            return response_error(
+                error_code=400, msg="Idempotency-Key 已用于其他请求"
+            )
+        if is_owner:
+            break
+        if not store.wait(entry, max(deadline - time.monotonic(), 0)):
+            return response_error(error_code=400, msg="请求正在处理中，请稍后重试")
+        if entry.result is not None:
+            body, status_code, header = response_succ(body=entry.result)
+            header["Idempotent-Replayed"] = "true"
+            return body, status_code, header
+        # 原请求失败，没有保存结果，由当前请求重新执行
+
+    model, max_token, temperature = __get_default_params_from_params(params)
+    try:
+        body = complete_chat(
+            user=user,
+            messages=params.get("messages") or [],
+            conversation_idf=params.get("conversation"),
+            model=model,
+            max_token=max_token,
+            temperature=temperature,
+            is_aborted=__disconnect_watcher(),
+        )
+    except CompletionError as e:
+        store.abandon(entry)
+        return __completion_error(e)
+    except BaseException:
+        store.abandon(entry)
+        raise
+    store.finish(entry, body)
+    return response_succ(body=body)
+
+
+@bp.route("/competion/batch/", methods=["POST"])
+@validate_params(BATCH_SCHEMA)
+@login_required
+def create_competion_batch():
+    """批量询问接口
+    每个 prompt 相互独立，各自创建一个会话，使用 key 池并发请求上游，
+    按照完成顺序以 NDJSON 逐行返回，结束后一次性批量写入聊天记录
+
+    prompts: 字符串，或者包含 messages/model/max_token/temperature 的字典
+    """
+    user: User = current_user
+    params = g.params
+    prompts: typing.List[typing.Any] = params.get("prompts") or []
+    if not prompts:
+        return response_error(error_code=400, msg="prompts is empty")
+
+    jobs: typing.List[typing.Tuple[typing.Any, ...]] = []
+    for prompt in prompts:
+        item_params: typing.Dict[str, typing.Any] = {}
+        if isinstance(prompt, dict):
+            item_params = {k: v for k, v in prompt.items() if v is not None}
+            messages = prompt.get("messages") or []
+        else:
+            messages = [{"role": "user", "content": prompt}]
+        if not messages or not messages[-1].get("content"):
+            return response_error(error_code=400, msg="prompt is empty")
+        jobs.append(
+            (
+                messages,
+                *__get_default_params_from_params({
+                    **params,
+                    **item_params
+                }),
+            )
+        )
+
+    upstream_router = router.get_router()
+    unavailable = [
+        job[1] for job in jobs if not upstream_router.is_available(job[1])
+    ]
+    if unavailable:
+        return __completion_error(
+            CompletionError(
+                error_code=503,
+                msg="上游服务暂时不可用，请稍后再试",
+                retry_after=max(upstream_router.retry_after(m) for m in unavailable),
+            )
+        )
+    concurrency = min(current_app.config["GPT_BATCH_CONCURRENCY"], len(jobs))
+    api_keys = __pick_api_keys(user, limit=concurrency)
+    if not api_keys:
+        return response_error(error_code=400, msg="当前服务繁忙，请稍后再试")
+    key_contents = [k.content for k in api_keys]
+
+    conversations = [Conversation(user=user) for _ in jobs]
+    db.session.add_all(conversations)
+    for k in api_keys:
+        k.occupy_uid = user.id
+    db.session.flush()
+    conversation_ids = [(c.cov_id, c.identifier) for c in conversations]
+    user_id: int = user.id
+    db.session.commit()
+    conversation_cache = convcache.get_cache()
+    for cov_id, identifier in conversation_ids:
+        conversation_cache.put(identifier, cov_id, user_id)
+
+    app = current_app._get_current_object()
+
+    def run(index: int) -> typing.Optional[Completion]:
+        messages, model, max_token, temperature = jobs[index]
+        with app.app_context():
+            return __request_completion(
+                model=model,
+                messages=messages,
+                max_token=max_token,
+                temperature=temperature,
+                api_key=key_contents[index % len(key_contents)],
+            )
+
+    def generate() -> typing.Iterator[str]:
+        rows: typing.List[typing.Dict[str, typing.Any]] = []
+        counters: typing.List[typing.Tuple[int, int, str]] = []
+        # model -> (提问, 回答, token)
+        usages: typing.Dict[str, typing.Tuple[typing.List[str], typing.List[str],
+                                             typing.List[int]]] = {}
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = {
+                executor.submit(run, index): index
+                for index in range(len(jobs))
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                cov_id, identifier = conversation_ids[index]
+                try:
+                    completion = future.result()
+                except Exception as e:
+                    print(f"batch exception: {e}")
+                    completion = None
+                create_at = int(get_unix_time_tuple(millisecond=True))
+                prompt_content = jobs[index][0][-1]["content"]
+                model = jobs[index][1]
+                prompts, answers, tokens = usages.setdefault(
+                    model, ([], [], [])
+                )
+                prompts.append(prompt_content)
+                rows.append(
+                    {
+                        "user_id": user_id,
+                        "conversation": cov_id,
+                        "content": prompt_content,
+                        "role": 1,
+                        "status": ChatRecord.STATUS_OK,
+                        "create_at": create_at,
+                        "model": model,
+                        "tokens": None,
+                    }
+                )
+                line: typing.Dict[str, typing.Any] = {
+                    "index": index,
+                    "conversation": identifier,
+                }
+                if completion is None:
+                    line["error"] = "请稍后再试"
+                    counters.append((cov_id, 1, prompt_content))
+                else:
+                    content = completion.content
+                    counters.append((cov_id, 2, content))
+                    answers.append(content)
+                    tokens.append(completion.tokens)
+                    line["content"] = content
+                    rows.append(
+                        {
+                            "user_id": user_id,
+                            "conversation": cov_id,
+                            "content": content,
+                            "role": 0,
+                            "status": ChatRecord.STATUS_OK,
+                            "create_at": create_at,
+                            "model": model,
+                            "tokens": completion.tokens,
+                        }
+                    )
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if rows:
+                db.session.execute(insert(ChatRecord), rows)
+                Conversation.add_messages(counters)
+                for model, (prompts, answers, tokens) in usages.items():
+                    __record_usage(
+                        user_id, model, prompts, answers, tokens=sum(tokens)
+                    )
+            for k in api_keys:
+                k.occupy_uid = None
+            db.session.commit()
+
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+
+
+@bp.route("/jobs/", methods=["POST"])
+@validate_params(COMPETION_SCHEMA)
+@login_required
+def create_job():
+    """提交后台询问任务
+    参数与询问接口一致，立即返回 202 与任务标识符，结果通过任务查询接口获取
+    """
+    user: User = current_user
+    params = g.params
+    messages: typing.List[typing.Dict[str, str]] = params.get("messages") or []
+    model, max_token, temperature = __get_default_params_from_params(params)
+    if error_msg := __check_messages(messages):
+        return response_error(error_code=400, msg=error_msg)
+
+    runner = jobs.get_runner()
+    runner.recover()
+    job = ChatJob(
+        user=user,
+        params={
+            "messages": messages,
+            "conversation_idf": params.get("conversation"),
+            "model": model,
+            "max_token": max_token,
+            "temperature": temperature,
+        }
+    )
+    db.session.add(job)
+    db.session.commit()
+    runner.submit(job.identifier)
+    return response_succ(body=job.to_json(), status_code=202)
+
+
+@bp.route("/jobs/<identifier>/", methods=["GET"])
+@validate_params(JOB_SCHEMA)
+@login_required
+def get_job(identifier: str):
+    """查询后台询问任务
+    wait: 长轮询的最长等待秒数，请求头 If-None-Match 与任务当前的 ETag 一致时，
+        等待任务状态变化，超时仍未变化则返回 304
+    """
+    params = g.params
+    wait = min(params["wait"] or 0, current_app.config["GPT_JOB_MAX_WAIT"])
+    poll_interval: float = current_app.config["GPT_JOB_POLL_INTERVAL"]
+    user_id: int = current_user.id
+    runner = jobs.get_runner()
+    runner.recover()
+
+    deadline = time.monotonic() + wait
+    while True:
+        job = ChatJob.get_job_by_identifier(identifier)
+        if not job or job.user_id != user_id:
+            return response_error(error_code=404, msg="任务不存在")
+        runner.resume(job)
+        etag = job.etag()
+        remaining = deadline - time.monotonic()
+        if not request.if_none_match.contains(etag) or job.is_finished(
+        ) or remaining <= 0:
+            break
+        # 结束当前事务，等待期间不占用数据库连接
+        db.session.rollback()
+        runner.wait(identifier, min(remaining, poll_interval))
+
+    if request.if_none_match.contains(etag):
+        not_modified = Response(status=304)
+        not_modified.set_etag(etag)
+        return not_modified
+    result, status_code, header = response_succ(body=job.to_json())
+    result.set_etag(etag)
+    return result, status_code, header
+
+
+@bp.route("/chat_records/", methods=["GET", "POST"])
+@validate_params(CHAT_RECORDS_SCHEMA)
 @login_required
 def get_recent_chat_records():
+    """聊天记录，从新到旧分页
+    ETag 由用户会话最大的 last_sid 与分页参数计算，If-None-Match 一致时
+    只执行一次索引查询，不查询聊天记录直接返回 304
+    """
     user: User = current_user
-    params = parse_params(request)
-    limit: int = params.get("limit", 10)
-    page: int = params.get("page", 0)
+    params = g.params
+    limit: int = params["limit"]
+    page: int = params["page"]
+    before = params["before"] or None
+    etag = make_etag(
+        "chat_records", user.id, Conversation.get_last_sid_of_user(user.id),
+        limit, page, before
+    )
+    if (not_modified := response_not_modified(etag)) is not None:
+        return not_modified
     records = ChatRecord.get_records_by_user_before_time(
-        user_id=user.id, limit=limit, page=page
+        user_id=user.id, limit=limit, page=page, before=before
     )
-    return response_succ(body=[record.to_json() for record in records])
+    if before:
+        # sid 之前的记录不会再增加，这一页的压缩结果可以缓存
+        compress.cache_response()
+    return with_etag(
+        response_succ(body=[record.to_json() for record in records]), etag
+    )
+
+
+@bp.route("/conversations/", methods=["POST"])
+@validate_params(CONVERSATIONS_SCHEMA)
+@login_required
+def get_conversations():
+    """会话列表，按照最后活跃时间从新到旧排列
+    翻页时传入上一页最后一个会话的 last_sid 作为 before
+    """
+    user: User = current_user
+    params = g.params
+    limit: int = min(params["limit"], 100)
+    before = params["before"] or None
+    conversations = Conversation.get_conversations_by_user(
+        user_id=user.id, limit=limit, before=before
+    )
+    return response_succ(body=[c.to_json() for c in conversations])
+
+@bp.route("/usage/", methods=["POST"])
+@validate_params(USAGE_SCHEMA)
+@login_required
+def get_usage():
+    """按天、按模型的用量统计，数据来自预先汇总的 usage_rollup
+    start/end: YYYY-MM-DD，包含两端，默认为最近 30 天
+    """
+    user: User = current_user
+    params = g.params
+    offset: int = current_app.config["USAGE_UTC_OFFSET_HOURS"]
+    today = UsageRollup.day_of(int(get_unix_time_tuple(millisecond=True)), offset)
+    epoch = datetime.date(1970, 1, 1)
+    try:
+        end_day = (
+            datetime.date.fromisoformat(params["end"]) - epoch
+        ).days if params.get("end") else today
+        start_day = (
+            datetime.date.fromisoformat(params["start"]) - epoch
+        ).days if params.get("start") else end_day - 29
+    except (TypeError, ValueError):
+        return response_error(error_code=400, msg="日期格式应为 YYYY-MM-DD")
+    if start_day > end_day:
+        return response_error(error_code=400, msg="开始日期不能晚于结束日期")
+    if end_day - start_day + 1 > current_app.config["USAGE_MAX_DAYS"]:
+        return response_error(error_code=413, msg="查询的时间范围过大")
+
+    rollups = UsageRollup.get_user_usage(
+        user_id=user.id, start_day=start_day, end_day=end_day + 1
+    )
+    total = {
+        "message_count": 0,
+        "prompt_chars": 0,
+        "completion_chars": 0,
+        "tokens": 0,
+    }
+    for rollup in rollups:
+        for name in total:
+            total[name] += getattr(rollup, name)
+    return response_succ(
+        body={
+            "days": [rollup.to_json() for rollup in rollups],
+            "total": total,
+        }
+    )
+
 
 @bp.route("/api_key/", methods=["POST"])
 @login_required
@@ -177,16 +978,193 @@ def get_time_range():
         
 
 @bp.route("/auth/", methods=["GET"])
+@validate_params(AUTH_SCHEMA)
 def gpt_auth():
     import datetime
-    params = parse_params(request)
+    params = g.params
     idf = params.get("idf")
-    days = params.get("days", 1)
-    auth = ChatAuth.auth_by_endtime(user_idf=idf, endtime=datetime.datetime.now() + datetime.timedelta(days=days))
-    db.session.add(auth)
-    db.session.commit()
+    days = params["days"]
+    ChatAuth.auth_by_endtime(user_idf=idf, endtime=datetime.datetime.now() + datetime.timedelta(days=days))
+    ratelimit.get_tier_resolver().clear()
     return response_succ(body={"auth_idf": idf})
+
+
+def grant_auths(
+    grants: typing.List[typing.Tuple[str, int]]
+) -> typing.Dict[str, typing.Any]:
+    """ 批量授权并清空一次授权相关的缓存，接口与命令行共用
+
+    Args:
+        grants: [(用户标识符, 天数)]，结束时间为现在加上天数
+
+    Returns:
+        每种结果的数量与每一行的结果
+    """
+    now = int(get_unix_time_tuple(millisecond=True))
+    rows = [(idf, now + days * 24 * 3600 * 1000) for idf, days in grants]
+    outcomes = ChatAuth.grant_many(
+        rows, chunk_size=current_app.config["GPT_AUTH_BATCH_CHUNK_SIZE"]
+    )
+    ratelimit.get_tier_resolver().clear()
+    counts = {
+        outcome: 0 for outcome in (
+            ChatAuth.GRANT_CREATED, ChatAuth.GRANT_UPDATED,
+            ChatAuth.GRANT_UNKNOWN_USER, ChatAuth.GRANT_DUPLICATE
+        )
+    }
+    for outcome in outcomes:
+        counts[outcome] += 1
+    return {
+        **counts,
+        "results": [
+            {
+                "idf": idf,
+                "status": outcome,
+                "end_at": end_at,
+            } for (idf, end_at), outcome in zip(rows, outcomes)
+        ],
+    }
+
+
+@bp.route("/auth/batch/", methods=["POST"])
+@validate_params(AUTH_BATCH_SCHEMA)
+@login_required
+def gpt_auth_batch():
+    """批量授权，只有管理员可以调用
+    grants: [{"idf": 用户标识符, "days": 天数，默认使用外层的 days}]
+    每个分块执行一次批量更新与批量插入，返回每一行的结果
+    """
+    if current_user.identifier != current_app.config["ADMIN_USER_IDENTIFIER"]:
+        return response_error(error_code=403, msg="没有权限")
+    params = g.params
+    days: int = params["days"]
+    grants = [
+        (grant["idf"], grant["days"] or days) for grant in params["grants"]
+    ]
+    return response_succ(body=grant_auths(grants))
     
 
+def __receive_socket_message(
+    ws: typing.Any, validate: typing.Callable[[typing.Any], typing.Any],
+    timeout: float
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """ 接收一条 JSON 消息，超时返回 None，格式错误时抛出 SchemaError
+    """
+    from app.schema import SchemaError
+    data = ws.receive(timeout=timeout)
+    if data is None:
+        return None
+    try:
+        message = json.loads(data)
+    except ValueError:
+        raise SchemaError(400, "JSON 格式错误")
+    return validate(message)
+
+
+def __send_socket_message(ws: typing.Any, **message: typing.Any) -> None:
+    ws.send(json.dumps(message, ensure_ascii=False))
+
+
+def chat_socket(ws: typing.Any):
+    """绑定一个会话的 WebSocket 通道
+    连接时认证一次(请求头的 token 或者第一条 {"type": "auth", "token"} 消息)，
+    会话通过 query 参数 conversation 指定，为空时创建新的会话；
+    会话上下文保存在连接的内存中，每一轮只需要发送 {"type": "ask", "content"}，
+    回答以 {"type": "delta"} 逐个片段返回，结束时返回 {"type": "done"}。
+    聊天记录的保存与询问接口一致。
+    """
+    from app.schema import SchemaError
+    config = current_app.config
+    validate = SOCKET_MESSAGE_SCHEMA.bind(
+        current_app._get_current_object()    # type: ignore
+    )[0]
+    idle_timeout: float = config["GPT_WS_IDLE_TIMEOUT"]
+    max_messages: int = config["GPT_MAX_MESSAGES"]
+
+    user: typing.Optional[User] = None
+    if current_user.is_authenticated:
+        user = current_user._get_current_object()
+    else:
+        try:
+            message = __receive_socket_message(ws, validate, idle_timeout)
+        except SchemaError:
+            message = None
+        if message and message["type"] == "auth" and message["token"]:
+            user = User.query.filter_by(token=message["token"]).first()
+    if user is None:
+        __send_socket_message(ws, type="error", code=410, msg="认证错误, 请重新登录")
+        return
+    # 连接期间不再查询用户，提交事务后属性也不会过期
+    db.session.expunge(user)
+
+    try:
+        cov_id, conversation_idf = __resolve_conversation(
+            user, request.args.get("conversation") or None
+        )
+    except CompletionError as e:
+        __send_socket_message(ws, type="error", code=e.error_code, msg=e.msg)
+        return
+    # 答案记录的 role 为 0，问题记录的 role 为 1，见 ChatRecord.__init__
+    context: typing.List[typing.Dict[str, str]] = [
+        {
+            "role": "assistant" if record.role == 0 else "user",
+            "content": record.content,
+        } for record in ChatRecord.get_conversation_history(
+            cov_id, limit=max_messages - 1
+        )
+    ]
+    db.session.commit()
+    __send_socket_message(ws, type="ready", conversation=conversation_idf)
+
+    while True:
+        try:
+            message = __receive_socket_message(ws, validate, idle_timeout)
+        except SchemaError as e:
+            __send_socket_message(ws, type="error", code=e.error_code, msg=e.msg)
+            continue
+        if message is None:
+            return
+        if message["type"] != "ask" or not message["content"]:
+            __send_socket_message(ws, type="error", code=400, msg="prompt is empty")
+            continue
+        model, max_token, temperature = __get_default_params_from_params(
+            message
+        )
+        prompt = {"role": "user", "content": message["content"]}
+        messages = context[-(max_messages - 1):] + [prompt]
+        try:
+            body = complete_chat(
+                user=user,
+                messages=messages,
+                conversation_idf=conversation_idf,
+                model=model,
+                max_token=max_token,
+                temperature=temperature,
+                on_delta=lambda delta: __send_socket_message(
+                    ws, type="delta", content=delta
+                ),
+                is_aborted=lambda: not ws.connected,
+            )
+        except CompletionError as e:
+            __send_socket_message(ws, type="error", code=e.error_code, msg=e.msg)
+            continue
+        context = messages + [{"role": "assistant", "content": body["content"]}]
+        __send_socket_message(ws, type="done", **body)
+
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+if Sock is not None:
+    Sock().route("/ws/", bp=ws_bp)(chat_socket)
+
+
 def init_app(app: Flask):
-    ...
+    router.init_app(app=app)
+    httpclient.init_app(app=app)
+    jobs.init_app(app=app)
+    simcache.init_app(app=app)
+    convcache.init_app(app=app)
+    keyprobe.init_app(app=app)
+    idempotency.init_app(app=app)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, current_app
+
+__all__ = ["DNSCache", "UpstreamClient", "get_client", "start_warmup"]
+
+
+class DNSCache(object):
+    """ 上游域名的 DNS 缓存
+    只在上游会话的连接池中使用(见 _cached_dns_adapter)，不影响进程中的其他连接。
+    解析时调用当前的 socket.getaddrinfo，gevent worker 中使用协程版本的解析函数。
+
+    Args:
+        ttl: 解析结果缓存的秒数
+    """
+
+    def __init__(self, ttl: float = 300) -> None:
+        self.ttl = ttl
+        self._entries: typing.Dict[typing.Tuple[str, int],
+                                   typing.Tuple[float, typing.List[str]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> typing.List[str]:
+        """ 返回域名对应的地址，按照 getaddrinfo 的顺序去重
+
+        Raises:
+            socket.gaierror: 解析失败，失败的结果不缓存
+        """
+        key = (host, port)
+        now = time.monotonic()
+        cached = self._entries.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        addresses = list(
+            dict.fromkeys(
+                str(info[4][0])
+                for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            )
+        )
+        with self._lock:
+            self._entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+def _cached_dns_adapter(dns_cache: DNSCache, **kwargs: typing.Any) -> typing.Any:
+    """ 使用 dns_cache 解析域名的 HTTPAdapter
+    连接池的 ConnectionCls 在建立连接之前把 urllib3 的 _dns_host 换成缓存的地址，
+    证书校验与 SNI 仍然使用原来的域名；依次尝试每个地址，全部失败时抛出最后一个异常。
+    """
+    import requests
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    def connection_class(base: typing.Any) -> typing.Any:
+
+        class Connection(base):
+
+            def _new_conn(self) -> socket.socket:
+                host = self._dns_host
+                try:
+                    addresses = dns_cache.resolve(host, self.port)
+                except socket.gaierror:
+                    # 由 urllib3 重新解析并抛出 NameResolutionError
+                    return super()._new_conn()
+                error: typing.Optional[Exception] = None
+                try:
+                    for address in addresses:
+                        self._dns_host = address
+                        try:
+                            return super()._new_conn()
+                        except (ConnectTimeoutError, NewConnectionError) as e:
+                            error = e
+                finally:
+                    self._dns_host = host
+                assert error is not None
+                raise error
+
+        return Connection
+
+    class ConnectionPool(HTTPConnectionPool):
+        ConnectionCls = connection_class(HTTPConnection)
+
+    class SecureConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = connection_class(HTTPSConnection)
+
+    class Adapter(requests.adapters.HTTPAdapter):
+
+        def init_poolmanager(self, *args: typing.Any, **kw: typing.Any) -> None:
+            super().init_poolmanager(*args, **kw)
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": ConnectionPool,
+                "https": SecureConnectionPool,
+            }
+
+    return Adapter(**kwargs)
+
+
+class UpstreamClient(object):
+    """ 进程内共享的上游 HTTP 会话
+    所有 key、所有请求共用一个带 keep-alive 连接池的 requests.Session，
+    openai 默认每个线程(gevent 下每个协程)创建自己的会话，新线程的第一次请求
+    都要重新握手；install_openai 之后 openai 的请求也使用这个会话。
+
+    Args:
+        pool_connections: 缓存连接池的 host 数量
+        pool_maxsize: 每个 host 保持的连接数量
+        connect_timeout: 建立连接的超时秒数，读取的超时由调用方传入
+        max_retries: 建立连接失败时的重试次数
+        dns_cache: 上游域名的 DNS 缓存，为空时每次建立连接都重新解析
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 16,
+        pool_maxsize: int = 64,
+        connect_timeout: float = 3.05,
+        max_retries: int = 2,
+        dns_cache: typing.Optional[DNSCache] = None,
+    ) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.dns_cache = dns_cache
+        self._session: typing.Any = None
+        self._openai_installed = False
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> typing.Any:
+        with self._lock:
+            if self._session is None:
+                import requests
+                session = requests.Session()
+                kwargs = {
+                    "pool_connections": self.pool_connections,
+                    "pool_maxsize": self.pool_maxsize,
+                    "max_retries": self.max_retries,
+                }
+                if self.dns_cache is not None:
+                    adapter = _cached_dns_adapter(self.dns_cache, **kwargs)
+                else:
+                    adapter = requests.adapters.HTTPAdapter(**kwargs)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+
+    def timeout(
+        self, read_timeout: typing.Optional[float]
+    ) -> typing.Union[float, typing.Tuple[float, float], None]:
+        """ requests 使用的 (连接超时, 读取超时)
+        """
+        if not read_timeout:
+            return None
+        return (min(self.connect_timeout, read_timeout), read_timeout)
+
+    def install_openai(self) -> None:
+        """ 让 openai 新建会话时返回共享的会话，第一次请求上游之前调用，不会提前导入 openai
+        替换的是 openai 0.27 的私有函数 api_requestor._make_session，pyproject 中固定了
+        openai 的版本，tests/test_httpclient.py 在这个函数不存在时失败
+        """
+        if self._openai_installed:
+            return
+        import openai
+        from openai import api_requestor
+        session = self.session
+        proxies = api_requestor._requests_proxies_arg(openai.proxy)
+        if proxies:
+            session.proxies = proxies
+        api_requestor._make_session = lambda: session
+        self._openai_installed = True
+
+    def warmup(self, api_bases: typing.List[str], connections: int = 1) -> int:
+        """ 预先解析域名并建立连接，返回建立成功的连接数量
+        """
+
+        def connect(api_base: str) -> bool:
+            try:
+                self.session.head(
+                    api_base, timeout=self.timeout(self.connect_timeout * 2)
+                )
+                return True
+            except Exception as e:
+                print(f"upstream warmup {api_base} failed: {e}")
+                return False
+
+        targets = [b for b in dict.fromkeys(api_bases) for _ in range(connections)]
+        if not targets:
+            return 0
+        with ThreadPoolExecutor(
+            max_workers=min(len(targets), self.pool_maxsize),
+            thread_name_prefix="gpt-upstream-warmup"
+        ) as executor:
+            return sum(executor.map(connect, targets))
+
+
+def get_client() -> UpstreamClient:
+    return current_app.extensions["gpt_http_client"]
+
+
+def init_app(app: Flask) -> None:
+    """ 需要在 router.init_app 之后调用
+    """
+    dns_ttl = app.config["GPT_HTTP_DNS_TTL"]
+    client = UpstreamClient(
+        pool_connections=app.config["GPT_HTTP_POOL_CONNECTIONS"],
+        pool_maxsize=app.config["GPT_HTTP_POOL_MAXSIZE"],
+        connect_timeout=app.config["GPT_UPSTREAM_CONNECT_TIMEOUT"],
+        max_retries=app.config["GPT_HTTP_MAX_RETRIES"],
+        dns_cache=DNSCache(ttl=dns_ttl) if dns_ttl > 0 else None,
+    )
+    app.extensions["gpt_http_client"] = client
+    router = app.extensions["gpt_router"]
+    router.client = client
+
+    api_bases = [
+        upstream.api_base
+        for upstreams in router.routes.values() for upstream in upstreams
+    ]
+    app.extensions["gpt_http_api_bases"] = api_bases
+
+
+def start_warmup(app: Flask) -> None:
+    """ worker 启动后在后台预热上游连接，不阻塞启动，见 gunicorn.conf.py 的 post_worker_init
+    """
+    connections = app.config["GPT_HTTP_WARMUP_CONNECTIONS"]
+    if connections <= 0:
+        return
+    client: UpstreamClient = app.extensions["gpt_http_client"]
+    threading.Thread(
+        target=client.warmup,
+        args=(app.extensions["gpt_http_api_bases"], connections),
+        name="gpt-upstream-warmup",
+        daemon=True,
+    ).start()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import typing
+
+from flask import Flask, current_app
+
+__all__ = ["IdempotencyEntry", "IdempotencyStore", "get_store"]
+
+
+class IdempotencyEntry(object):
+    """ 一个幂等键对应的请求
+    result 为 None 时请求还在处理中，或者原请求失败没有保存结果
+    """
+
+    def __init__(self, key_id: int, fingerprint: str, create_at: int,
+                 result: typing.Optional[typing.Dict[str, typing.Any]] = None) -> None:
+        self.key_id = key_id
+        self.fingerprint = fingerprint
+        self.create_at = create_at
+        self.result = result
+
+
+class IdempotencyStore(object):
+    """ 幂等结果存储，保存在数据库的 idempotency_key 表中，多个 worker 进程共享
+    同一个幂等键的第一个请求负责执行，结果保存 ttl 秒，重试时直接返回保存的结果；
+    原请求还在执行时，重复的请求等待原请求结束，不会再次请求上游。
+    原请求失败时不保存结果，等待的请求会重新执行；原请求所在的进程退出时，
+    lease 秒之后其他请求可以接手。
+    同一进程内的等待通过事件立即唤醒，其他进程的结果每 poll_interval 秒查询一次。
+
+    Args:
+        ttl: 结果保存的秒数
+        lease: 处理中的请求最长占用幂等键的秒数
+        poll_interval: 等待其他进程的结果时查询数据库的间隔秒数
+    """
+
+    def __init__(self, ttl: float = 600, lease: float = 120,
+                 poll_interval: float = 0.2) -> None:
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._events: typing.Dict[int, threading.Event] = {}
+        self._last_purge = time.monotonic()
+        self._lock = threading.Lock()
+
+    def begin(self, user_id: int, key: str,
+              fingerprint: str) -> typing.Tuple[IdempotencyEntry, bool]:
+        """ 获取幂等键对应的请求，不存在或者已经过期时创建
+
+        Return:
+            (请求, 当前请求是否负责执行)
+        """
+        from app.model import IdempotencyKey
+        self._purge()
+        row, is_owner = IdempotencyKey.acquire(
+            user_id, key, fingerprint, int(self.lease * 1000)
+        )
+        entry = IdempotencyEntry(
+            row.key_id,
+            row.fingerprint,
+            row.create_at,
+            json.loads(row.result) if row.result else None,
+        )
+        if is_owner:
+            with self._lock:
+                self._events[entry.key_id] = threading.Event()
+        return entry, is_owner
+
+    def wait(self, entry: IdempotencyEntry, timeout: float) -> bool:
+        """ 等待原请求结束，结束时返回 True，成功的结果保存在 entry.result
+
+        Return:
+            超时返回 False
+        """
+        from app.model import IdempotencyKey
+        deadline = time.monotonic() + timeout
+        while True:
+            state = IdempotencyKey.get_state(entry.key_id)
+            if state is None:
+                return True
+            status, result = state
+            if status == IdempotencyKey.STATUS_SUCCEED:
+                entry.result = json.loads(result) if result else None
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self._lock:
+                event = self._events.get(entry.key_id)
+            wait = min(self.poll_interval, remaining)
+            if event is not None:
+                event.wait(wait)
+            else:
+                time.sleep(wait)
+
+    def finish(self, entry: IdempotencyEntry,
+               result: typing.Dict[str, typing.Any]) -> None:
+        from app.model import IdempotencyKey
+        entry.result = result
+        IdempotencyKey.finish(
+            entry.key_id,
+            entry.create_at,
+            json.dumps(result, ensure_ascii=False),
+            int(self.ttl * 1000),
+        )
+        self._notify(entry)
+
+    def abandon(self, entry: IdempotencyEntry) -> None:
+        """ 请求失败，不保存结果，唤醒等待的请求重新执行
+        """
+        from app.model import IdempotencyKey
+        IdempotencyKey.release(entry.key_id, entry.create_at)
+        self._notify(entry)
+
+    def _notify(self, entry: IdempotencyEntry) -> None:
+        with self._lock:
+            event = self._events.pop(entry.key_id, None)
+        if event is not None:
+            event.set()
+
+    def _purge(self) -> None:
+        """ 每 ttl 秒删除一次过期的结果
+        """
+        from app.model import IdempotencyKey
+        from app.utils import get_unix_time_tuple
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < self.ttl:
+                return
+            self._last_purge = now
+        IdempotencyKey.purge(int(get_unix_time_tuple(millisecond=True)))
+
+
+def get_store() -> IdempotencyStore:
+    return current_app.extensions["gpt_idempotency"]
+
+
+def init_app(app: Flask) -> None:
+    app.extensions["gpt_idempotency"] = IdempotencyStore(
+        ttl=app.config["GPT_IDEMPOTENCY_TTL"],
+        lease=app.config["GPT_IDEMPOTENCY_WAIT"],
+        poll_interval=app.config["GPT_IDEMPOTENCY_POLL_INTERVAL"],
+    )
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, current_app
+
+from app.ext import db
+from app.utils import get_unix_time_tuple
+
+__all__ = ["JobRunner", "get_runner"]
+
+
+class JobRunner(object):
+    """ 后台任务的执行器
+    任务保存在 chat_job 表中，进程内的线程池负责执行；进程第一次使用时会把
+    排队中、以及执行超时（原进程已退出）的任务重新放入线程池，保证重启后任务不会丢失。
+    进程重启时还没有超时的任务，在之后查询任务时由 `resume` 重新提交。
+    同一进程内的长轮询可以通过 `wait` 等待任务状态变化，不必反复查询数据库。
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        self.workers: int = app.config["GPT_JOB_WORKERS"]
+        self.stale_seconds: int = app.config["GPT_JOB_STALE_SECONDS"]
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._events: typing.Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._recovered = False
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="gpt-job"
+                )
+            return self._executor
+
+    def stale_before(self) -> int:
+        now = int(get_unix_time_tuple(millisecond=True))
+        return now - self.stale_seconds * 1000
+
+    def recover(self) -> None:
+        """ 重新提交数据库中未完成的任务，每个进程只执行一次
+        """
+        from app.model import ChatJob
+        with self._lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        for identifier in ChatJob.get_recoverable_jobs(self.stale_before()):
+            print(f"recover job: {identifier}")
+            self.submit(identifier)
+
+    def resume(self, job: typing.Any) -> bool:
+        """ 查询任务时发现任务已经超时(执行它的进程已经退出)，重新提交到当前进程
+        recover 只在进程第一次使用时执行，那时还没有超时的任务由这里接手
+
+        Return:
+            是否重新提交
+        """
+        with self._lock:
+            if job.identifier in self._events:
+                return False
+        if not job.is_recoverable(self.stale_before()):
+            return False
+        print(f"resume stale job: {job.identifier}")
+        self.submit(job.identifier)
+        return True
+
+    def submit(self, identifier: str) -> None:
+        with self._lock:
+            self._events.setdefault(identifier, threading.Event())
+        self.executor.submit(self.run, identifier)
+
+    def wait(self, identifier: str, timeout: float) -> bool:
+        """ 等待任务状态变化，任务不在当前进程执行时直接等待超时
+        Return:
+            任务在当前进程中执行结束时返回 True
+        """
+        with self._lock:
+            event = self._events.get(identifier)
+        if event is None:
+            threading.Event().wait(timeout)
+            return False
+        return event.wait(timeout)
+
+    def run(self, identifier: str) -> None:
+        from app.gpt import complete_chat, CompletionError
+        from app.model import ChatJob, User
+        with self.app.app_context():
+            try:
+                if not ChatJob.claim(identifier, self.stale_before()):
+                    return
+                job = ChatJob.get_job_by_identifier(identifier)
+                user = User.query.filter_by(id=job.user_id).first()
+                params: typing.Dict[str, typing.Any] = json.loads(job.params)
+                try:
+                    body = complete_chat(user=user, **params)
+                    job.finish(result=body)
+                except CompletionError as e:
+                    job.finish(error_code=e.error_code, error=e.msg)
+                db.session.add(job)
+                db.session.commit()
+            except Exception as e:
+                print(f"job {identifier} exception: {e}")
+                db.session.rollback()
+                self._fail(identifier)
+            finally:
+                with self._lock:
+                    event = self._events.pop(identifier, None)
+                if event:
+                    event.set()
+
+    @staticmethod
+    def _fail(identifier: str) -> None:
+        """ 意外的异常也需要结束任务，否则任务一直处于执行中，长轮询等到超时
+        """
+        from app.model import ChatJob
+        try:
+            job = ChatJob.get_job_by_identifier(identifier)
+            if job is None or job.is_finished():
+                return
+            job.finish(error_code=500, error="任务执行失败，请重新提交")
+            db.session.commit()
+        except Exception as e:
+            print(f"job {identifier} mark failed exception: {e}")
+            db.session.rollback()
+
+
+def get_runner() -> JobRunner:
+    return current_app.extensions["gpt_jobs"]
+
+
+def init_app(app: Flask) -> None:
+    app.extensions["gpt_jobs"] = JobRunner(app)
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+from sqlalchemy import bindparam
+
+from app.ext import db
+from app.utils import get_monotonic_millis
+
+__all__ = ["ProbeResult", "probe_key", "KeyProber", "get_prober"]
+
+
+class ProbeResult(typing.NamedTuple):
+    """ 一个 key 的检测结果
+
+    Args:
+        is_live: key 是否可用
+        definitive: 结果是否可以确定 key 的状态，网络错误、上游 5xx 时为 False，不修改 is_live
+        error: 错误信息
+        remaining_requests: 上游返回的剩余请求次数
+        remaining_tokens: 上游返回的剩余 token 数量
+    """
+    is_live: bool
+    definitive: bool
+    error: typing.Optional[str] = None
+    remaining_requests: typing.Optional[int] = None
+    remaining_tokens: typing.Optional[int] = None
+
+
+def _int_header(headers: typing.Mapping[str, str],
+                name: str) -> typing.Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def probe_key(
+    session: typing.Any, api_base: str, api_key: str, timeout: float
+) -> ProbeResult:
+    """ 请求上游的 /models 接口检测 key，这个接口不消耗额度
+    """
+    try:
+        resp = session.get(
+            f"{api_base.rstrip('/')}/models",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout,
+        )
+    except Exception as e:
+        return ProbeResult(is_live=True, definitive=False, error=str(e)[:256])
+    remaining = {
+        "remaining_requests":
+            _int_header(resp.headers, "x-ratelimit-remaining-requests"),
+        "remaining_tokens":
+            _int_header(resp.headers, "x-ratelimit-remaining-tokens"),
+    }
+    if resp.status_code == 200:
+        return ProbeResult(is_live=True, definitive=True, **remaining)
+    try:
+        error = resp.json().get("error") or {}
+    except ValueError:
+        error = {}
+    reason = error.get("code") or error.get("type") or ""
+    message = f"{resp.status_code} {reason} {error.get('message') or ''}"
+    message = " ".join(message.split())[:256]
+    if resp.status_code in (401, 403):
+        return ProbeResult(
+            is_live=False, definitive=True, error=message, **remaining
+        )
+    if resp.status_code == 429:
+        # 额度用完时 key 不可用，只是触发了频率限制时 key 仍然可用
+        quota = "insufficient_quota" in (error.get("code"), error.get("type"))
+        return ProbeResult(
+            is_live=not quota, definitive=True, error=message, **remaining
+        )
+    return ProbeResult(
+        is_live=True, definitive=False, error=message, **remaining
+    )
+
+
+class KeyProber(object):
+    """ 并发检测 key 是否可用
+    使用线程池与共享的 HTTP 连接池并发请求上游，检测结果按批写回 chat_gpt_key：
+    可以确定状态时更新 is_live，同时记录检测时间、错误信息与剩余额度。
+    GPT_KEY_PROBE_INTERVAL 大于 0 时，进程处理第一个请求后启动后台线程定期检测，
+    只检测超过间隔没有检测过的 key，多个进程同时运行时不会重复检测太多。
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self.app = app
+        self.api_base: typing.Optional[str] = app.config["GPT_KEY_PROBE_API_BASE"]
+        self.concurrency: int = app.config["GPT_KEY_PROBE_CONCURRENCY"]
+        self.timeout: float = app.config["GPT_KEY_PROBE_TIMEOUT"]
+        self.interval: int = app.config["GPT_KEY_PROBE_INTERVAL"]
+        self._thread: typing.Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> typing.Any:
+        """ 与上游请求共用 app.httpclient 的连接池
+        """
+        return self.app.extensions["gpt_http_client"].session
+
+    def resolve_api_base(self) -> str:
+        """ 没有单独配置时，使用默认模型的第一个上游
+        """
+        if self.api_base:
+            return self.api_base
+        from app import router
+        with self.app.app_context():
+            model = self.app.config["GPT_MODEL"]
+            return router.get_router().upstreams_for(model)[0].api_base
+
+    def probe(self, contents: typing.List[str]) -> typing.List[ProbeResult]:
+        """ 并发检测一组 key，返回顺序与传入顺序一致
+        """
+        if not contents:
+            return []
+        api_base = self.resolve_api_base()
+        session = self.session
+        workers = min(self.concurrency, len(contents))
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="gpt-key-probe"
+        ) as executor:
+            return list(
+                executor.map(
+                    lambda content: probe_key(
+                        session, api_base, content, self.timeout
+                    ), contents
+                )
+            )
+
+    def save(
+        self, keys: typing.List[typing.Tuple[int, str, bool]],
+        results: typing.List[ProbeResult]
+    ) -> None:
+        """ 一次 executemany 写回一批检测结果
+        """
+        from app.model import ChatGPTKey
+        if not keys:
+            return
+        table = ChatGPTKey.__table__
+        checked_at = get_monotonic_millis()
+        stmt = table.update().where(
+            table.c.chatkey_id == bindparam("b_id")
+        ).values(
+            is_live=bindparam("b_is_live"),
+            last_checked_at=bindparam("b_checked_at"),
+            last_error=bindparam("b_error"),
+            remaining_requests=bindparam("b_remaining_requests"),
+            remaining_tokens=bindparam("b_remaining_tokens"),
+        )
+        db.session.execute(
+            stmt, [
+                {
+                    "b_id": key_id,
+                    "b_is_live":
+                        result.is_live if result.definitive else is_live,
+                    "b_checked_at": checked_at,
+                    "b_error": result.error,
+                    "b_remaining_requests": result.remaining_requests,
+                    "b_remaining_tokens": result.remaining_tokens,
+                } for (key_id, _, is_live), result in zip(keys, results)
+            ]
+        )
+        db.session.commit()
+
+    def probe_stored(self, force: bool = False,
+                     batch_size: int = 1000) -> typing.Dict[str, int]:
+        """ 检测数据库中的 key，需要在 app context 中调用
+
+        Args:
+            force: 为 True 时检测全部 key，否则只检测超过间隔没有检测过的 key
+        Return:
+            检测数量统计 {"checked", "live", "dead", "unknown"}
+        """
+        from app.model import ChatGPTKey
+        checked_before = get_monotonic_millis()
+        if not force:
+            checked_before -= self.interval * 1000
+        stats = {"checked": 0, "live": 0, "dead": 0, "unknown": 0}
+        after_id = 0
+        while True:
+            keys = ChatGPTKey.get_keys_to_probe(
+                checked_before=checked_before,
+                after_id=after_id,
+                limit=batch_size
+            )
+            if not keys:
+                break
+            results = self.probe([content for _, content, _ in keys])
+            self.save(keys, results)
+            for result in results:
+                stats["checked"] += 1
+                if not result.definitive:
+                    stats["unknown"] += 1
+                elif result.is_live:
+                    stats["live"] += 1
+                else:
+                    stats["dead"] += 1
+            after_id = keys[-1][0]
+        return stats
+
+    def import_keys(self, contents: typing.List[str], user_id: int,
+                    only_live: bool = True) -> typing.Dict[str, int]:
+        """ 批量导入 key，导入前并发检测，跳过重复与已经存在的 key
+
+        Args:
+            only_live: 为 True 时只导入检测可用的 key
+        """
+        from app.model import ChatGPTKey
+        unique = list(dict.fromkeys(c.strip() for c in contents if c.strip()))
+        existing = ChatGPTKey.get_existing_contents(unique)
+        candidates = [c for c in unique if c not in existing]
+        results = self.probe(candidates)
+        checked_at = get_monotonic_millis()
+        rows: typing.List[typing.Dict[str, typing.Any]] = []
+        for content, result in zip(candidates, results):
+            if only_live and not result.is_live:
+                continue
+            rows.append(
+                {
+                    "user_id": user_id,
+                    "content": content,
+                    "is_live": result.is_live,
+                    "last_checked_at": checked_at,
+                    "last_error": result.error,
+                    "remaining_requests": result.remaining_requests,
+                    "remaining_tokens": result.remaining_tokens,
+                }
+            )
+        if rows:
+            db.session.execute(ChatGPTKey.__table__.insert(), rows)
+            db.session.commit()
+        return {
+            "imported": len(rows),
+            "duplicated": len(contents) - len(candidates),
+            "rejected": len(candidates) - len(rows),
+        }
+
+    def ensure_started(self) -> None:
+        """ 启动后台检测线程，每个进程只启动一次
+        """
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._loop, name="gpt-key-prober", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            began = time.monotonic()
+            with self.app.app_context():
+                try:
+                    stats = self.probe_stored()
+                    if stats["checked"]:
+                        print(f"key probe: {stats}")
+                except Exception as e:
+                    print(f"key probe exception: {e}")
+                    db.session.rollback()
+            self._stop.wait(max(self.interval - (time.monotonic() - began), 1))
+
+
+def get_prober() -> KeyProber:
+    return current_app.extensions["gpt_key_prober"]
+
+
+def init_app(app: Flask) -> None:
+    prober = KeyProber(app)
+    app.extensions["gpt_key_prober"] = prober
+
+    if not app.config["TESTING"]:
+
+        @app.before_request
+        def start_key_prober():
+            prober.ensure_started()
+
+    keys_cli = AppGroup("keys", help="API key commands.")
+
+    @keys_cli.command("probe")
+    @click.option("--force", is_flag=True, help="Probe every key.")
+    def probe(force: bool):
+        """Probe stored keys and update is_live."""
+        print(f"key probe: {prober.probe_stored(force=force)}")
+
+    @keys_cli.command("import")
+    @click.argument("path", type=click.File("r"))
+    @click.option("--user-id", type=int, help="Owner, defaults to the admin.")
+    @click.option(
+        "--all", "import_all", is_flag=True, help="Also import dead keys."
+    )
+    def import_keys(path: typing.TextIO, user_id: typing.Optional[int],
+                    import_all: bool):
+        """Validate keys (one per line) in parallel and import them."""
+        from app.model import User
+        if user_id is None:
+            admin = db.session.query(User.id).filter_by(
+                identifier=app.config["ADMIN_USER_IDENTIFIER"]
+            ).first()
+            if not admin:
+                print("admin user not found, use --user-id")
+                return
+            user_id = admin[0]
+        stats = prober.import_keys(
+            path.read().splitlines(), user_id=user_id, only_live=not import_all
+        )
+        print(f"key import: {stats}")
+
+    app.cli.add_command(keys_cli)
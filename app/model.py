@@ -2,16 +2,20 @@
 import typing
 import datetime
 from flask import Request
-from sqlalchemy import Column, Sequence
+from sqlalchemy import Column, Sequence, bindparam, func, or_
 from sqlalchemy import SMALLINT
+from sqlalchemy.exc import IntegrityError
 from flask_login import UserMixin
 from app.ext import db, login_manager
-from app.utils import get_unix_time_tuple
+from app.utils import get_unix_time_tuple, generate_id, get_monotonic_millis
+from app.utils import get_min_id_at
 from uuid import uuid4
 
 
 class User(db.Model, UserMixin):
     __tablename__ = "user"
+    # 每个请求都按照 token 查询用户
+    __table_args__ = (db.Index("ix_user_token", "token"), )
 
     id = Column(
         db.Integer,
@@ -27,7 +31,14 @@ class User(db.Model, UserMixin):
     email = Column(db.String(64), nullable=False, unique=True)
     password = Column(db.String(64), nullable=True)
     token = Column(db.String(64), nullable=True)
-    create_at = Column(db.Integer, nullable=False, comment="创建时间")
+    create_at = Column(db.BigInteger, nullable=False, comment="创建时间")
+    sid = Column(
+        db.BigInteger,
+        nullable=False,
+        unique=True,
+        default=generate_id,
+        comment="可排序的唯一ID"
+    )
 
     def __init__(
         self,
@@ -88,6 +99,12 @@ class Conversation(db.Model):
 
     """
     __tablename__ = "conversation"
+    __table_args__ = (
+        db.Index("ix_conversation_user_id_sid", "user_id", "sid"),
+        db.Index("ix_conversation_user_id_last_sid", "user_id", "last_sid"),
+    )
+    # 最后一条消息预览的长度
+    PREVIEW_LENGTH = 64
 
     cov_id = Column(
         db.Integer,
@@ -104,7 +121,22 @@ class Conversation(db.Model):
     chats = db.relationship(
         "ChatRecord", backref="chat_record.conversation", lazy="dynamic"
     )
-    create_at = Column(db.Integer, nullable=False, comment="创建时间")
+    create_at = Column(db.BigInteger, nullable=False, comment="创建时间")
+    sid = Column(
+        db.BigInteger,
+        nullable=False,
+        unique=True,
+        default=generate_id,
+        comment="可排序的唯一ID"
+    )
+    message_count = Column(
+        db.Integer, nullable=False, default=0, server_default="0", comment="消息数量"
+    )
+    last_message = Column(db.String(128), nullable=True, comment="最后一条消息的预览")
+    last_active_at = Column(db.BigInteger, nullable=False, comment="最后活跃时间")
+    last_sid = Column(
+        db.BigInteger, nullable=False, comment="最后活跃时生成的可排序ID，用于按活跃时间分页"
+    )
 
     def __init__(
         self, user: User, identifier: typing.Optional[str] = None
@@ -112,6 +144,10 @@ class Conversation(db.Model):
         self.user_id = user.id
         self.identifier = identifier or uuid4().hex
         self.create_at = get_unix_time_tuple(millisecond=True)
+        self.message_count = 0
+        self.last_active_at = self.create_at
+        self.sid = generate_id()
+        self.last_sid = self.sid
 
     @staticmethod
     def get_conversation_by_identifier(
@@ -123,11 +159,124 @@ class Conversation(db.Model):
                                      ).first()
         return conversation
 
+    @staticmethod
+    def add_messages(
+        messages: typing.List[typing.Tuple[int, int, str]]
+    ) -> None:
+        """ 写入聊天记录时更新会话的消息数量、最后活跃时间与最后一条消息预览
+        与聊天记录在同一个事务中提交，消息数量以增量方式更新，并发写入不会丢失计数
+
+        Args:
+            messages: [(cov_id, 新增的消息数量, 最后一条消息)]
+        """
+        if not messages:
+            return
+        table = Conversation.__table__
+        stmt = table.update().where(
+            table.c.cov_id == bindparam("b_cov_id")
+        ).values(
+            message_count=table.c.message_count + bindparam("b_count"),
+            last_message=bindparam("b_last_message"),
+            last_active_at=bindparam("b_last_active_at"),
+            last_sid=bindparam("b_last_sid"),
+        )
+        db.session.execute(
+            stmt, [
+                {
+                    "b_cov_id": cov_id,
+                    "b_count": count,
+                    "b_last_message": content[:Conversation.PREVIEW_LENGTH],
+                    "b_last_active_at": get_monotonic_millis(),
+                    "b_last_sid": generate_id(),
+                } for cov_id, count, content in messages
+            ]
+        )
+
+    @staticmethod
+    def get_last_sid_of_user(user_id: int) -> int:
+        """ 用户所有会话中最大的 last_sid，写入聊天记录时会更新，可以作为聊天记录的版本
+        只读取 (user_id, last_sid) 索引的一端，不加载任何记录
+        """
+        last_sid: typing.Optional[int] = db.session.query(
+            func.max(Conversation.last_sid)
+        ).filter(Conversation.user_id == user_id).scalar()
+        return last_sid or 0
+
+    @staticmethod
+    def get_conversations_by_user(
+        user_id: int,
+        limit: int,
+        before: typing.Optional[int] = None,
+    ) -> typing.List["Conversation"]:
+        """ 按照最后活跃时间从新到旧分页获取用户的会话
+
+        Args:
+            before: 上一页最后一个会话的 last_sid
+        """
+        query = Conversation.query.filter_by(user_id=user_id)
+        if before:
+            query = query.filter(Conversation.last_sid < before)
+        conversations: typing.List[Conversation] = query.order_by(
+            Conversation.last_sid.desc()
+        ).limit(limit).all()
+        return conversations
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "conversation": self.identifier,
+            "message_count": self.message_count,
+            "last_message": self.last_message,
+            "last_active_at": self.last_active_at,
+            "last_sid": str(self.last_sid),
+            "create_at": self.create_at,
+        }
+
+    @staticmethod
+    def get_owner_by_identifier(
+        identifier: str
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """ 只查询会话的 (cov_id, user_id)
+        """
+        row = db.session.query(Conversation.cov_id, Conversation.user_id
+                              ).filter_by(identifier=identifier).first()
+        return (row.cov_id, row.user_id) if row else None
+
+    @staticmethod
+    def create_or_get(
+        user: User, identifier: typing.Optional[str] = None
+    ) -> typing.Tuple[int, int, str]:
+        """ 创建会话并立即提交，同一个标识符被并发创建时返回先创建的会话
+
+        Return:
+            (cov_id, user_id, identifier)
+        """
+        conversation = Conversation(user=user, identifier=identifier)
+        identifier = conversation.identifier
+        db.session.add(conversation)
+        try:
+            db.session.flush()
+            cov_id, user_id = conversation.cov_id, conversation.user_id
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            owner = Conversation.get_owner_by_identifier(identifier)
+            if owner is None:
+                raise
+            cov_id, user_id = owner
+        return cov_id, user_id, identifier
+
 
 class ChatRecord(db.Model):
     """ 聊天记录
     """
     __tablename__ = "chat_record"
+    __table_args__ = (
+        db.Index("ix_chat_record_user_id_sid", "user_id", "sid"),
+        db.Index("ix_chat_record_conversation_sid", "conversation", "sid"),
+    )
+
+    STATUS_OK = 0
+    STATUS_ABORTED = 1
 
     chat_id = Column(
         db.Integer,
@@ -140,41 +289,88 @@ class ChatRecord(db.Model):
     )
     content = Column(db.Text, nullable=False, comment="聊天内容")
     role = Column(SMALLINT, nullable=False, comment="角色，0表示用户，1表示机器人")
-    create_at = Column(db.Integer, nullable=False, comment="创建时间")
+    create_at = Column(db.BigInteger, nullable=False, comment="创建时间")
+    sid = Column(
+        db.BigInteger,
+        nullable=False,
+        unique=True,
+        default=generate_id,
+        comment="可排序的唯一ID"
+    )
+    model = Column(db.String(64), nullable=True, comment="这一轮使用的模型")
+    tokens = Column(db.Integer, nullable=True, comment="这一轮消耗的 token 数量，记录在回答上")
+    status = Column(
+        SMALLINT,
+        nullable=False,
+        default=0,
+        server_default="0",
+        comment="状态，0正常，1客户端断开后中止(只记录在问题上)"
+    )
 
     def __init__(
         self,
         user: User,
         content: str,
-        conversation: Conversation,
+        conversation: typing.Union[Conversation, int],
         response_chat: typing.
-        Optional['ChatRecord'] = None    # 没有这个参数表示用户发起的聊天，有这个参数表示机器人回复的聊天
+        Optional['ChatRecord'] = None,    # 没有这个参数表示用户发起的聊天，有这个参数表示机器人回复的聊天
+        model: typing.Optional[str] = None,
+        tokens: typing.Optional[int] = None,
     ) -> None:
+        self.model = model
+        self.tokens = tokens
         self.user_id = user.id
         self.content = content
-        self.conversation = conversation.cov_id
+        self.conversation = conversation if isinstance(
+            conversation, int
+        ) else conversation.cov_id
         self.create_at = get_unix_time_tuple(millisecond=True)
         self.role = 0 if response_chat else 1
+        self.status = ChatRecord.STATUS_OK
+
+    @staticmethod
+    def get_conversation_history(cov_id: int,
+                                 limit: int) -> typing.List['ChatRecord']:
+        """ 会话最近的 limit 条聊天记录，按时间先后排列，走 (conversation, sid) 索引
+        """
+        records: typing.List[ChatRecord] = ChatRecord.query.filter_by(
+            conversation=cov_id
+        ).order_by(ChatRecord.sid.desc()).limit(limit).all()
+        records.reverse()
+        return records
 
     @staticmethod
     def get_records_by_user_before_time(
-        user_id: int, page: int, limit: int
+        user_id: int,
+        page: int,
+        limit: int,
+        before: typing.Optional[int] = None,
     ) -> typing.List['ChatRecord']:
-        records: typing.List[ChatRecord] = ChatRecord.query.filter_by(
-            user_id=user_id
-        ).order_by(ChatRecord.create_at.desc()).offset(page * limit
-                                                      ).limit(limit).all()
+        """ 从新到旧分页获取用户的聊天记录
+
+        Args:
+            before: 上一页最早一条记录的 sid，传入时按 sid 翻页，忽略 page
+        """
+        query = ChatRecord.query.filter_by(user_id=user_id
+                                          ).order_by(ChatRecord.sid.desc())
+        if before:
+            query = query.filter(ChatRecord.sid < before)
+        else:
+            query = query.offset(page * limit)
+        records: typing.List[ChatRecord] = query.limit(limit).all()
         return records
 
     @staticmethod
     def get_user_records_in_time(user_id: int, start_time: int,
                                  end_time: int) -> typing.List['ChatRecord']:
+        """ 获取时间范围内的全部聊天记录，按天统计用量请使用 UsageRollup
+        """
         records: typing.List[ChatRecord] = ChatRecord.query.filter_by(
             user_id=user_id
         ).filter(
             ChatRecord.create_at >= start_time,
             ChatRecord.create_at <= end_time
-        ).order_by(ChatRecord.create_at.desc()).all()
+        ).order_by(ChatRecord.create_at.desc(), ChatRecord.sid.desc()).all()
         return records
 
     def to_json(self) -> typing.Dict[str, typing.Any]:
@@ -182,15 +378,186 @@ class ChatRecord(db.Model):
         """
         payload: typing.Dict[str, typing.Any] = {
             "chat_id": self.chat_id,
+            "sid": str(self.sid),
             "conversation": self.conversation,
             "content": self.content,
             "create_at": self.create_at,
             "role": self.role,
+            "status": self.status,
         }
         return payload
 
+    @staticmethod
+    def mark_aborted(chat_id: int) -> None:
+        """ 标记一轮对话在客户端断开后中止，不需要先加载记录
+        """
+        db.session.execute(
+            ChatRecord.__table__.update().where(
+                ChatRecord.__table__.c.chat_id == chat_id
+            ).values(status=ChatRecord.STATUS_ABORTED)
+        )
+
+class UsageRollup(db.Model):
+    """ 按用户、天、模型预先汇总的用量
+    写入聊天记录时以增量方式更新；`rebuild` 可以从聊天记录重新计算一段时间的汇总，
+    用于补齐历史数据或修复。天数为本地时区(USAGE_UTC_OFFSET_HOURS)下从 1970-01-01 开始的天数。
+    """
+    __tablename__ = "usage_rollup"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "user_id", "day", "model", name="uq_usage_rollup_user_id_day_model"
+        ),
+    )
+
+    DAY_MILLIS = 86400 * 1000
+
+    rollup_id = Column(
+        db.Integer,
+        Sequence("rollup_id_seq", start=1, increment=1),
+        primary_key=True
+    )
+    user_id = Column(db.Integer, nullable=False, comment="用户")
+    day = Column(db.Integer, nullable=False, comment="从 1970-01-01 开始的天数")
+    model = Column(db.String(64), nullable=False, comment="模型，历史记录为空字符串")
+    message_count = Column(db.Integer, nullable=False, comment="消息数量")
+    prompt_chars = Column(db.BigInteger, nullable=False, comment="提问的字符数")
+    completion_chars = Column(db.BigInteger, nullable=False, comment="回答的字符数")
+    tokens = Column(db.BigInteger, nullable=False, comment="token 数量")
+
+    @staticmethod
+    def day_of(millis: int, utc_offset_hours: int) -> int:
+        return (int(millis) + utc_offset_hours * 3600 * 1000
+               ) // UsageRollup.DAY_MILLIS
+
+    @staticmethod
+    def day_start_millis(day: int, utc_offset_hours: int) -> int:
+        return day * UsageRollup.DAY_MILLIS - utc_offset_hours * 3600 * 1000
+
+    @staticmethod
+    def add(
+        user_id: int,
+        day: int,
+        model: str,
+        message_count: int,
+        prompt_chars: int,
+        completion_chars: int,
+        tokens: int,
+    ) -> None:
+        """ 累加一条汇总，与聊天记录在同一个事务中提交
+        先按增量更新，没有这一行时插入；并发插入冲突时回滚到保存点再更新
+        """
+        table = UsageRollup.__table__
+        key = (table.c.user_id == user_id) & (table.c.day == day) & (
+            table.c.model == model
+        )
+        increments = {
+            "message_count": table.c.message_count + message_count,
+            "prompt_chars": table.c.prompt_chars + prompt_chars,
+            "completion_chars": table.c.completion_chars + completion_chars,
+            "tokens": table.c.tokens + tokens,
+        }
+        if db.session.execute(table.update().where(key).values(increments)
+                             ).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(
+                    table.insert().values(
+                        user_id=user_id,
+                        day=day,
+                        model=model,
+                        message_count=message_count,
+                        prompt_chars=prompt_chars,
+                        completion_chars=completion_chars,
+                        tokens=tokens,
+                    )
+                )
+        except IntegrityError:
+            db.session.execute(table.update().where(key).values(increments))
+
+    @staticmethod
+    def rebuild(start_day: int, end_day: int, utc_offset_hours: int) -> int:
+        """ 从聊天记录重新计算 [start_day, end_day) 的汇总，时间范围转换为 sid 范围走索引
+
+        Return:
+            写入的汇总行数
+        """
+        from sqlalchemy import Integer, case, cast, func, select
+        table = UsageRollup.__table__
+        records = ChatRecord.__table__
+        offset = utc_offset_hours * 3600 * 1000
+        local = records.c.create_at + offset
+        day = cast(
+            (local - local % UsageRollup.DAY_MILLIS) / UsageRollup.DAY_MILLIS,
+            Integer
+        )
+        model = func.coalesce(records.c.model, "")
+        length = func.length(records.c.content)
+        aggregated = select(
+            records.c.user_id,
+            day.label("day"),
+            model.label("model"),
+            func.count().label("message_count"),
+            func.sum(case((records.c.role == 1, length), else_=0)),
+            func.sum(case((records.c.role == 0, length), else_=0)),
+            func.sum(func.coalesce(records.c.tokens, 0)),
+        ).where(
+            records.c.sid >= get_min_id_at(
+                UsageRollup.day_start_millis(start_day, utc_offset_hours)
+            ),
+            records.c.sid < get_min_id_at(
+                UsageRollup.day_start_millis(end_day, utc_offset_hours)
+            ),
+        ).group_by(records.c.user_id, day, model)
+
+        db.session.execute(
+            table.delete().where(table.c.day >= start_day, table.c.day < end_day)
+        )
+        result = db.session.execute(
+            table.insert().from_select(
+                [
+                    "user_id", "day", "model", "message_count", "prompt_chars",
+                    "completion_chars", "tokens"
+                ], aggregated
+            )
+        )
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def get_user_usage(user_id: int, start_day: int,
+                       end_day: int) -> typing.List["UsageRollup"]:
+        """ 获取 [start_day, end_day) 的汇总，走 (user_id, day, model) 唯一索引
+        """
+        rollups: typing.List[UsageRollup] = UsageRollup.query.filter(
+            UsageRollup.user_id == user_id,
+            UsageRollup.day >= start_day,
+            UsageRollup.day < end_day,
+        ).order_by(UsageRollup.day, UsageRollup.model).all()
+        return rollups
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "day": (datetime.date(1970, 1, 1) +
+                    datetime.timedelta(days=self.day)).isoformat(),
+            "model": self.model,
+            "message_count": self.message_count,
+            "prompt_chars": self.prompt_chars,
+            "completion_chars": self.completion_chars,
+            "tokens": self.tokens,
+        }
+
+
 class ChatAuth(db.Model):
     __tablename__ = "chat_auth"
+    __table_args__ = (
+        db.Index("ix_chat_auth_user_idf", "user_idf", unique=True),
+    )
+
+    GRANT_CREATED = "created"
+    GRANT_UPDATED = "updated"
+    GRANT_UNKNOWN_USER = "unknown_user"
+    GRANT_DUPLICATE = "duplicate"
     
     auth_id = Column(
         db.Integer,
@@ -198,8 +565,18 @@ class ChatAuth(db.Model):
         primary_key=True
     )
     user_idf = Column(db.String(32), nullable=False, comment="用户标识符")
-    began_at = Column(db.Integer, nullable=False, comment="开始时间")
-    end_at = Column(db.Integer, nullable=False, comment="结束时间")
+    began_at = Column(db.BigInteger, nullable=False, comment="开始时间")
+    end_at = Column(db.BigInteger, nullable=False, comment="结束时间")
+    tier = Column(
+        db.String(32), nullable=True, comment="限流档位，为空时使用默认限制"
+    )
+    sid = Column(
+        db.BigInteger,
+        nullable=False,
+        unique=True,
+        default=generate_id,
+        comment="可排序的唯一ID"
+    )
     
     @staticmethod
     def auth_by_endtime(user_idf: str, endtime: typing.Union[datetime.datetime, int]) -> "ChatAuth":
@@ -220,6 +597,93 @@ class ChatAuth(db.Model):
             db.session.commit()
         return auth
     
+    @staticmethod
+    def grant_many(
+        grants: typing.List[typing.Tuple[str, int]],
+        chunk_size: int = 500,
+    ) -> typing.List[str]:
+        """ 批量授权，与 auth_by_endtime 一致：已有授权只修改结束时间，没有时新建，
+        不存在的用户标识符不授权
+        每个分块查询一次用户与已有授权，更新与插入各执行一条批量语句，提交一次；
+        并发创建同一个用户的授权时插入冲突，回滚到保存点后改为更新
+
+        Args:
+            grants: [(用户标识符, 结束时间毫秒)]，同一个用户出现多次时以最后一次为准
+
+        Return:
+            与 grants 一一对应的结果，GRANT_* 之一
+        """
+        table = ChatAuth.__table__
+        outcomes: typing.List[str] = [""] * len(grants)
+        last: typing.Dict[str, int] = {}
+        for i, (user_idf, _) in enumerate(grants):
+            if user_idf in last:
+                outcomes[last[user_idf]] = ChatAuth.GRANT_DUPLICATE
+            last[user_idf] = i
+        indexes = sorted(last.values())
+        update = table.update().where(
+            table.c.user_idf == bindparam("b_user_idf")
+        ).values(end_at=bindparam("b_end_at"))
+
+        def existing_of(user_idfs: typing.List[str]) -> typing.Set[str]:
+            return {
+                row[0] for row in db.session.query(ChatAuth.user_idf).filter(
+                    ChatAuth.user_idf.in_(user_idfs)
+                )
+            }
+
+        def insert_rows(rows: typing.List[int], now: int) -> None:
+            db.session.execute(
+                table.insert(), [
+                    {
+                        "user_idf": grants[i][0],
+                        "began_at": now,
+                        "end_at": grants[i][1],
+                    } for i in rows
+                ]
+            )
+
+        for start in range(0, len(indexes), chunk_size):
+            chunk = indexes[start:start + chunk_size]
+            users = {
+                row[0] for row in db.session.query(User.identifier).filter(
+                    User.identifier.in_([grants[i][0] for i in chunk])
+                )
+            }
+            for i in chunk:
+                if grants[i][0] not in users:
+                    outcomes[i] = ChatAuth.GRANT_UNKNOWN_USER
+            chunk = [i for i in chunk if grants[i][0] in users]
+            existing = existing_of([grants[i][0] for i in chunk])
+            now = int(get_unix_time_tuple(millisecond=True))
+            updates = [i for i in chunk if grants[i][0] in existing]
+            inserts = [i for i in chunk if grants[i][0] not in existing]
+            if inserts:
+                try:
+                    with db.session.begin_nested():
+                        insert_rows(inserts, now)
+                except IntegrityError:
+                    created = existing_of([grants[i][0] for i in inserts])
+                    updates.extend(i for i in inserts if grants[i][0] in created)
+                    inserts = [i for i in inserts if grants[i][0] not in created]
+                    if inserts:
+                        insert_rows(inserts, now)
+            if updates:
+                db.session.execute(
+                    update, [
+                        {
+                            "b_user_idf": grants[i][0],
+                            "b_end_at": grants[i][1]
+                        } for i in updates
+                    ]
+                )
+            for i in updates:
+                outcomes[i] = ChatAuth.GRANT_UPDATED
+            for i in inserts:
+                outcomes[i] = ChatAuth.GRANT_CREATED
+            db.session.commit()
+        return outcomes
+
     @staticmethod
     def get_auth_by_user_idf(user_idf: str) -> typing.Optional["ChatAuth"]:
         return ChatAuth.query.filter_by(user_idf=user_idf).first()
@@ -255,6 +719,11 @@ class ChatGPTKey(db.Model):
 
     occupy_uid = Column(db.Integer, nullable=True, comment="占用者")
 
+    last_checked_at = Column(db.BigInteger, nullable=True, comment="最后检测时间")
+    last_error = Column(db.String(256), nullable=True, comment="最后一次检测的错误信息")
+    remaining_requests = Column(db.Integer, nullable=True, comment="剩余请求次数")
+    remaining_tokens = Column(db.Integer, nullable=True, comment="剩余 token 数量")
+
     def __init__(
         self,
         user_id: int,
@@ -268,15 +737,66 @@ class ChatGPTKey(db.Model):
         self.occupy_uid = occupy_uid
 
     @staticmethod
-    def get_avaliable_key() -> typing.Optional['ChatGPTKey']:
+    def get_keys_to_probe(
+        checked_before: int,
+        after_id: int = 0,
+        limit: int = 1000,
+    ) -> typing.List[typing.Tuple[int, str, bool]]:
+        """ 按主键分批获取需要检测的 key，从未检测过的 key 也需要检测
+
+        Return:
+            [(chatkey_id, content, is_live)]
+        """
+        rows = db.session.query(
+            ChatGPTKey.chatkey_id, ChatGPTKey.content, ChatGPTKey.is_live
+        ).filter(
+            ChatGPTKey.chatkey_id > after_id,
+            or_(
+                ChatGPTKey.last_checked_at.is_(None),
+                ChatGPTKey.last_checked_at < checked_before,
+            )
+        ).order_by(ChatGPTKey.chatkey_id).limit(limit).all()
+        return [(row[0], row[1], row[2]) for row in rows]
+
+    @staticmethod
+    def get_existing_contents(contents: typing.List[str]) -> typing.Set[str]:
+        """ 返回已经存在的 key
+        """
+        existing: typing.Set[str] = set()
+        for i in range(0, len(contents), 500):
+            existing.update(
+                row[0] for row in db.session.query(ChatGPTKey.content).filter(
+                    ChatGPTKey.content.in_(contents[i:i + 500])
+                )
+            )
+        return existing
+
+    @staticmethod
+    def get_avaliable_key(
+        exclude: typing.Collection[str] = ()
+    ) -> typing.Optional['ChatGPTKey']:
         '''
-        获取可用的key
+        获取可用的key，跳过 exclude 中的 key(例如被熔断的 key)
         '''
-        k: typing.Optional[ChatGPTKey] = ChatGPTKey.query.filter_by(
-            is_live=True, occupy_uid=None
-        ).first()
+        query = ChatGPTKey.query.filter_by(is_live=True, occupy_uid=None)
+        if exclude:
+            query = query.filter(ChatGPTKey.content.notin_(list(exclude)))
+        k: typing.Optional[ChatGPTKey] = query.first()
         return k
 
+    @staticmethod
+    def get_avaliable_keys(
+        limit: int, exclude: typing.Collection[str] = ()
+    ) -> typing.List['ChatGPTKey']:
+        '''
+        获取多个可用的key，跳过 exclude 中的 key
+        '''
+        query = ChatGPTKey.query.filter_by(is_live=True, occupy_uid=None)
+        if exclude:
+            query = query.filter(ChatGPTKey.content.notin_(list(exclude)))
+        keys: typing.List[ChatGPTKey] = query.limit(limit).all()
+        return keys
+
     @staticmethod
     def get_user_key_if_could(user: User) -> typing.Optional['ChatGPTKey']:
         '''
@@ -295,3 +815,278 @@ class ChatGPTKey(db.Model):
             user_id=user.id, app_key="test_key", is_live=True, occupy_uid=None
         )
         return k
+
+
+class ChatJob(db.Model):
+    """ 后台询问任务
+    """
+    __tablename__ = "chat_job"
+    __table_args__ = (
+        db.Index("ix_chat_job_status_update_at", "status", "update_at"),
+    )
+
+    STATUS_PENDING = 0
+    STATUS_RUNNING = 1
+    STATUS_SUCCEED = 2
+    STATUS_FAILED = 3
+
+    STATUS_NAMES = {
+        STATUS_PENDING: "pending",
+        STATUS_RUNNING: "running",
+        STATUS_SUCCEED: "succeed",
+        STATUS_FAILED: "failed",
+    }
+
+    job_id = Column(
+        db.Integer,
+        Sequence("job_id_seq", start=1, increment=1),
+        primary_key=True
+    )
+    identifier = Column(
+        db.String(32), nullable=False, unique=True, comment="任务的标识符"
+    )
+    user_id = Column(db.Integer, nullable=False, comment="用户")
+    params = Column(db.Text, nullable=False, comment="询问参数，json格式")
+    status = Column(
+        SMALLINT, nullable=False, comment="状态，0排队中，1执行中，2成功，3失败"
+    )
+    result = Column(db.Text, nullable=True, comment="执行结果，json格式")
+    error_code = Column(db.Integer, nullable=True, comment="错误码")
+    error = Column(db.String(256), nullable=True, comment="错误信息")
+    create_at = Column(db.BigInteger, nullable=False, comment="创建时间")
+    update_at = Column(db.BigInteger, nullable=False, comment="更新时间")
+
+    def __init__(self, user: User, params: typing.Dict[str, typing.Any]) -> None:
+        import json
+        self.identifier = uuid4().hex
+        self.user_id = user.id
+        self.params = json.dumps(params, ensure_ascii=False)
+        self.status = ChatJob.STATUS_PENDING
+        self.create_at = get_unix_time_tuple(millisecond=True)
+        self.update_at = self.create_at
+
+    @staticmethod
+    def get_job_by_identifier(identifier: str) -> typing.Optional["ChatJob"]:
+        return ChatJob.query.filter_by(identifier=identifier).first()
+
+    @staticmethod
+    def get_recoverable_jobs(stale_before: int) -> typing.List[str]:
+        """ 获取需要重新执行的任务
+        排队中的任务，以及更新时间早于 `stale_before` 的执行中任务（执行它的进程已经退出）
+        """
+        rows = db.session.query(ChatJob.identifier).filter(
+            or_(
+                ChatJob.status == ChatJob.STATUS_PENDING,
+                db.and_(
+                    ChatJob.status == ChatJob.STATUS_RUNNING,
+                    ChatJob.update_at < stale_before
+                )
+            )
+        ).all()
+        return [row.identifier for row in rows]
+
+    def is_recoverable(self, stale_before: int) -> bool:
+        """ 与 get_recoverable_jobs 的条件一致，排队中的任务也需要超过 stale_before 才算，
+        避免抢走其他进程刚提交、还在线程池中排队的任务
+        """
+        return self.status in (
+            ChatJob.STATUS_PENDING, ChatJob.STATUS_RUNNING
+        ) and self.update_at < stale_before
+
+    @staticmethod
+    def claim(identifier: str, stale_before: int) -> bool:
+        """ 抢占一个任务，多个进程同时抢占时只有一个会成功
+        """
+        now = int(get_unix_time_tuple(millisecond=True))
+        result = db.session.execute(
+            db.update(ChatJob).where(
+                ChatJob.identifier == identifier,
+                or_(
+                    ChatJob.status == ChatJob.STATUS_PENDING,
+                    db.and_(
+                        ChatJob.status == ChatJob.STATUS_RUNNING,
+                        ChatJob.update_at < stale_before
+                    )
+                )
+            ).values(status=ChatJob.STATUS_RUNNING, update_at=now)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def finish(
+        self,
+        result: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        error_code: typing.Optional[int] = None,
+        error: typing.Optional[str] = None,
+    ) -> None:
+        import json
+        if error_code:
+            self.status = ChatJob.STATUS_FAILED
+            self.error_code = error_code
+            self.error = error
+        else:
+            self.status = ChatJob.STATUS_SUCCEED
+            self.result = json.dumps(result, ensure_ascii=False)
+        self.update_at = get_unix_time_tuple(millisecond=True)
+
+    def is_finished(self) -> bool:
+        return self.status in (ChatJob.STATUS_SUCCEED, ChatJob.STATUS_FAILED)
+
+    def etag(self) -> str:
+        return f"{self.identifier}-{self.status}-{self.update_at}"
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        import json
+        payload: typing.Dict[str, typing.Any] = {
+            "job": self.identifier,
+            "status": ChatJob.STATUS_NAMES[self.status],
+            "result": json.loads(self.result) if self.result else None,
+            "error_code": self.error_code,
+            "error": self.error,
+            "create_at": self.create_at,
+            "update_at": self.update_at,
+        }
+        return payload
+
+
+class IdempotencyKey(db.Model):
+    """ Idempotency-Key 对应的请求与结果，保存在数据库中，多个进程共享
+    同一个用户的同一个 key 只有一行：处理中的行 expire_at 为租约的到期时间，
+    执行它的进程退出后租约过期，其他请求可以接手；成功的行保存结果到 expire_at 为止。
+    """
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "user_id", "key", name="uq_idempotency_key_user_id_key"
+        ),
+        db.Index("ix_idempotency_key_expire_at", "expire_at"),
+    )
+
+    STATUS_PENDING = 0
+    STATUS_SUCCEED = 1
+
+    key_id = Column(
+        db.Integer,
+        Sequence("idempotency_key_id_seq", start=1, increment=1),
+        primary_key=True
+    )
+    user_id = Column(db.Integer, nullable=False, comment="用户")
+    key = Column(db.String(255), nullable=False, comment="Idempotency-Key")
+    fingerprint = Column(db.String(64), nullable=False, comment="请求参数的摘要")
+    status = Column(SMALLINT, nullable=False, comment="状态，0处理中，1成功")
+    result = Column(db.Text, nullable=True, comment="返回的报文内容，json格式")
+    create_at = Column(db.BigInteger, nullable=False, comment="开始处理的时间")
+    expire_at = Column(
+        db.BigInteger, nullable=False, comment="租约或者结果的过期时间"
+    )
+
+    @staticmethod
+    def acquire(
+        user_id: int, key: str, fingerprint: str, lease_ms: int
+    ) -> typing.Tuple['IdempotencyKey', bool]:
+        """ 获取 key 对应的行，不存在或者已经过期时由当前请求负责执行
+
+        Return:
+            (行, 当前请求是否负责执行)
+        """
+        table = IdempotencyKey.__table__
+        while True:
+            now = int(get_unix_time_tuple(millisecond=True))
+            pending = {
+                "fingerprint": fingerprint,
+                "status": IdempotencyKey.STATUS_PENDING,
+                "result": None,
+                "create_at": now,
+                "expire_at": now + lease_ms,
+            }
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(
+                        table.insert().values(user_id=user_id, key=key, **pending)
+                    )
+                db.session.commit()
+                return IdempotencyKey.get(user_id, key), True
+            except IntegrityError:
+                pass
+            row = IdempotencyKey.get(user_id, key)
+            if row is None:
+                # 插入之后被原请求删除，重新插入
+                continue
+            if row.expire_at >= now:
+                db.session.commit()
+                return row, False
+            # 结果过期，或者执行它的进程已经退出，按照原来的 expire_at 条件更新，只有一个请求能接手
+            claimed = db.session.execute(
+                table.update().where(
+                    table.c.key_id == row.key_id,
+                    table.c.expire_at == row.expire_at,
+                ).values(**pending)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return IdempotencyKey.get(user_id, key), True
+
+    @staticmethod
+    def get(user_id: int, key: str) -> typing.Optional['IdempotencyKey']:
+        return IdempotencyKey.query.filter_by(user_id=user_id, key=key
+                                             ).populate_existing().first()
+
+    @staticmethod
+    def get_state(key_id: int) -> typing.Optional[typing.Tuple[int, typing.Optional[str]]]:
+        """ 等待时查询 (状态, 结果)，行已经被删除时返回 None
+        每次查询之后结束事务，下一次查询可以看到其他进程提交的结果
+        """
+        table = IdempotencyKey.__table__
+        row = db.session.execute(
+            db.select(table.c.status, table.c.result).where(
+                table.c.key_id == key_id
+            )
+        ).first()
+        db.session.commit()
+        return (row.status, row.result) if row is not None else None
+
+    @staticmethod
+    def finish(key_id: int, create_at: int, result: str, ttl_ms: int) -> None:
+        """ 保存结果，create_at 与 acquire 时一致，租约已经被其他请求接手时不修改
+        """
+        table = IdempotencyKey.__table__
+        db.session.execute(
+            table.update().where(
+                table.c.key_id == key_id,
+                table.c.create_at == create_at,
+                table.c.status == IdempotencyKey.STATUS_PENDING,
+            ).values(
+                status=IdempotencyKey.STATUS_SUCCEED,
+                result=result,
+                expire_at=int(get_unix_time_tuple(millisecond=True)) + ttl_ms,
+            )
+        )
+        db.session.commit()
+
+    @staticmethod
+    def release(key_id: int, create_at: int) -> None:
+        """ 请求失败，删除处理中的行，等待的请求重新执行
+        """
+        table = IdempotencyKey.__table__
+        db.session.execute(
+            table.delete().where(
+                table.c.key_id == key_id,
+                table.c.create_at == create_at,
+                table.c.status == IdempotencyKey.STATUS_PENDING,
+            )
+        )
+        db.session.commit()
+
+    @staticmethod
+    def purge(now: int) -> int:
+        """ 删除过期的结果，返回删除的行数
+        """
+        table = IdempotencyKey.__table__
+        count = db.session.execute(
+            table.delete().where(
+                table.c.status == IdempotencyKey.STATUS_SUCCEED,
+                table.c.expire_at < now,
+            )
+        ).rowcount
+        db.session.commit()
+        return count
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import _thread
+import hmac
+import os
+import random
+import re
+import sys
+import time
+import typing
+from collections import Counter
+
+from flask import Flask, g, request
+
+from app.utils import get_unix_time_tuple, is_cooperative
+
+__all__ = ["SamplingProfiler"]
+
+# 文件名中只保留的字符
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def _real_primitives() -> typing.Tuple[typing.Callable[..., typing.Any],
+                                       typing.Callable[[float], None],
+                                       typing.Callable[[], typing.Any]]:
+    """ 采样线程使用的 (start_new_thread, sleep, allocate_lock)
+    gevent worker 下使用 monkey patch 之前的版本，采样线程是真正的系统线程，
+    不会因为请求协程阻塞而停止采样
+    """
+    if is_cooperative():
+        from gevent import monkey
+        return (
+            monkey.get_original("_thread", "start_new_thread"),
+            monkey.get_original("time", "sleep"),
+            monkey.get_original("_thread", "allocate_lock"),
+        )
+    return _thread.start_new_thread, time.sleep, _thread.allocate_lock
+
+
+def _frame_label(frame: typing.Any) -> str:
+    code = frame.f_code
+    name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    # 折叠格式使用 ; 分隔调用栈
+    return name.replace(";", ":")
+
+
+class SamplingProfiler(object):
+    """ 按固定间隔采样一个请求的调用栈，输出 flamegraph.pl / speedscope 可以读取的折叠格式
+    采样在单独的线程中进行，被采样的请求不执行任何额外的代码；
+    统计的是墙上时间，等待上游、等待数据库的时间也会出现在结果中。
+    gevent worker 下采样请求所在的协程：协程挂起时读取它挂起的位置。
+
+    Args:
+        interval: 采样间隔秒数
+        max_depth: 最多记录的调用栈深度
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: typing.Counter[typing.Tuple[str, ...]] = Counter()
+        self.elapsed = 0.0
+        self._began = 0.0
+        self._running = False
+        self._done: typing.Any = None
+
+    def start(self) -> None:
+        start_thread, sleep, allocate_lock = _real_primitives()
+        ident = _thread.get_ident()
+        greenlet: typing.Any = None
+        if is_cooperative():
+            import greenlet as greenlet_module
+            greenlet = greenlet_module.getcurrent()
+        self._done = allocate_lock()
+        self._done.acquire()
+        self._running = True
+        self._began = time.perf_counter()
+
+        def current_frame() -> typing.Any:
+            if greenlet is not None and greenlet.gr_frame is not None:
+                return greenlet.gr_frame
+            return sys._current_frames().get(ident)
+
+        def sample() -> None:
+            try:
+                while self._running:
+                    sleep(self.interval)
+                    frame = current_frame()
+                    stack: typing.List[str] = []
+                    while frame is not None and len(stack) < self.max_depth:
+                        stack.append(_frame_label(frame))
+                        frame = frame.f_back
+                    if stack:
+                        self.samples[tuple(reversed(stack))] += 1
+            finally:
+                self._done.release()
+
+        start_thread(sample, ())
+
+    def stop(self) -> None:
+        """ 停止采样，最多等待一个采样间隔
+        """
+        if not self._running:
+            return
+        self._running = False
+        self.elapsed = time.perf_counter() - self._began
+        self._done.acquire()
+
+    def folded(self, root: typing.Optional[str] = None) -> typing.List[str]:
+        """ 折叠格式的结果，root 作为所有调用栈的根
+        """
+        prefix = (root.replace(";", ":"), ) if root else ()
+        return [
+            ";".join(prefix + stack) + f" {count}"
+            for stack, count in self.samples.most_common()
+        ]
+
+
+def _should_profile(app: Flask) -> typing.Optional[str]:
+    """ 当前请求是否需要采样，返回触发的方式
+    """
+    endpoints = app.config["PROFILER_ENDPOINTS"]
+    if endpoints is not None and request.endpoint not in endpoints:
+        return None
+    token = app.config["PROFILER_TOKEN"]
+    if token:
+        # 只使用请求头触发，query 参数会让 request.values 不为空，接口不再读取 JSON 请求体
+        provided = request.headers.get("X-Profile")
+        if provided and hmac.compare_digest(provided, token):
+            return "token"
+    rate = app.config["PROFILER_SAMPLE_RATE"]
+    if rate > 0 and random.random() < rate:
+        return "sample"
+    return None
+
+
+def _save(app: Flask, profiler: SamplingProfiler) -> str:
+    """ 保存到 instance_path/PROFILER_DIR，文件名包含时间、endpoint 与耗时，返回文件名
+    """
+    elapsed_ms = int(profiler.elapsed * 1000)
+    rule = request.url_rule.rule if request.url_rule else request.path
+    endpoint = _UNSAFE_NAME.sub("_", request.endpoint or "unknown")
+    name = f"{get_unix_time_tuple(millisecond=True)}-{endpoint}-{elapsed_ms}ms.folded"
+    directory = os.path.join(app.instance_path, app.config["PROFILER_DIR"])
+    os.makedirs(directory, exist_ok=True)
+    lines = profiler.folded(root=f"{request.method} {rule} {elapsed_ms}ms")
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"profile saved: {name}, {sum(profiler.samples.values())} samples")
+    return name
+
+
+def init_app(app: Flask) -> None:
+    """ 没有配置 PROFILER_TOKEN 且 PROFILER_SAMPLE_RATE 为 0 时不注册任何钩子
+    """
+    if not app.config["PROFILER_TOKEN"] and app.config["PROFILER_SAMPLE_RATE"] <= 0:
+        return
+
+    @app.before_request
+    def start_profiler():
+        trigger = _should_profile(app)
+        if trigger is None:
+            return
+        profiler = SamplingProfiler(interval=app.config["PROFILER_INTERVAL"])
+        profiler.start()
+        g.profiler = (profiler, trigger)
+
+    @app.after_request
+    def save_profile(response):
+        profiler, trigger = g.pop("profiler", (None, None))
+        if profiler is None:
+            return response
+        profiler.stop()
+        name = _save(app, profiler)
+        if trigger == "token":
+            response.headers["X-Profile"] = name
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # 视图抛出异常时没有执行 after_request
+        profiler, _ = g.pop("profiler", (None, None))
+        if profiler is not None:
+            profiler.stop()
+            _save(app, profiler)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import time
+import typing
+from collections import Counter
+
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+
+from app.ext import db
+
+__all__ = ["QueryStats", "count_queries"]
+
+
+class QueryStats(object):
+    """ 一段时间内执行的 SQL 统计：语句数量、总耗时、每条语句的执行次数
+    语句是带占位符的 SQL，参数不同的同一条语句计为同一条
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: typing.Counter[str] = Counter()
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated(self, threshold: int) -> typing.List[typing.Tuple[str, int]]:
+        """ 执行次数不少于 threshold 的语句，通常是 N+1 查询
+        """
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+    def report(self) -> str:
+        lines = [f"{self.count} statements, {self.seconds * 1000:.1f} ms"]
+        lines.extend(
+            f"  {count} x {' '.join(statement.split())[:200]}"
+            for statement, count in self.statements.most_common()
+        )
+        return "\n".join(lines)
+
+
+def _route() -> str:
+    if not has_request_context():
+        return "-"
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return f"{request.method} {rule}"
+
+
+def _listen(
+    app: Flask, on_query: typing.Callable[[str, float], None]
+) -> typing.Callable[[], None]:
+    """ 在 app 的所有 engine 上统计每条语句的耗时，返回取消监听的函数
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.querystats_began = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        began = getattr(context, "querystats_began", None)
+        if began is not None:
+            on_query(statement, time.perf_counter() - began)
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before)
+        event.listen(engine, "after_cursor_execute", after)
+
+    def remove() -> None:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before)
+            event.remove(engine, "after_cursor_execute", after)
+
+    return remove
+
+
+@contextlib.contextmanager
+def count_queries(app: Flask) -> typing.Iterator[QueryStats]:
+    """ 统计代码块中 app 执行的全部 SQL，用于测试每个接口的查询数量
+    """
+    stats = QueryStats()
+    remove = _listen(app, stats.record)
+    try:
+        yield stats
+    finally:
+        remove()
+
+
+def init_app(app: Flask) -> None:
+    """ 统计每个请求的 SQL 数量与耗时，记录慢查询与疑似 N+1 的查询
+    SQL_QUERY_STATS_ENABLED 为 False 时不注册任何监听
+    """
+    if not app.config["SQL_QUERY_STATS_ENABLED"]:
+        return
+    slow_seconds: float = app.config["SQL_SLOW_QUERY_SECONDS"]
+    nplus1_threshold: int = app.config["SQL_NPLUS1_THRESHOLD"]
+    server_timing: bool = app.config["SQL_SERVER_TIMING"]
+
+    def on_query(statement: str, seconds: float) -> None:
+        if seconds >= slow_seconds:
+            print(
+                f"slow query {seconds * 1000:.1f} ms {_route()}: "
+                f"{' '.join(statement.split())[:500]}"
+            )
+        if has_request_context():
+            stats = g.get("query_stats")
+            if stats is None:
+                stats = g.query_stats = QueryStats()
+            stats.record(statement, seconds)
+
+    _listen(app, on_query)
+
+    if server_timing:
+
+        @app.after_request
+        def add_server_timing(response):
+            stats = g.get("query_stats")
+            if stats is not None:
+                response.headers.add(
+                    "Server-Timing",
+                    f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"'
+                )
+            return response
+
+    @app.teardown_request
+    def report_queries(exc):
+        stats: typing.Optional[QueryStats] = g.get("query_stats")
+        if stats is None:
+            return
+        for statement, count in stats.repeated(nplus1_threshold):
+            print(
+                f"possible N+1 query {_route()}: {count} x "
+                f"{' '.join(statement.split())[:500]}"
+            )
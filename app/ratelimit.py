@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import threading
+import time
+import typing
+
+from flask import Blueprint, Flask, current_app, make_response, request, session
+from flask_limiter import Limiter, RequestLimit
+from flask_limiter.util import get_remote_address
+
+from app.response import response_error
+
+__all__ = [
+    "rate_limit_key", "VerifiedTokens", "TierResolver", "get_limiter",
+    "get_tier_resolver", "get_verified_tokens", "remember_token"
+]
+
+
+def _token_digest() -> typing.Optional[str]:
+    api_key = request.headers.get("Authorization")
+    if not api_key:
+        return None
+    token = api_key.replace("Token ", "", 1).strip()
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def rate_limit_key() -> str:
+    """ 限流的计数 key：已经验证过的 token 与登录后的 session 使用用户 id，
+    其他请求（匿名、未验证或者伪造的 token）使用 IP
+    只读取请求头、session 与进程内缓存，不查询数据库
+    """
+    digest = _token_digest()
+    if digest is not None:
+        user_id = get_verified_tokens().get(digest)
+        if user_id is not None:
+            return f"user:{user_id}"
+        return f"ip:{get_remote_address()}"
+    user_id = session.get("_user_id")
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{get_remote_address()}"
+
+
+class VerifiedTokens(object):
+    """ token 摘要 -> 用户 id 的进程内缓存，只保存登录验证成功的 token
+    token 第一次出现时按 IP 计数，验证成功之后 ttl 秒内按用户计数
+
+    Args:
+        ttl: 缓存的秒数
+    """
+
+    def __init__(self, ttl: float = 300) -> None:
+        self.ttl = ttl
+        self._entries: typing.Dict[str, typing.Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> typing.Optional[str]:
+        with self._lock:
+            cached = self._entries.get(digest)
+        if cached is None or cached[0] <= time.monotonic():
+            return None
+        return cached[1]
+
+    def add(self, digest: str, user_id: str) -> None:
+        with self._lock:
+            if len(self._entries) > 100000:
+                self._entries.clear()
+            self._entries[digest] = (time.monotonic() + self.ttl, user_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class TierResolver(object):
+    """ 限流 key -> ChatAuth.tier 的进程内缓存
+    档位只在第一次请求与缓存过期时查询数据库，没有配置档位时不查询
+
+    Args:
+        ttl: 缓存的秒数
+    """
+
+    def __init__(self, ttl: float = 60) -> None:
+        self.ttl = ttl
+        self._entries: typing.Dict[str, typing.Tuple[float,
+                                                     typing.Optional[str]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, key: str) -> typing.Optional[str]:
+        if key.startswith("ip:"):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        tier = self._load()
+        with self._lock:
+            if len(self._entries) > 100000:
+                self._entries.clear()
+            self._entries[key] = (now + self.ttl, tier)
+        return tier
+
+    def clear(self) -> None:
+        """ 授权变化后清空，只影响当前进程，其他进程在缓存过期后生效
+        """
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _load() -> typing.Optional[str]:
+        """ 查询当前用户的档位，授权过期时使用默认限制
+        """
+        from flask_login import current_user
+        from app.model import ChatAuth
+        if not current_user.is_authenticated:
+            return None
+        auth = ChatAuth.get_auth_by_user_idf(user_idf=current_user.identifier)
+        if not auth or not auth.is_auth():
+            return None
+        return auth.tier
+
+
+def _limit_provider(app: Flask, resolver: TierResolver,
+                    blueprint: str) -> typing.Callable[[], str]:
+
+    def provider() -> str:
+        limits: typing.Dict[str, str] = app.config["RATELIMIT_BLUEPRINTS"]
+        tiers: typing.Dict[str, typing.Dict[str, str]] = app.config["RATELIMIT_TIERS"]
+        if tiers:
+            tier = resolver.resolve(rate_limit_key())
+            if tier in tiers and blueprint in tiers[tier]:
+                return tiers[tier][blueprint]
+        return limits.get(blueprint) or ""
+
+    return provider
+
+
+def _on_breach(request_limit: RequestLimit):
+    """ 超出限制时直接返回 429，不再执行视图
+    """
+    retry_after = max(math.ceil(request_limit.reset_at - time.time()), 1)
+    response = make_response(
+        response_error(
+            error_code=429,
+            msg="请求过于频繁，请稍后再试",
+            http_code=429,
+        )
+    )
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+def get_limiter() -> Limiter:
+    return current_app.extensions["gpt_limiter"]
+
+
+def get_tier_resolver() -> TierResolver:
+    return current_app.extensions["gpt_tier_resolver"]
+
+
+def get_verified_tokens() -> VerifiedTokens:
+    return current_app.extensions["gpt_verified_tokens"]
+
+
+def remember_token(user_id: str) -> None:
+    """ 请求中的 token 通过验证之后记录到缓存，后续请求按用户计数
+    """
+    digest = _token_digest()
+    if digest is not None:
+        get_verified_tokens().add(digest, user_id)
+
+
+def init_app(app: Flask, blueprints: typing.List[Blueprint]) -> None:
+    """ 按照 RATELIMIT_BLUEPRINTS 为每个 blueprint 设置一个共享的 moving window 限制，
+    RATELIMIT_TIERS 中 ChatAuth.tier 对应的限制优先
+    """
+    limiter = Limiter(
+        key_func=rate_limit_key, app=app, on_breach=_on_breach
+    )
+    app.extensions["gpt_limiter"] = limiter
+    resolver = TierResolver(ttl=app.config["RATELIMIT_TIER_CACHE_SECONDS"])
+    app.extensions["gpt_tier_resolver"] = resolver
+    app.extensions["gpt_verified_tokens"] = VerifiedTokens(
+        ttl=app.config["RATELIMIT_TOKEN_CACHE_SECONDS"]
+    )
+    for blueprint in blueprints:
+        limiter.shared_limit(
+            _limit_provider(app, resolver, blueprint.name),
+            scope=blueprint.name,
+        )(blueprint)
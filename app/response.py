@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
+import hashlib
 from typing import Dict, Tuple, Optional, Union, List, Any
-from flask import jsonify, Response, current_app
+from flask import jsonify, Response, current_app, request
 
 
 def __check_request(method: str = "") -> str:
@@ -117,15 +118,18 @@ def response_error(
     406 Not Acceptable - [GET]：用户请求的格式不可得（比如用户请求JSON格式，但是只有XML格式）。
     410 Gone -[GET]：用户请求的资源被永久删除，且不会再得到的。
     422 Unprocesable entity - [POST/PUT/PATCH] 当创建一个对象时，发生一个验证错误。
+    429 Too Many Requests - [*]：请求过于频繁，稍后按照 Retry-After 重试。
     500 INTERNAL SERVER ERROR - [*]：服务器发生错误，用户将无法判断发出的请求是否成功。
+    503 Service Unavailable - [*]：上游服务暂时不可用，请求没有发出，按照 Retry-After 重试。
 
     :return: 返回一个响应
     """
     from flask import request as r
 
-    error_codes = [400, 401, 402, 403, 404, 406, 410, 411, 412, 413, 500]
+    error_codes = [400, 401, 402, 403, 404, 406, 410, 411, 412, 413, 429, 500, 503]
     # error_codes = [200]
-    http_code = 200
+    # 默认返回 200，需要客户端或者代理识别的错误(例如 429)可以指定 http_code
+    http_code = http_code or 200
     if msg is None:
         raise ValueError("error Msg can't be None")
     if msg and (error_code not in error_codes):
@@ -145,6 +149,36 @@ def response_error(
     ), http_code, header
 
 
+def make_etag(*parts: Any) -> str:
+    """ 由决定响应内容的几个值计算 ETag，不需要先生成响应
+    """
+    raw = "|".join(str(part) for part in parts)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def response_not_modified(etag: str) -> Optional[Response]:
+    """ 请求头 If-None-Match 包含 etag 时返回 304，否则返回 None
+    ETag 由数据的版本计算，与响应是否压缩无关，所以使用弱比较
+    """
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    not_modified = Response(status=304)
+    not_modified.set_etag(etag, weak=True)
+    not_modified.headers["Cache-Control"] = "private, no-cache"
+    return not_modified
+
+
+def with_etag(
+    result: Tuple[Response, int, Dict[str, str]], etag: str
+) -> Tuple[Response, int, Dict[str, str]]:
+    """ 给 response_succ 的结果加上弱 ETag，客户端每次都需要重新验证
+    """
+    response, status_code, header = result
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response, status_code, header
+
+
 def page_wrapper(
     content: List[Any],
     current: int,
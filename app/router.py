@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import itertools
+import random
+import threading
+import time
+import typing
+
+from flask import Flask, current_app
+
+from app.breaker import BreakerRegistry, CircuitBreaker, CircuitOpenError
+from app.upstream import Upstream, DEFAULT_API_BASE
+
+__all__ = ["UpstreamStats", "UpstreamRouter", "CircuitOpenError", "get_router"]
+
+# 熔断器的 (上游熔断器, key 熔断器)
+Breakers = typing.Tuple[typing.Optional[CircuitBreaker],
+                        typing.Optional[CircuitBreaker]]
+
+
+def _blame(error: Exception) -> typing.Tuple[bool, bool]:
+    """ 一次失败应该算在 (上游, key) 哪一方
+    key 无效、没有权限、超出频率限制只算 key 的失败，请求本身不合法不算任何一方的失败
+    """
+    import openai
+    if isinstance(
+        error, (
+            openai.error.AuthenticationError,
+            openai.error.PermissionError,
+            openai.error.RateLimitError,
+        )
+    ):
+        return False, True
+    if isinstance(error, openai.error.InvalidRequestError):
+        return False, False
+    return True, False
+
+
+class UpstreamStats(object):
+    """ 上游的运行统计，使用 EWMA 平滑延迟与错误率
+    """
+
+    def __init__(self) -> None:
+        self.latency: float = 0.0
+        self.error_rate: float = 0.0
+        self.samples: int = 0
+
+    def update(self, latency: float, ok: bool, alpha: float) -> None:
+        error = 0.0 if ok else 1.0
+        if self.samples == 0:
+            self.latency = latency
+            self.error_rate = error
+        else:
+            self.latency = alpha * latency + (1 - alpha) * self.latency
+            self.error_rate = alpha * error + (1 - alpha) * self.error_rate
+        self.samples += 1
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "samples": self.samples,
+        }
+
+
+class UpstreamRouter(object):
+    """ 根据模型选择上游
+    每个模型可以对应多个上游，按照 EWMA 延迟与错误率打分，选择分数最低的上游，
+    没有样本的上游会被优先尝试，同时以 `explore_ratio` 的概率随机探索其他上游。
+
+    Args:
+        routes: model -> 上游列表，`*` 表示默认路由
+        alpha: EWMA 的平滑系数
+        error_penalty: 一次失败折算的延迟(秒)，分数为 延迟 + 错误率 * error_penalty
+        explore_ratio: 随机探索的概率
+        max_attempts: 一次请求最多尝试的上游数量
+        breakers: 上游与 key 的熔断器，为空时不熔断，见 app.breaker
+    """
+
+    def __init__(
+        self,
+        routes: typing.Dict[str, typing.List[Upstream]],
+        alpha: float = 0.3,
+        error_penalty: float = 10.0,
+        explore_ratio: float = 0.05,
+        max_attempts: int = 2,
+        rand: typing.Optional[random.Random] = None,
+        breakers: typing.Optional[BreakerRegistry] = None,
+    ) -> None:
+        self.routes = routes
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.explore_ratio = explore_ratio
+        self.max_attempts = max(max_attempts, 1)
+        self.stats: typing.Dict[str, UpstreamStats] = {}
+        self.breakers = breakers
+        # key 熔断器名称 -> key，用于挑选 key 时跳过熔断的 key
+        self._breaker_keys: typing.Dict[str, str] = {}
+        # 共享的 HTTP 会话，见 app.httpclient
+        self.client: typing.Any = None
+        self._rand = rand or random.Random()
+        self._lock = threading.Lock()
+        for upstreams in routes.values():
+            for upstream in upstreams:
+                self.stats.setdefault(upstream.name, UpstreamStats())
+
+    @staticmethod
+    def from_config(config: typing.Dict[str, typing.Any]) -> "UpstreamRouter":
+        routes: typing.Dict[str, typing.List[Upstream]] = {}
+        for model, upstreams in (config.get("GPT_UPSTREAMS") or {}).items():
+            if not isinstance(upstreams, (list, tuple)):
+                upstreams = [upstreams]
+            routes[model] = [Upstream.from_config(u) for u in upstreams]
+        routes.setdefault("*", [Upstream(name="default", api_base=DEFAULT_API_BASE)])
+        return UpstreamRouter(
+            routes=routes,
+            alpha=config.get("GPT_UPSTREAM_EWMA_ALPHA", 0.3),
+            error_penalty=config.get("GPT_UPSTREAM_ERROR_PENALTY", 10.0),
+            explore_ratio=config.get("GPT_UPSTREAM_EXPLORE_RATIO", 0.05),
+            max_attempts=config.get("GPT_UPSTREAM_MAX_ATTEMPTS", 2),
+            breakers=BreakerRegistry(
+                window=config.get("GPT_BREAKER_WINDOW", 60),
+                min_requests=config.get("GPT_BREAKER_MIN_REQUESTS", 10),
+                error_rate=config.get("GPT_BREAKER_ERROR_RATE", 0.5),
+                slow_call_seconds=config.get("GPT_BREAKER_SLOW_CALL_SECONDS"),
+                open_seconds=config.get("GPT_BREAKER_OPEN_SECONDS", 30),
+                half_open_calls=config.get("GPT_BREAKER_HALF_OPEN_CALLS", 2),
+            ) if config.get("GPT_BREAKER_ENABLED", True) else None,
+        )
+
+    def upstreams_for(self, model: str) -> typing.List[Upstream]:
+        return self.routes.get(model) or self.routes["*"]
+
+    def score(self, upstream: Upstream) -> float:
+        stats = self.stats[upstream.name]
+        if stats.samples == 0:
+            return 0.0
+        return stats.latency + self.error_penalty * stats.error_rate
+
+    def rank(self, model: str) -> typing.List[Upstream]:
+        """ 按照分数从低到高排列某个模型的上游
+        """
+        upstreams = self.upstreams_for(model)
+        with self._lock:
+            ranked = sorted(upstreams, key=self.score)
+            if len(ranked) > 1 and self._rand.random() < self.explore_ratio:
+                explored = self._rand.choice(ranked[1:])
+                ranked.remove(explored)
+                ranked.insert(0, explored)
+        return ranked
+
+    def select(self, model: str) -> Upstream:
+        return self.rank(model)[0]
+
+    def record(self, upstream: Upstream, latency: float, ok: bool) -> None:
+        with self._lock:
+            self.stats[upstream.name].update(latency, ok, self.alpha)
+
+    def upstream_breaker(self, upstream: Upstream) -> typing.Optional[CircuitBreaker]:
+        if self.breakers is None:
+            return None
+        return self.breakers.get(f"upstream:{upstream.name}")
+
+    def key_breaker(self, key: typing.Optional[str]) -> typing.Optional[CircuitBreaker]:
+        """ key 的熔断器，名称只包含 key 的摘要
+        """
+        if self.breakers is None or not key:
+            return None
+        name = "key:" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        self._breaker_keys.setdefault(name, key)
+        return self.breakers.get(name)
+
+    def open_keys(self) -> typing.List[str]:
+        """ 熔断器没有放行请求的 key
+        """
+        if self.breakers is None:
+            return []
+        return [
+            key for name, key in list(self._breaker_keys.items())
+            if not self.breakers.get(name).available()
+        ]
+
+    def is_available(self, model: str) -> bool:
+        """ 模型是否还有熔断器可能放行的上游，不占用试探名额
+        """
+        return any(
+            breaker is None or breaker.available()
+            for breaker in map(self.upstream_breaker, self.upstreams_for(model))
+        )
+
+    def _acquire(
+        self, upstream: Upstream, fallback: typing.Optional[str]
+    ) -> typing.Optional[typing.Tuple[typing.Optional[str], Breakers]]:
+        """ 通过熔断器申请一次请求，选择熔断器放行的 key，上游或者所有 key 都被熔断时返回 None
+        """
+        key_breaker: typing.Optional[CircuitBreaker] = None
+        for _ in range(max(len(upstream.keys), 1)):
+            key = upstream.next_key(fallback=fallback)
+            key_breaker = self.key_breaker(key)
+            if key_breaker is None or key_breaker.allow():
+                break
+        else:
+            return None
+        breaker = self.upstream_breaker(upstream)
+        if breaker is not None and not breaker.allow():
+            if key_breaker is not None:
+                key_breaker.release()
+            return None
+        return key, (breaker, key_breaker)
+
+    def _settle(
+        self, upstream: Upstream, breakers: Breakers, latency: float,
+        error: typing.Optional[Exception] = None
+    ) -> None:
+        """ 记录一次请求的结果到统计与熔断器
+        """
+        self.record(upstream, latency, ok=error is None)
+        upstream_failed, key_failed = _blame(error) if error else (False, False)
+        breaker, key_breaker = breakers
+        if breaker is not None:
+            breaker.record(ok=not upstream_failed, latency=latency)
+        if key_breaker is not None:
+            # key 的熔断只看 key 本身的错误，不统计慢请求
+            key_breaker.record(ok=not key_failed)
+
+    def retry_after(self, model: str) -> float:
+        """ 模型的所有上游都被熔断时，距离下一次允许试探的秒数
+        """
+        return self._open_error(model).retry_after
+
+    def _open_error(self, model: str) -> CircuitOpenError:
+        breakers = [
+            b for b in map(self.upstream_breaker, self.upstreams_for(model))
+            if b is not None
+        ]
+        return CircuitOpenError(
+            name=model,
+            retry_after=min((b.retry_after() for b in breakers), default=0.0),
+        )
+
+    def create_chat_completion(
+        self,
+        model: str,
+        messages: typing.List[typing.Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        api_key: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """ 选择上游并发起请求，失败时按照分数顺序尝试下一个上游
+
+        Args:
+            api_key: 上游没有配置 key 池时使用的 key
+        Raises:
+            最后一个上游抛出的异常
+        """
+        request_timeout: typing.Any = timeout
+        if self.client is not None:
+            self.client.install_openai()
+            request_timeout = self.client.timeout(timeout)
+        last_error: typing.Optional[Exception] = None
+        attempts = 0
+        for upstream in self.rank(model):
+            if attempts >= self.max_attempts:
+                break
+            acquired = self._acquire(upstream, fallback=api_key)
+            if acquired is None:
+                continue
+            key, breakers = acquired
+            attempts += 1
+            began = time.perf_counter()
+            try:
+                resp = upstream.create_chat_completion(
+                    api_key=key,
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout,
+                    request_timeout=request_timeout,
+                )
+            except Exception as e:
+                self._settle(upstream, breakers, time.perf_counter() - began, e)
+                print(f"upstream {upstream.name} failed: {e}")
+                last_error = e
+                continue
+            self._settle(upstream, breakers, time.perf_counter() - began)
+            return resp
+        raise last_error or self._open_error(model)
+
+    def stream_chat_completion(
+        self,
+        model: str,
+        messages: typing.List[typing.Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        api_key: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+        on_usage: typing.Optional[
+            typing.Callable[[typing.Dict[str, typing.Any]], None]] = None,
+    ) -> typing.Iterator[str]:
+        """ 流式请求，逐个返回回答的片段
+        收到第一个片段之前失败时按照分数顺序尝试下一个上游，之后失败时直接抛出异常；
+        熔断器按照第一个片段的结果与耗时统计
+
+        Args:
+            on_usage: 上游在最后一个片段返回 token 用量时调用
+
+        Raises:
+            最后一个上游抛出的异常
+        """
+        request_timeout: typing.Any = timeout
+        if self.client is not None:
+            self.client.install_openai()
+            request_timeout = self.client.timeout(timeout)
+        last_error: typing.Optional[Exception] = None
+        attempts = 0
+        for upstream in self.rank(model):
+            if attempts >= self.max_attempts:
+                break
+            acquired = self._acquire(upstream, fallback=api_key)
+            if acquired is None:
+                continue
+            key, breakers = acquired
+            attempts += 1
+            began = time.perf_counter()
+            try:
+                chunks = iter(
+                    upstream.create_chat_completion(
+                        api_key=key,
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        timeout=timeout,
+                        request_timeout=request_timeout,
+                        stream=True,
+                    )
+                )
+                first = next(chunks, None)
+            except Exception as e:
+                self._settle(upstream, breakers, time.perf_counter() - began, e)
+                print(f"upstream {upstream.name} failed: {e}")
+                last_error = e
+                continue
+            except BaseException:
+                for breaker in breakers:
+                    if breaker is not None:
+                        breaker.release()
+                raise
+            upstream_breaker, key_breaker = breakers
+            if upstream_breaker is not None:
+                upstream_breaker.record(ok=True, latency=time.perf_counter() - began)
+            if key_breaker is not None:
+                key_breaker.record(ok=True)
+            try:
+                for chunk in itertools.chain([first] if first else [], chunks):
+                    usage = chunk.get("usage")
+                    if usage and on_usage is not None:
+                        on_usage(usage)
+                    choices = chunk.get("choices") or [{}]
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+            except Exception:
+                self.record(upstream, time.perf_counter() - began, ok=False)
+                raise
+            finally:
+                # 调用方中途停止迭代时关闭上游的响应，断开连接让上游停止生成
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    close()
+            self.record(upstream, time.perf_counter() - began, ok=True)
+            return
+        raise last_error or self._open_error(model)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {
+                name: stats.to_json()
+                for name, stats in self.stats.items()
+            }
+
+    def status(self) -> typing.Dict[str, typing.Any]:
+        """ 给运维查看的上游统计与熔断器状态，只包含当前进程的数据
+        """
+        return {
+            "upstreams": self.to_json(),
+            "breakers": self.breakers.to_json() if self.breakers else {},
+        }
+
+
+def get_router() -> UpstreamRouter:
+    return current_app.extensions["gpt_router"]
+
+
+def init_app(app: Flask) -> None:
+    app.extensions["gpt_router"] = UpstreamRouter.from_config(app.config)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import math
+import typing
+import weakref
+
+from flask import Flask, current_app, g, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from app.response import response_error
+
+__all__ = ["Field", "Schema", "SchemaError", "validate_params"]
+
+# 限制可以是整数，也可以是配置项的名称，在第一次使用时从 app.config 读取
+Limit = typing.Union[int, float, str, None]
+Validator = typing.Callable[[typing.Any], typing.Any]
+
+
+class SchemaError(Exception):
+    """ 参数不合法，携带返回给客户端的错误码与错误信息
+    """
+
+    def __init__(self, error_code: int, msg: str) -> None:
+        super().__init__(msg)
+        self.error_code = error_code
+        self.msg = msg
+
+
+class Field(object):
+    """ 一个参数的声明
+
+    Args:
+        kind: 参数类型，str/int/float/bool/list、嵌套的 Schema，或者它们组成的元组
+        required: 是否必填，None 与空字符串视为没有传入
+        default: 没有传入时的默认值
+        minimum/maximum: 数值的范围
+        max_length: 字符串的最大长度或者列表的最大数量，列表超出时返回 413
+        choices: 可选值
+        items: 列表元素的声明
+    """
+
+    def __init__(
+        self,
+        kind: typing.Any,
+        required: bool = False,
+        default: typing.Any = None,
+        minimum: Limit = None,
+        maximum: Limit = None,
+        max_length: Limit = None,
+        choices: typing.Optional[typing.Iterable[typing.Any]] = None,
+        items: typing.Optional["Field"] = None,
+    ) -> None:
+        self.kinds: typing.Tuple[typing.Any, ...] = kind if isinstance(
+            kind, tuple
+        ) else (kind, )
+        self.required = required
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_length = max_length
+        self.choices = frozenset(choices) if choices is not None else None
+        self.items = items
+
+    def object_budget(self, config: typing.Mapping[str, typing.Any]
+                      ) -> typing.Optional[int]:
+        """ 这个参数最多包含的 JSON 对象数量，None 表示不限制
+        """
+        budget = 0
+        for kind in self.kinds:
+            if isinstance(kind, Schema):
+                objects = kind.object_budget(config)
+            elif kind is list and self.items is not None:
+                objects = self.items.object_budget(config)
+                max_length = _resolve(self.max_length, config)
+                if objects and max_length is None:
+                    return None
+                if objects:
+                    objects *= int(max_length)    # type: ignore
+            else:
+                continue
+            if objects is None:
+                return None
+            budget = max(budget, objects)
+        return budget
+
+    def compile(self, name: str,
+                config: typing.Mapping[str, typing.Any]) -> Validator:
+        """ 把声明编译为一个校验函数，返回转换之后的值
+        """
+        minimum = _resolve(self.minimum, config)
+        maximum = _resolve(self.maximum, config)
+        max_length = _resolve(self.max_length, config)
+        choices = self.choices
+        schemas = [k for k in self.kinds if isinstance(k, Schema)]
+        schema = schemas[0].compile(config) if schemas else None
+        items = self.items.compile(f"{name}[]", config) if self.items else None
+        kinds = [k for k in self.kinds if not isinstance(k, Schema)]
+
+        def convert(value: typing.Any) -> typing.Any:
+            if isinstance(value, dict) and schema is not None:
+                return schema(value)
+            for kind in kinds:
+                if kind is str and isinstance(value, str):
+                    if max_length is not None and len(value) > max_length:
+                        raise SchemaError(
+                            400, f"{name} 长度不能超过 {max_length}"
+                        )
+                    return value
+                if kind is list and isinstance(value, list):
+                    if max_length is not None and len(value) > max_length:
+                        raise SchemaError(
+                            413, f"{name} 数量不能超过 {max_length}"
+                        )
+                    return [items(v) for v in value] if items else value
+                if kind is bool and isinstance(value, bool):
+                    return value
+                if kind in (int, float) and not isinstance(value, bool):
+                    try:
+                        number = kind(value)
+                    except (TypeError, ValueError, OverflowError):
+                        continue
+                    if kind is float and not math.isfinite(number):
+                        raise SchemaError(400, f"{name} 不是有效的数字")
+                    if minimum is not None and number < minimum:
+                        raise SchemaError(400, f"{name} 不能小于 {minimum}")
+                    if maximum is not None and number > maximum:
+                        raise SchemaError(400, f"{name} 不能大于 {maximum}")
+                    return number
+            raise SchemaError(400, f"{name} 类型错误")
+
+        def validate(value: typing.Any) -> typing.Any:
+            value = convert(value)
+            if choices is not None and value not in choices:
+                raise SchemaError(400, f"{name} 不是可选的值")
+            return value
+
+        return validate
+
+
+class Schema(object):
+    """ 一组参数的声明，按 app 编译一次，请求时只执行编译好的校验函数
+    只返回声明过的参数，没有传入的参数使用默认值
+
+    Args:
+        fields: 参数名 -> 声明
+        max_bytes: 请求体的最大字节数，在读取请求体之前检查
+    """
+
+    def __init__(self, fields: typing.Dict[str, Field],
+                 max_bytes: Limit = None) -> None:
+        self.fields = fields
+        self.max_bytes = max_bytes
+        self._compiled: "weakref.WeakKeyDictionary[typing.Any, typing.Any]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def object_budget(self, config: typing.Mapping[str, typing.Any]
+                      ) -> typing.Optional[int]:
+        total = 1
+        for field in self.fields.values():
+            budget = field.object_budget(config)
+            if budget is None:
+                return None
+            total += budget
+        return total
+
+    def compile(self, config: typing.Mapping[str, typing.Any]) -> Validator:
+        validators = [
+            (
+                name, field.required, field.default, str not in field.kinds,
+                field.compile(name, config)
+            ) for name, field in self.fields.items()
+        ]
+
+        def validate(data: typing.Any) -> typing.Dict[str, typing.Any]:
+            if not isinstance(data, dict):
+                raise SchemaError(400, "参数格式错误")
+            params: typing.Dict[str, typing.Any] = {}
+            for name, required, default, empty_missing, validator in validators:
+                value = data.get(name)
+                if value is None or (empty_missing and value == ""):
+                    if required:
+                        raise SchemaError(400, f"缺少参数 {name}")
+                    params[name] = default
+                    continue
+                params[name] = validator(value)
+            return params
+
+        return validate
+
+    def bind(self, app: Flask) -> typing.Tuple[Validator, typing.Optional[int],
+                                               typing.Optional[int]]:
+        """ 返回 app 对应的 (校验函数, 最大字节数, 最多 JSON 对象数量)
+        """
+        compiled = self._compiled.get(app)
+        if compiled is None:
+            compiled = (
+                self.compile(app.config),
+                _resolve(self.max_bytes, app.config),
+                self.object_budget(app.config),
+            )
+            self._compiled[app] = compiled
+        return compiled
+
+    def load(self) -> typing.Dict[str, typing.Any]:
+        """ 从当前请求读取并校验参数，不合法时抛出 SchemaError
+        """
+        validate, max_bytes, max_objects = self.bind(
+            current_app._get_current_object()    # type: ignore
+        )
+        return validate(_read_params(max_bytes, max_objects))
+
+
+class _TooManyObjects(Exception):
+    pass
+
+
+def _reject_constant(name: str) -> typing.NoReturn:
+    # 标准 JSON 没有 NaN 与 Infinity
+    raise ValueError(name)
+
+
+def _resolve(limit: Limit, config: typing.Mapping[str, typing.Any]) -> Limit:
+    return config[limit] if isinstance(limit, str) else limit
+
+
+def _read_params(max_bytes: typing.Optional[int],
+                 max_objects: typing.Optional[int]) -> typing.Any:
+    """ 读取请求参数，query 与表单参数优先，与 parse_params 一致
+    请求体超过 max_bytes 时不读取，也不解析表单；没有 Content-Length 的请求体
+    由 MAX_CONTENT_LENGTH 限制。解析 JSON 时对象数量超过 max_objects 立即停止
+    """
+    length = request.content_length
+    if max_bytes is not None and length is not None and length > max_bytes:
+        raise SchemaError(413, "请求体过大")
+    try:
+        if request.values:
+            return request.values.to_dict()
+        if max_bytes is None:
+            raw = request.get_data(cache=False)
+        else:
+            raw = request.stream.read(max_bytes + 1)
+            if len(raw) > max_bytes:
+                raise SchemaError(413, "请求体过大")
+    except RequestEntityTooLarge:
+        raise SchemaError(413, "请求体过大")
+    if not raw:
+        return {}
+
+    object_hook = None
+    if max_objects is not None:
+        count = 0
+
+        def object_hook(obj: typing.Dict[str, typing.Any]):
+            nonlocal count
+            count += 1
+            if count > max_objects:
+                raise _TooManyObjects()
+            return obj
+
+    try:
+        return json.loads(
+            raw, object_hook=object_hook, parse_constant=_reject_constant
+        )
+    except _TooManyObjects:
+        raise SchemaError(413, "请求包含的内容过多")
+    except ValueError:
+        raise SchemaError(400, "JSON 格式错误")
+
+
+def validate_params(schema: Schema):
+    """ 校验请求参数的装饰器，需要放在 login_required 之前，
+    不合法的请求在查询用户、挑选 key 之前返回，校验后的参数保存在 g.params
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                g.params = schema.load()
+            except SchemaError as e:
+                return response_error(error_code=e.error_code, msg=e.msg)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import re
+import threading
+import typing
+import unicodedata
+from collections import OrderedDict
+
+from flask import Flask, current_app
+
+__all__ = [
+    "normalize_prompt",
+    "simhash",
+    "hamming_distance",
+    "signature",
+    "SimilarityCache",
+    "get_cache",
+    "is_cacheable",
+]
+
+FINGERPRINT_BITS = 64
+# LSH 分段数量的上限，每段至少 8 位，否则桶太大，查询退化为扫描
+MAX_BANDS = 8
+
+# 结尾的客套话不影响问题本身
+_COURTESY_SUFFIX = re.compile(
+    r"(谢谢你|谢谢您|谢谢|多谢|感谢|thankyou|thanks|thx|please|请)+$"
+)
+
+
+# 句子中的标点，小数点与时间中的 . 和 : 除外；运算符、比较符号与括号会改变问题的含义，保留
+_SENTENCE_PUNCTUATION = re.compile(
+    r"[,!?;'\"、。，！？；…~“”‘’「」『』《》]|(?<!\d)[.:]|[.:](?!\d)"
+)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """ 归一化问题文本
+    全角转半角、转小写、去掉空白与句子中的标点，以及结尾的客套话
+    """
+    text = unicodedata.normalize("NFKC", prompt).lower()
+    text = "".join(
+        ch for ch in text if unicodedata.category(ch)[0] not in ("Z", "C")
+    )
+    text = _SENTENCE_PUNCTUATION.sub("", text)
+    return _COURTESY_SUFFIX.sub("", text) or text
+
+
+def signature(text: str) -> str:
+    """ 归一化文本中的数字与符号，SimHash 对单个字符的差异不敏感，
+    这部分必须完全相同才算相似问题，例如 1+1 与 1-1
+    """
+    return "".join(ch for ch in text if not ch.isalpha())
+
+
+def _features(text: str, size: int = 3) -> typing.Set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def simhash(text: str) -> int:
+    """ 计算归一化文本的 64 位 SimHash，特征为字符 3-gram
+    """
+    weights = [0] * FINGERPRINT_BITS
+    for feature in _features(text):
+        h = int.from_bytes(
+            hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(),
+            "big"
+        )
+        for i in range(FINGERPRINT_BITS):
+            weights[i] += 1 if h >> i & 1 else -1
+    fingerprint = 0
+    for i, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << i
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class _Entry(object):
+    __slots__ = ("namespace", "fingerprint", "signature", "answer")
+
+    def __init__(
+        self, namespace: str, fingerprint: int, signature: str, answer: str
+    ) -> None:
+        self.namespace = namespace
+        self.fingerprint = fingerprint
+        self.signature = signature
+        self.answer = answer
+
+
+class SimilarityCache(object):
+    """ 近似问题的回答缓存
+    问题归一化后计算 SimHash，指纹按位切分成若干段建立 LSH 索引：
+    两个指纹的汉明距离不超过 d 时，切成 d + 1 段后至少有一段完全相同，
+    所以只需要比较同段桶里的候选项，查询成本与缓存条目数量无关。
+    段数最多为 MAX_BANDS，所以汉明距离最多为 MAX_BANDS - 1，即阈值不能低于 0.89。
+    问题中的数字与符号(见 signature)必须完全相同。
+    缓存条目数量有上限，超出后按照 LRU 淘汰。
+
+    Args:
+        threshold: 相似度阈值，相似度 = 1 - 汉明距离 / 64
+        max_entries: 最多缓存的条目数量
+    Raises:
+        ValueError: 阈值对应的汉明距离超过 MAX_BANDS - 1
+    """
+
+    def __init__(
+        self, threshold: float = 0.95, max_entries: int = 100000
+    ) -> None:
+        self.max_distance = max(int((1 - threshold) * FINGERPRINT_BITS), 0)
+        if self.max_distance >= MAX_BANDS:
+            raise ValueError(
+                f"threshold {threshold} allows hamming distance "
+                f"{self.max_distance}, must be less than {MAX_BANDS}"
+            )
+        self.bands = self.max_distance + 1
+        self.band_bits = FINGERPRINT_BITS // self.bands
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._index: typing.List[typing.Dict[typing.Tuple[str, int],
+                                             typing.Set[int]]] = [
+                                                 {} for _ in range(self.bands)
+                                             ]
+        self._ids: typing.Dict[typing.Tuple[str, int], int] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _band_keys(
+        self, namespace: str, fingerprint: int
+    ) -> typing.Iterator[typing.Tuple[int, typing.Tuple[str, int]]]:
+        mask = (1 << self.band_bits) - 1
+        for band in range(self.bands):
+            yield band, (namespace, fingerprint >> band * self.band_bits & mask)
+
+    def get(self, namespace: str, prompt: str) -> typing.Optional[str]:
+        text = normalize_prompt(prompt)
+        return self.get_fingerprint(namespace, simhash(text), signature(text))
+
+    def put(self, namespace: str, prompt: str, answer: str) -> None:
+        text = normalize_prompt(prompt)
+        self.put_fingerprint(
+            namespace, simhash(text), answer, signature(text)
+        )
+
+    def get_fingerprint(
+        self, namespace: str, fingerprint: int, signature: str = ""
+    ) -> typing.Optional[str]:
+        with self._lock:
+            best: typing.Optional[int] = None
+            best_distance = self.max_distance + 1
+            for band, key in self._band_keys(namespace, fingerprint):
+                for entry_id in self._index[band].get(key, ()):
+                    entry = self._entries[entry_id]
+                    if entry.signature != signature:
+                        continue
+                    distance = hamming_distance(fingerprint, entry.fingerprint)
+                    if distance < best_distance:
+                        best, best_distance = entry_id, distance
+            if best is None:
+                return None
+            self._entries.move_to_end(best)
+            return self._entries[best].answer
+
+    def put_fingerprint(
+        self, namespace: str, fingerprint: int, answer: str, signature: str = ""
+    ) -> None:
+        with self._lock:
+            if (namespace, fingerprint) in self._ids:
+                entry_id = self._ids[(namespace, fingerprint)]
+                self._entries[entry_id].signature = signature
+                self._entries[entry_id].answer = answer
+                self._entries.move_to_end(entry_id)
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._ids[(namespace, fingerprint)] = entry_id
+            self._entries[entry_id] = _Entry(
+                namespace, fingerprint, signature, answer
+            )
+            for band, key in self._band_keys(namespace, fingerprint):
+                self._index[band].setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        entry_id, entry = self._entries.popitem(last=False)
+        del self._ids[(entry.namespace, entry.fingerprint)]
+        for band, key in self._band_keys(entry.namespace, entry.fingerprint):
+            bucket = self._index[band][key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._index[band][key]
+
+
+def get_cache() -> typing.Optional[SimilarityCache]:
+    return current_app.extensions.get("gpt_simcache")
+
+
+def is_cacheable(
+    messages: typing.List[typing.Dict[str, str]], temperature: float
+) -> bool:
+    """ 只缓存单轮、低温度的询问
+    """
+    return len(messages) == 1 and temperature <= current_app.config[
+        "GPT_SIMCACHE_MAX_TEMPERATURE"]
+
+
+def init_app(app: Flask) -> None:
+    if not app.config["GPT_SIMCACHE_ENABLED"]:
+        return
+    app.extensions["gpt_simcache"] = SimilarityCache(
+        threshold=app.config["GPT_SIMCACHE_THRESHOLD"],
+        max_entries=app.config["GPT_SIMCACHE_MAX_ENTRIES"],
+    )
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import itertools
+import threading
+import typing
+
+__all__ = ["Upstream", "DEFAULT_API_BASE"]
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+
+
+class Upstream(object):
+    """ 一个上游服务
+    可以是 OpenAI 官方接口，也可以是 Azure 或者自建的兼容服务
+
+    Args:
+        name: 上游名称，用于日志与统计
+        api_base: 上游的 base url，例如 https://api.openai.com/v1
+        api_type: openai 的 api_type，例如 open_ai、azure
+        api_version: azure 类型需要的 api_version
+        deployments: azure 类型需要的 model -> deployment 映射
+        keys: 该上游自己的 key 池，为空时使用调用方传入的 key
+        stream_usage: 流式请求时通过 stream_options 要求上游在最后一个片段返回 token 用量，
+            不支持该参数的兼容服务设为 False
+    """
+
+    def __init__(
+        self,
+        name: str,
+        api_base: str = DEFAULT_API_BASE,
+        api_type: typing.Optional[str] = None,
+        api_version: typing.Optional[str] = None,
+        deployments: typing.Optional[typing.Dict[str, str]] = None,
+        keys: typing.Optional[typing.List[str]] = None,
+        stream_usage: bool = True,
+    ) -> None:
+        self.name = name
+        self.api_base = api_base.rstrip("/")
+        self.api_type = api_type
+        self.api_version = api_version
+        self.deployments = deployments or {}
+        self.keys = list(keys or [])
+        self.stream_usage = stream_usage
+        self._key_cycle = itertools.cycle(self.keys) if self.keys else None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(
+        config: typing.Union[str, typing.Dict[str, typing.Any]]
+    ) -> "Upstream":
+        """ 从配置中构建上游，配置可以是一个 base url，也可以是一个字典
+        """
+        if isinstance(config, str):
+            return Upstream(name=config, api_base=config)
+        api_base = config.get("api_base") or DEFAULT_API_BASE
+        return Upstream(
+            name=config.get("name") or api_base,
+            api_base=api_base,
+            api_type=config.get("api_type"),
+            api_version=config.get("api_version"),
+            deployments=config.get("deployments"),
+            keys=config.get("keys"),
+            stream_usage=config.get("stream_usage", True),
+        )
+
+    def next_key(self, fallback: typing.Optional[str] = None) -> typing.Optional[str]:
+        """ 轮询获取该上游 key 池中的下一个 key，没有 key 池时返回 fallback
+        """
+        if not self._key_cycle:
+            return fallback
+        with self._lock:
+            return next(self._key_cycle)
+
+    def create_chat_completion(
+        self,
+        api_key: str,
+        model: str,
+        messages: typing.List[typing.Dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        timeout: typing.Optional[float] = None,
+        request_timeout: typing.Union[float, typing.Tuple[float, float],
+                                      None] = None,
+        stream: bool = False,
+    ) -> typing.Any:
+        """ 向该上游发起一次 chat completion 请求
+
+        Args:
+            request_timeout: HTTP 请求的超时，可以是 (连接超时, 读取超时)，为空时使用 timeout
+            stream: 为 True 时返回逐个片段的迭代器
+        """
+        from openai import ChatCompletion
+        kwargs: typing.Dict[str, typing.Any] = {
+            "api_key": api_key,
+            "api_base": self.api_base,
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        if self.api_type:
+            kwargs["api_type"] = self.api_type
+            kwargs["api_version"] = self.api_version
+        if stream:
+            kwargs["stream"] = True
+            if self.stream_usage:
+                kwargs["stream_options"] = {"include_usage": True}
+        if model in self.deployments:
+            kwargs["deployment_id"] = self.deployments[model]
+        if timeout:
+            kwargs["timeout"] = timeout
+        if request_timeout or timeout:
+            kwargs["request_timeout"] = request_timeout or timeout
+        return ChatCompletion.create(**kwargs)
+
+    def __repr__(self) -> str:
+        return f"<Upstream {self.name} {self.api_base}>"
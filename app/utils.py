@@ -1,23 +1,131 @@
 # -*- coding: utf-8 -*-
 import datetime
+import os
 import random
+import sys
+import threading
 import time
 import typing
 from flask import Request
 
+# 2023-01-01 00:00:00 UTC，ID 中的时间部分从这里开始计算
+ID_EPOCH = 1672531200000
+ID_WORKER_BITS = 10
+ID_SEQUENCE_BITS = 12
+
+
+class MonotonicClock(object):
+    """ 单调不减的毫秒时钟
+    系统时间被回拨时，继续返回上一次的时间，保证同一进程内的时间不会倒退
+    """
+
+    def __init__(self) -> None:
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def now_ms(self) -> int:
+        with self._lock:
+            self._last = max(self._last, int(time.time() * 1000))
+            return self._last
+
+
+class SnowflakeGenerator(object):
+    """ 可排序的唯一ID生成器
+    64 位整数，高位到低位依次为：41 位毫秒时间(从 ID_EPOCH 开始)、10 位 worker、12 位序号，
+    同一毫秒内的序号用完时等待下一毫秒。生成的 ID 按时间递增，不同 worker 之间不会重复。
+
+    Args:
+        worker_id: worker 编号，为 None 时使用进程号，fork 之后会重新计算
+    """
+
+    def __init__(
+        self,
+        worker_id: typing.Optional[int] = None,
+        clock: typing.Optional[MonotonicClock] = None,
+    ) -> None:
+        self.configured_worker_id = worker_id
+        self.clock = clock or MonotonicClock()
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @property
+    def worker_id(self) -> int:
+        worker_id = self.configured_worker_id
+        if worker_id is None:
+            worker_id = os.getpid()
+        return worker_id & ((1 << ID_WORKER_BITS) - 1)
+
+    def next_id(self) -> int:
+        with self._lock:
+            now = self.clock.now_ms()
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & (
+                    (1 << ID_SEQUENCE_BITS) - 1
+                )
+                if self._sequence == 0:
+                    while now <= self._last_ms:
+                        now = self.clock.now_ms()
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - ID_EPOCH) << (ID_WORKER_BITS + ID_SEQUENCE_BITS)) | (
+                self.worker_id << ID_SEQUENCE_BITS
+            ) | self._sequence
+
+
+_clock = MonotonicClock()
+_id_generator = SnowflakeGenerator(clock=_clock)
+
+
+def configure_id_generator(worker_id: typing.Optional[int]) -> None:
+    """ 设置当前进程的 worker 编号，多机部署时每个进程需要不同的编号
+    """
+    _id_generator.configured_worker_id = worker_id
+
+
+def generate_id() -> int:
+    """ 生成一个可排序的唯一ID
+    """
+    return _id_generator.next_id()
+
+
+def get_min_id_at(millis: int) -> int:
+    """ 指定毫秒时间生成的最小ID，可以把时间范围转换为ID范围，走ID上的索引
+    """
+    return max(millis - ID_EPOCH, 0) << (ID_WORKER_BITS + ID_SEQUENCE_BITS)
+
+
+def get_monotonic_millis() -> int:
+    """ 当前的毫秒时间，同一进程内单调不减
+    """
+    return _clock.now_ms()
+
+
+def is_cooperative() -> bool:
+    """ 当前进程是否运行在 gevent 协程模式下(socket 已经被 monkey patch)
+    只检查已经导入的模块，不会因此导入 gevent
+    """
+    monkey = sys.modules.get("gevent.monkey")
+    return bool(monkey and monkey.is_module_patched("socket"))
+
 
 def get_unix_time_tuple(
-    date=datetime.datetime.now(), millisecond: bool = False
+    date: typing.Optional[datetime.datetime] = None,
+    millisecond: bool = False
 ) -> str:
     """ get time tuple
     get unix time tuple, default `date` is current time
     Args:
-        date: datetime, default is datetime.datetime.now()
-        millisecond: if True, Use random three digits instead of milliseconds, default id False
+        date: datetime, default is current time from the monotonic clock
+        millisecond: if True, return milliseconds, default is False
     Return:
         a str type value, return unix time of incoming time
     """
-    time_tuple = time.mktime(date.timetuple())
+    if date is None:
+        now = get_monotonic_millis()
+        return str(now if millisecond else now // 1000)
+    time_tuple = time.mktime(date.timetuple()) + date.microsecond / 1e6
     time_tuple = round(time_tuple * 1000) if millisecond else time_tuple
     second = str(int(time_tuple))
     return second
@@ -29,7 +137,7 @@ def parse_params(request: Request) -> typing.Dict[str, typing.Any]:
         request: flask.request 实例对象
     Return: 一个解析过的字典对象，如果没有解析出，则返回一个空的字典对象
     """
-    params = request.values or request.get_json() or {}
+    params = request.values or request.get_json(silent=True) or {}
     print(f"server params: {params}")
     return dict(params)
 
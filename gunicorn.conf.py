@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+""" gunicorn 配置，`gunicorn wsgi:app` 启动时自动加载
+
+默认使用同步 worker；询问接口大部分时间都在等待上游回答，设置
+GUNICORN_WORKER_CLASS=gevent 后每个 worker 进程以协程方式同时处理
+GUNICORN_WORKER_CONNECTIONS 个请求(需要安装 gevent: `poetry install -E gevent`)。
+"""
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:3000")
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+# 默认只有一个 worker 进程：频率限制(memory://)、任务长轮询的唤醒、会话 LRU、
+# 用户等级缓存与压缩缓存都保存在进程内，多个进程之间不共享。
+# 增加 worker 之前需要把 RATELIMIT_STORAGE_URI 配置为 redis:// 等共享存储，
+# 并接受其余进程内缓存各自独立；并发优先使用 gevent worker 提高
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+# 上游超时 + 重试的时间
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+keepalive = 5
+
+# gevent worker 在 worker 进程启动时 monkey patch，应用必须在 patch 之后加载，
+# 否则提前导入的 socket、ssl、threading 仍然是阻塞的版本
+preload_app = False
+
+# 应用按照协程并发数设置数据库连接池，见 GPT_WORKER_CONNECTIONS
+raw_env = [f"GPT_WORKER_CONNECTIONS={worker_connections}"]
+
+
+def post_fork(server, worker):
+    """ 每个 worker 使用不同的可排序ID worker 编号：GUNICORN_WORKER_ID_BASE + worker.age
+    worker.age 在同一个 master 中递增，重启的 worker 也不会与存活的 worker 重复；
+    多副本部署时每个副本设置不同的 GUNICORN_WORKER_ID_BASE，区间之间留出足够的间隔，
+    编号超过 1023 时回绕。应用在 worker 进程中加载(preload_app = False)，从 GPT_WORKER_ID 读取
+    """
+    base = int(os.environ.get("GUNICORN_WORKER_ID_BASE", 0))
+    os.environ["GPT_WORKER_ID"] = str((base + worker.age) % 1024)
+
+
+def post_worker_init(worker):
+    """ worker 加载应用之后预热上游连接
+    """
+    from app.httpclient import start_warmup
+    start_warmup(worker.wsgi)
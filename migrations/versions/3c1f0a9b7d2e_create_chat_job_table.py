@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""create chat_job table
+
+Revision ID: 3c1f0a9b7d2e
+Revises: dafee6eb1cae
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0a9b7d2e'
+down_revision = 'dafee6eb1cae'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'chat_job', sa.Column('job_id', sa.Integer(), nullable=False),
+        sa.Column(
+            'identifier', sa.String(length=32), nullable=False, comment='任务的标识符'
+        ), sa.Column('user_id', sa.Integer(), nullable=False, comment='用户'),
+        sa.Column('params', sa.Text(), nullable=False, comment='询问参数，json格式'),
+        sa.Column(
+            'status',
+            sa.SMALLINT(),
+            nullable=False,
+            comment='状态，0排队中，1执行中，2成功，3失败'
+        ),
+        sa.Column('result', sa.Text(), nullable=True, comment='执行结果，json格式'),
+        sa.Column('error_code', sa.Integer(), nullable=True, comment='错误码'),
+        sa.Column(
+            'error', sa.String(length=256), nullable=True, comment='错误信息'
+        ),
+        sa.Column(
+            'create_at', sa.BigInteger(), nullable=False, comment='创建时间'
+        ),
+        sa.Column(
+            'update_at', sa.BigInteger(), nullable=False, comment='更新时间'
+        ),
+        sa.PrimaryKeyConstraint('job_id'), sa.UniqueConstraint('identifier')
+    )
+    op.create_index(
+        'ix_chat_job_status_update_at',
+        'chat_job', ['status', 'update_at'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_chat_job_status_update_at', table_name='chat_job')
+    op.drop_table('chat_job')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""add indexes for admin filters
+
+Revision ID: 5d7a9c3e1b42
+Revises: 8e4b2d6f1a37
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d7a9c3e1b42'
+down_revision = '8e4b2d6f1a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_conversation_user_id_sid',
+        'conversation', ['user_id', 'sid'],
+        unique=False
+    )
+    op.create_index(
+        'ix_chat_record_conversation_sid',
+        'chat_record', ['conversation', 'sid'],
+        unique=False
+    )
+    op.create_index(
+        'ix_chat_auth_user_idf', 'chat_auth', ['user_idf'], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_chat_auth_user_idf', table_name='chat_auth')
+    op.drop_index('ix_chat_record_conversation_sid', table_name='chat_record')
+    op.drop_index('ix_conversation_user_id_sid', table_name='conversation')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""add sortable ids and millisecond timestamps
+
+Revision ID: 8e4b2d6f1a37
+Revises: 3c1f0a9b7d2e
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8e4b2d6f1a37'
+down_revision = '3c1f0a9b7d2e'
+branch_labels = None
+depends_on = None
+
+# 与 app.utils.ID_EPOCH 一致
+ID_EPOCH = 1672531200000
+# 时间部分左移 22 位(10 位 worker + 12 位序号)，回填时低位使用主键
+ID_SHIFT = 1 << 22
+
+# (表名, 主键, 时间字段, 需要改为 BigInteger 的字段)
+TABLES = [
+    ('user', 'id', 'create_at', ['create_at']),
+    ('conversation', 'cov_id', 'create_at', ['create_at']),
+    ('chat_record', 'chat_id', 'create_at', ['create_at']),
+    ('chat_auth', 'auth_id', 'began_at', ['began_at', 'end_at']),
+]
+
+
+def upgrade():
+    for table, pk, time_column, big_columns in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(
+                sa.Column(
+                    'sid', sa.BigInteger(), nullable=True, comment='可排序的唯一ID'
+                )
+            )
+            for column in big_columns:
+                batch_op.alter_column(
+                    column,
+                    existing_type=sa.Integer(),
+                    type_=sa.BigInteger(),
+                    existing_nullable=False
+                )
+
+        t = sa.table(table, sa.column(pk), sa.column(time_column), sa.column('sid'))
+        if time_column == 'create_at':
+            # 以前的创建时间只精确到秒，同一秒内的记录按照主键先后错开若干毫秒，
+            # 每组中主键最小的一条保持不变。
+            # MySQL 不允许在 UPDATE 的子查询中直接读取同一张表(1093)，
+            # 分组的结果放在派生表中，带 GROUP BY 的派生表会先物化再更新
+            t2 = t.alias('t2')
+            groups = sa.select(
+                t2.c[time_column].label('at'),
+                sa.func.min(t2.c[pk]).label('first_pk'),
+            ).where(t2.c[time_column] % 1000 == 0).group_by(
+                t2.c[time_column]
+            ).subquery('groups')
+            first_pk = sa.select(groups.c.first_pk).where(
+                groups.c.at == t.c[time_column]
+            ).scalar_subquery()
+            op.execute(
+                t.update().where(t.c[time_column] % 1000 == 0).values(
+                    {time_column: t.c[time_column] + t.c[pk] - first_pk}
+                )
+            )
+        op.execute(
+            t.update().values(
+                sid=(t.c[time_column] - ID_EPOCH) * ID_SHIFT + t.c[pk] % ID_SHIFT
+            )
+        )
+
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                'sid', existing_type=sa.BigInteger(), nullable=False
+            )
+            batch_op.create_unique_constraint(f'uq_{table}_sid', ['sid'])
+
+    op.create_index(
+        'ix_chat_record_user_id_sid',
+        'chat_record', ['user_id', 'sid'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_chat_record_user_id_sid', table_name='chat_record')
+    for table, _, _, big_columns in reversed(TABLES):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(f'uq_{table}_sid', type_='unique')
+            batch_op.drop_column('sid')
+            for column in big_columns:
+                batch_op.alter_column(
+                    column,
+                    existing_type=sa.BigInteger(),
+                    type_=sa.Integer(),
+                    existing_nullable=False
+                )
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""add conversation counters and last message preview
+
+Revision ID: a4c8e2f6b913
+Revises: 5d7a9c3e1b42
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a4c8e2f6b913'
+down_revision = '5d7a9c3e1b42'
+branch_labels = None
+depends_on = None
+
+# 与 Conversation.PREVIEW_LENGTH 一致
+PREVIEW_LENGTH = 64
+
+
+def upgrade():
+    with op.batch_alter_table('conversation') as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                'message_count',
+                sa.Integer(),
+                nullable=False,
+                server_default='0',
+                comment='消息数量'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'last_message',
+                sa.String(length=128),
+                nullable=True,
+                comment='最后一条消息的预览'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'last_active_at',
+                sa.BigInteger(),
+                nullable=True,
+                comment='最后活跃时间'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'last_sid',
+                sa.BigInteger(),
+                nullable=True,
+                comment='最后活跃时生成的可排序ID，用于按活跃时间分页'
+            )
+        )
+
+    conversation = sa.table(
+        'conversation', sa.column('cov_id'), sa.column('sid'),
+        sa.column('create_at'), sa.column('message_count'),
+        sa.column('last_message'), sa.column('last_active_at'),
+        sa.column('last_sid')
+    )
+    record = sa.table(
+        'chat_record', sa.column('conversation'), sa.column('content'),
+        sa.column('create_at'), sa.column('sid')
+    )
+    of_conversation = record.c.conversation == conversation.c.cov_id
+    op.execute(
+        conversation.update().values(
+            message_count=sa.select(sa.func.count()).select_from(record).where(
+                of_conversation
+            ).scalar_subquery(),
+            last_sid=sa.func.coalesce(
+                sa.select(sa.func.max(record.c.sid)).where(of_conversation
+                                                          ).scalar_subquery(),
+                conversation.c.sid
+            ),
+            last_active_at=sa.func.coalesce(
+                sa.select(sa.func.max(record.c.create_at)
+                         ).where(of_conversation).scalar_subquery(),
+                conversation.c.create_at
+            ),
+            last_message=sa.select(
+                sa.func.substr(record.c.content, 1, PREVIEW_LENGTH)
+            ).where(of_conversation).order_by(record.c.sid.desc()
+                                             ).limit(1).scalar_subquery(),
+        )
+    )
+
+    with op.batch_alter_table('conversation') as batch_op:
+        batch_op.alter_column(
+            'last_active_at', existing_type=sa.BigInteger(), nullable=False
+        )
+        batch_op.alter_column(
+            'last_sid', existing_type=sa.BigInteger(), nullable=False
+        )
+    op.create_index(
+        'ix_conversation_user_id_last_sid',
+        'conversation', ['user_id', 'last_sid'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_conversation_user_id_last_sid', table_name='conversation')
+    with op.batch_alter_table('conversation') as batch_op:
+        batch_op.drop_column('last_sid')
+        batch_op.drop_column('last_active_at')
+        batch_op.drop_column('last_message')
+        batch_op.drop_column('message_count')
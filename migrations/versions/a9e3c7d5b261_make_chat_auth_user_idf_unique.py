@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""make chat_auth user_idf unique
+
+Revision ID: a9e3c7d5b261
+Revises: f1d6b8a3c574
+Create Date: 2026-10-19 22:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a9e3c7d5b261'
+down_revision = 'f1d6b8a3c574'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 每个用户只保留最早的一条授权，get_auth_by_user_idf 读取的也是这一条
+    op.execute(
+        "DELETE FROM chat_auth WHERE auth_id NOT IN "
+        "(SELECT auth_id FROM (SELECT min(auth_id) AS auth_id FROM chat_auth "
+        "GROUP BY user_idf) AS first_auth)"
+    )
+    op.drop_index('ix_chat_auth_user_idf', table_name='chat_auth')
+    op.create_index(
+        'ix_chat_auth_user_idf', 'chat_auth', ['user_idf'], unique=True
+    )
+
+
+def downgrade():
+    op.drop_index('ix_chat_auth_user_idf', table_name='chat_auth')
+    op.create_index(
+        'ix_chat_auth_user_idf', 'chat_auth', ['user_idf'], unique=False
+    )
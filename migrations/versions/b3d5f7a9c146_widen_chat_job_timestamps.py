@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""widen chat_job timestamps
+
+Revision ID: b3d5f7a9c146
+Revises: a9e3c7d5b261
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b3d5f7a9c146'
+down_revision = 'a9e3c7d5b261'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 毫秒时间戳超出 INT4 的范围，8e4b2d6f1a37 修改其他表的时间字段时漏掉了 chat_job；
+    # 新建的数据库在 3c1f0a9b7d2e 中已经是 BigInteger，这里只修改已有的数据库
+    with op.batch_alter_table('chat_job') as batch_op:
+        for column in ('create_at', 'update_at'):
+            batch_op.alter_column(
+                column,
+                existing_type=sa.Integer(),
+                type_=sa.BigInteger(),
+                existing_nullable=False
+            )
+
+
+def downgrade():
+    # 3c1f0a9b7d2e 已经创建 BigInteger，降级时保持不变
+    pass
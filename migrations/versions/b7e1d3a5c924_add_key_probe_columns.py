@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""add key probe columns
+
+Revision ID: b7e1d3a5c924
+Revises: a4c8e2f6b913
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b7e1d3a5c924'
+down_revision = 'a4c8e2f6b913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_gpt_key') as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                'last_checked_at',
+                sa.BigInteger(),
+                nullable=True,
+                comment='最后检测时间'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'last_error',
+                sa.String(length=256),
+                nullable=True,
+                comment='最后一次检测的错误信息'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'remaining_requests',
+                sa.Integer(),
+                nullable=True,
+                comment='剩余请求次数'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'remaining_tokens',
+                sa.Integer(),
+                nullable=True,
+                comment='剩余 token 数量'
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('chat_gpt_key') as batch_op:
+        batch_op.drop_column('remaining_tokens')
+        batch_op.drop_column('remaining_requests')
+        batch_op.drop_column('last_error')
+        batch_op.drop_column('last_checked_at')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""create usage_rollup table
+
+Revision ID: c2f9a7d4e816
+Revises: b7e1d3a5c924
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c2f9a7d4e816'
+down_revision = 'b7e1d3a5c924'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_record') as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                'model', sa.String(length=64), nullable=True, comment='这一轮使用的模型'
+            )
+        )
+        batch_op.add_column(
+            sa.Column(
+                'tokens',
+                sa.Integer(),
+                nullable=True,
+                comment='这一轮消耗的 token 数量，记录在回答上'
+            )
+        )
+    op.create_table(
+        'usage_rollup', sa.Column('rollup_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False, comment='用户'),
+        sa.Column(
+            'day', sa.Integer(), nullable=False, comment='从 1970-01-01 开始的天数'
+        ),
+        sa.Column(
+            'model',
+            sa.String(length=64),
+            nullable=False,
+            comment='模型，历史记录为空字符串'
+        ),
+        sa.Column('message_count', sa.Integer(), nullable=False, comment='消息数量'),
+        sa.Column(
+            'prompt_chars', sa.BigInteger(), nullable=False, comment='提问的字符数'
+        ),
+        sa.Column(
+            'completion_chars',
+            sa.BigInteger(),
+            nullable=False,
+            comment='回答的字符数'
+        ),
+        sa.Column('tokens', sa.BigInteger(), nullable=False, comment='token 数量'),
+        sa.PrimaryKeyConstraint('rollup_id'),
+        sa.UniqueConstraint(
+            'user_id', 'day', 'model', name='uq_usage_rollup_user_id_day_model'
+        )
+    )
+
+
+def downgrade():
+    op.drop_table('usage_rollup')
+    with op.batch_alter_table('chat_record') as batch_op:
+        batch_op.drop_column('tokens')
+        batch_op.drop_column('model')
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""create idempotency_key table
+
+Revision ID: c6e8a2d4f917
+Revises: b3d5f7a9c146
+Create Date: 2026-10-20 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c6e8a2d4f917'
+down_revision = 'b3d5f7a9c146'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_key', sa.Column('key_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False, comment='用户'),
+        sa.Column(
+            'key', sa.String(length=255), nullable=False, comment='Idempotency-Key'
+        ),
+        sa.Column(
+            'fingerprint',
+            sa.String(length=64),
+            nullable=False,
+            comment='请求参数的摘要'
+        ),
+        sa.Column(
+            'status', sa.SMALLINT(), nullable=False, comment='状态，0处理中，1成功'
+        ),
+        sa.Column(
+            'result', sa.Text(), nullable=True, comment='返回的报文内容，json格式'
+        ),
+        sa.Column(
+            'create_at', sa.BigInteger(), nullable=False, comment='开始处理的时间'
+        ),
+        sa.Column(
+            'expire_at',
+            sa.BigInteger(),
+            nullable=False,
+            comment='租约或者结果的过期时间'
+        ),
+        sa.PrimaryKeyConstraint('key_id'),
+        sa.UniqueConstraint(
+            'user_id', 'key', name='uq_idempotency_key_user_id_key'
+        )
+    )
+    op.create_index(
+        'ix_idempotency_key_expire_at',
+        'idempotency_key', ['expire_at'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_expire_at', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""add chat_auth tier
+
+Revision ID: d8a3f5c1e027
+Revises: c2f9a7d4e816
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd8a3f5c1e027'
+down_revision = 'c2f9a7d4e816'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_auth') as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                'tier',
+                sa.String(length=32),
+                nullable=True,
+                comment='限流档位，为空时使用默认限制'
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('chat_auth') as batch_op:
+        batch_op.drop_column('tier')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""add chat_record status
+
+Revision ID: e4b7c9a2d153
+Revises: d8a3f5c1e027
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7c9a2d153'
+down_revision = 'd8a3f5c1e027'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_record') as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                'status',
+                sa.SMALLINT(),
+                nullable=False,
+                server_default='0',
+                comment='状态，0正常，1客户端断开后中止(只记录在问题上)'
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('chat_record') as batch_op:
+        batch_op.drop_column('status')
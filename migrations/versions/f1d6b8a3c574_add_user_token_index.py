@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""add user token index
+
+Revision ID: f1d6b8a3c574
+Revises: e4b7c9a2d153
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f1d6b8a3c574'
+down_revision = 'e4b7c9a2d153'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_user_token', 'user', ['token'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_token', table_name='user')
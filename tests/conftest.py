@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from flask import Flask
+
+from app.querystats import QueryStats, count_queries
+
+
+class _Server(ThreadingHTTPServer):
+    # 默认的监听队列只有 5，并发测试时连接会被丢弃后重试
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeUpstream(object):
+    """ 本地的 OpenAI 兼容服务，用于模拟不同延迟、错误的上游
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        status: int = 200,
+        key_errors: typing.Optional[typing.Dict[str, typing.Tuple[int, str]]] = None,
+        chunk_delay: float = 0.0,
+    ) -> None:
+        self.latency = latency
+        # 流式回答每个片段之间的间隔，大于 0 时逐个片段写出
+        self.chunk_delay = chunk_delay
+        # 流式回答写出的片段数量，以及写到一半连接被调用方关闭的次数
+        self.chunks_sent = 0
+        self.aborted = 0
+        self.status = status
+        # key -> (状态码, 错误码)
+        self.key_errors = key_errors or {}
+        self.requests: typing.List[typing.Dict[str, typing.Any]] = []
+        # 预热时建立的连接
+        self.connections: typing.Set[typing.Tuple[str, int]] = set()
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeUpstream":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self) -> typing.Type[BaseHTTPRequestHandler]:
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 支持 keep-alive，所有回复都带有 Content-Length
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: typing.Any) -> None:
+                pass
+
+            def _reply(
+                self,
+                payload: typing.Dict[str, typing.Any],
+                status: typing.Optional[int] = None,
+                headers: typing.Optional[typing.Dict[str, str]] = None,
+            ) -> None:
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status or upstream.status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _reply_stream(
+                self,
+                content: str,
+                usage: typing.Optional[typing.Dict[str, int]] = None,
+            ) -> None:
+                """ 按照 server-sent events 逐字返回回答，传入 usage 时最后返回用量
+                """
+                events = [
+                    {"choices": [{"index": 0, "delta": {"role": "assistant"}}]}
+                ] + [
+                    {"choices": [{"index": 0, "delta": {"content": c}}]}
+                    for c in content
+                ]
+                if usage is not None:
+                    events.append({"choices": [], "usage": usage})
+                chunks = [f"data: {json.dumps(e)}\n\n" for e in events]
+                chunks.append("data: [DONE]\n\n")
+                if upstream.chunk_delay > 0:
+                    self._write_chunks(chunks)
+                    return
+                data = "".join(chunks).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_chunks(self, chunks: typing.List[str]) -> None:
+                """ 不带 Content-Length 逐个写出片段，写完后关闭连接
+                """
+                self.close_connection = True
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    for chunk in chunks:
+                        time.sleep(upstream.chunk_delay)
+                        self.wfile.write(chunk.encode("utf-8"))
+                        self.wfile.flush()
+                        with upstream._lock:
+                            upstream.chunks_sent += 1
+                except (BrokenPipeError, ConnectionResetError):
+                    with upstream._lock:
+                        upstream.aborted += 1
+
+            def _enter(self, body: typing.Any = None) -> None:
+                with upstream._lock:
+                    upstream.requests.append(
+                        {
+                            "path": self.path,
+                            "headers": dict(self.headers),
+                            "body": body,
+                            "client": self.client_address,
+                        }
+                    )
+                    upstream.inflight += 1
+                    upstream.max_inflight = max(
+                        upstream.max_inflight, upstream.inflight
+                    )
+
+            def do_HEAD(self) -> None:
+                with upstream._lock:
+                    upstream.connections.add(self.client_address)
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self) -> None:
+                self._enter()
+                try:
+                    time.sleep(upstream.latency)
+                    key = self.headers.get("Authorization", "")[len("Bearer "):]
+                    if upstream.status != 200:
+                        self._reply(
+                            {"error": {"message": "fake upstream error"}}
+                        )
+                        return
+                    if key in upstream.key_errors:
+                        status, code = upstream.key_errors[key]
+                        self._reply(
+                            {"error": {"message": "fake key error", "code": code}},
+                            status=status,
+                        )
+                        return
+                    self._reply(
+                        {"object": "list", "data": [{"id": "gpt-3.5-turbo"}]},
+                        headers={"x-ratelimit-remaining-requests": "99"},
+                    )
+                finally:
+                    with upstream._lock:
+                        upstream.inflight -= 1
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                self._enter(body)
+                try:
+                    time.sleep(upstream.latency)
+                    key = self.headers.get("Authorization", "")[len("Bearer "):]
+                    if upstream.status != 200:
+                        self._reply(
+                            {"error": {"message": "fake upstream error"}}
+                        )
+                        return
+                    if key in upstream.key_errors:
+                        status, code = upstream.key_errors[key]
+                        self._reply(
+                            {"error": {"message": "fake key error", "code": code}},
+                            status=status,
+                        )
+                        return
+                    prompt = body["messages"][-1]["content"]
+                    usage = {
+                        "prompt_tokens": len(prompt),
+                        "completion_tokens": len(prompt) + 4,
+                        "total_tokens": len(prompt) * 2 + 4,
+                    }
+                    if body.get("stream"):
+                        include_usage = (
+                            body.get("stream_options") or {}
+                        ).get("include_usage")
+                        self._reply_stream(
+                            f" 回答: {prompt} ", usage if include_usage else None
+                        )
+                        return
+                    self._reply(
+                        {
+                            "id": "chatcmpl-fake",
+                            "object": "chat.completion",
+                            "model": body.get("model"),
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": f" 回答: {prompt} ",
+                                    },
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": usage,
+                        }
+                    )
+                finally:
+                    with upstream._lock:
+                        upstream.inflight -= 1
+
+        return Handler
+
+
+@pytest.fixture
+def fake_upstream() -> typing.Iterator[typing.Callable[..., FakeUpstream]]:
+    """ 创建本地上游服务的工厂，测试结束后自动关闭
+    """
+    started: typing.List[FakeUpstream] = []
+
+    def factory(latency: float = 0.0, status: int = 200,
+                **kwargs: typing.Any) -> FakeUpstream:
+        upstream = FakeUpstream(latency=latency, status=status, **kwargs).start()
+        started.append(upstream)
+        return upstream
+
+    yield factory
+    for upstream in started:
+        upstream.stop()
+
+
+@pytest.fixture
+def query_budget() -> typing.Callable[..., typing.ContextManager[QueryStats]]:
+    """ 断言代码块执行的 SQL 数量不超过预算，超出时列出执行过的语句
+
+        with query_budget(app, 3):
+            client.get(...)
+    """
+
+    @contextlib.contextmanager
+    def budget(app: Flask, max_queries: int) -> typing.Iterator[QueryStats]:
+        with count_queries(app) as stats:
+            yield stats
+        assert stats.count <= max_queries, stats.report()
+
+    return budget
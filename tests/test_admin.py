@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import typing
+
+import pytest
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app
+from app.admin import create_admin_app
+
+
+@pytest.fixture
+def admin_client(tmp_path) -> FlaskClient:
+    """ 使用文件数据库，配置了独立连接池的管理后台也能看到主应用写入的数据
+    """
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'admin.sqlite'}",
+    })
+    from app.ext import db
+    from app.model import ChatRecord, Conversation, User
+    with app.app_context():
+        db.create_all()
+        admin = User(
+            email="admin@email.com", password=User.transform_password("admin")
+        )
+        admin.identifier = app.config["ADMIN_USER_IDENTIFIER"]
+        user = User(email="test@email.com", password=None)
+        db.session.add_all([admin, user])
+        db.session.commit()
+        for _ in range(2):
+            conversation = Conversation(user=user)
+            db.session.add(conversation)
+            db.session.flush()
+            for i in range(60):
+                db.session.add(
+                    ChatRecord(
+                        user=user,
+                        content=f"record-{conversation.cov_id}-{i} " + "x" * 200,
+                        conversation=conversation,
+                    )
+                )
+        db.session.commit()
+    with app.test_client() as client:
+        client.post(
+            "/auth/admin_login_form/",
+            data={
+                "email": "admin@email.com",
+                "password": "admin"
+            }
+        )
+        yield client
+
+
+def _record_sids(client: FlaskClient, **filters: typing.Any) -> typing.List[int]:
+    from app.model import ChatRecord
+    with client.application.app_context():
+        query = ChatRecord.query.filter_by(**filters)
+        return [r.sid for r in query.order_by(ChatRecord.sid.desc())]
+
+
+def test_admin_chat_record_keyset_pages(admin_client: FlaskClient):
+    sids = _record_sids(admin_client)
+    offsets: typing.List[int] = []
+
+    def record(conn, cursor, statement, parameters, *args):
+        # sqlite 总是生成 LIMIT ? OFFSET ?，最后一个参数是 offset
+        if "ORDER BY chat_record.sid DESC" in statement:
+            offsets.append(parameters[-1])
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        first = admin_client.get("/admin/chatrecord/")
+        second = admin_client.get("/admin/chatrecord/?page=1")
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+    assert first.status_code == 200
+    html = first.get_data(as_text=True)
+    assert str(sids[0]) in html and str(sids[50]) not in html
+    # 聊天内容被截断
+    assert "x" * 200 not in html and "x" * 60 + "..." in html
+
+    html = second.get_data(as_text=True)
+    assert str(sids[50]) in html and str(sids[49]) not in html
+    assert offsets == [0, 0]
+
+
+def test_admin_chat_record_filters(admin_client: FlaskClient):
+    from app.model import Conversation
+    with admin_client.application.app_context():
+        cov_id = Conversation.query.order_by(Conversation.cov_id).first().cov_id
+    sids = _record_sids(admin_client, conversation=cov_id)
+    others = _record_sids(admin_client)
+
+    html = admin_client.get(f"/admin/chatrecord/?flt0_1={cov_id}"
+                           ).get_data(as_text=True)
+    assert str(sids[0]) in html and str(others[0]) not in html
+
+    html = admin_client.get(
+        "/admin/chatrecord/?flt0_4=2000-01-01+00:00:00"
+    ).get_data(as_text=True)
+    assert str(others[0]) not in html
+    html = admin_client.get(
+        "/admin/chatrecord/?flt0_3=2000-01-01+00:00:00"
+    ).get_data(as_text=True)
+    assert str(others[0]) in html
+
+
+def test_admin_conversation_and_auth_views(admin_client: FlaskClient):
+    assert admin_client.get("/admin/conversation/").status_code == 200
+    assert admin_client.get("/admin/chatauth/").status_code == 200
+    assert admin_client.get("/admin/chatgptkey/").status_code == 200
+
+
+def test_admin_upstream_status(admin_client: FlaskClient):
+    body = admin_client.get("/admin/upstreams/").json["data"]
+    assert "default" in body["upstreams"]
+    assert body["breakers"] == {}
+
+
+@pytest.mark.parametrize("options, shared", [({}, True),
+                                             ({"pool_pre_ping": True}, False)])
+def test_admin_engine(tmp_path, options: typing.Dict, shared: bool):
+    from app.ext import db
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'engine.sqlite'}",
+        "ADMIN_SQLALCHEMY_ENGINE_OPTIONS": options,
+    })
+    admin_app = create_admin_app(app)
+    with app.app_context():
+        engine = db.engine
+    with admin_app.app_context():
+        # 没有单独配置时共用主应用的连接池
+        assert (db.engine is engine) == shared
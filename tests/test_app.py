@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+
+
+def test_create_app_is_lazy():
+    code = """
+import sys
+from app import create_app
+app = create_app({"TESTING": True})
+lazy = ["flask_admin", "flask_migrate", "openai"]
+assert not [m for m in lazy if m in sys.modules], [m for m in lazy if m in sys.modules]
+response = app.test_client().get("/admin/")
+assert response.status_code == 302, response.status_code
+assert response.headers["Location"].endswith("/auth/admin_login/")
+assert "flask_admin" in sys.modules
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_startup_profile_command():
+    from app import create_app
+    app = create_app({"TESTING": True})
+    result = app.test_cli_runner().invoke(args=["startup-profile"])
+    assert result.exit_code == 0
+    assert "blueprint" in result.output
+    assert "openai" in result.output
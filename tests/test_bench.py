@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import json
+
+from sqlalchemy import func
+
+from app import create_app
+from app.bench import compare_results, run_benchmarks, seed_dataset
+
+
+def test_bench_seed_and_run(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'bench.sqlite'}",
+    })
+    from app.ext import db
+    from app.model import ChatRecord, Conversation, User
+    with app.app_context():
+        db.create_all()
+        stats = seed_dataset(users=50, records=400, batch_size=64, echo=lambda _: None)
+        assert stats["users"] == 50 and stats["records"] == 400
+        assert db.session.query(func.count(ChatRecord.chat_id)).scalar() == 400
+        assert db.session.query(
+            func.sum(Conversation.message_count)
+        ).scalar() == 400
+        counts = sorted(
+            (count for _, count in db.session.query(
+                ChatRecord.user_id, func.count(ChatRecord.chat_id)
+            ).group_by(ChatRecord.user_id)),
+            reverse=True,
+        )
+        # 按 Zipf 分布，聊天最多的用户远多于平均数
+        assert counts[0] > 400 / 50 * 3
+        # 会话的统计与聊天记录一致
+        conversation = Conversation.query.order_by(
+            Conversation.message_count.desc()
+        ).first()
+        records = ChatRecord.get_conversation_history(conversation.cov_id, 1000)
+        assert len(records) == conversation.message_count
+        assert records[-1].sid == conversation.last_sid
+        assert records[-1].content.startswith(conversation.last_message)
+
+        # 再次生成的数据接在已有数据之后
+        seed_dataset(users=5, records=10, seed=1, echo=lambda _: None)
+        assert db.session.query(func.count(User.id)).scalar() == 55
+
+        report = run_benchmarks(iterations=5, samples=4)
+    assert report["dialect"] == "sqlite"
+    assert report["rows"]["records"] == 410
+    assert "chat_record.records_by_user_before_sid" in report["results"]
+    assert report["results"]["user.token_lookup"]["rows"] == 1
+    assert all(r["p50_ms"] >= 0 for r in report["results"].values())
+    lines = compare_results(json.loads(json.dumps(report)), report)
+    assert lines[1].endswith("+0.0%")
+
+
+def test_bench_cli(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'bench.sqlite'}",
+    })
+    from app.ext import db
+    with app.app_context():
+        db.create_all()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["bench", "seed", "--users", "10", "--records", "60"])
+    assert result.exit_code == 0, result.output
+    output = tmp_path / "bench.json"
+    result = runner.invoke(
+        args=[
+            "bench", "run", "--iterations", "3", "--only", "user.token_lookup",
+            "--output", str(output)
+        ]
+    )
+    assert result.exit_code == 0, result.output
+    with open(output, encoding="utf-8") as f:
+        assert list(json.load(f)["results"]) == ["user.token_lookup"]
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+
+import pytest
+
+from app.breaker import BreakerRegistry, CircuitBreaker, CircuitOpenError
+from app.router import UpstreamRouter
+from app.upstream import Upstream
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def _router(*upstreams: Upstream, **options) -> UpstreamRouter:
+    options.setdefault("min_requests", 2)
+    options.setdefault("open_seconds", 30)
+    return UpstreamRouter(
+        routes={"gpt-3.5-turbo": list(upstreams)},
+        explore_ratio=0.0,
+        rand=random.Random(0),
+        breakers=BreakerRegistry(**options),
+    )
+
+
+def _ask(router: UpstreamRouter, api_key: str = "sk-test"):
+    return router.create_chat_completion(
+        model="gpt-3.5-turbo",
+        messages=MESSAGES,
+        max_tokens=16,
+        temperature=0.2,
+        api_key=api_key,
+    )
+
+
+def test_breaker_state_machine():
+    breaker = CircuitBreaker(
+        "test", min_requests=2, error_rate=0.5, open_seconds=0.1,
+        half_open_calls=2
+    )
+    assert breaker.allow()
+    breaker.record(ok=False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    breaker.record(ok=False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert not breaker.available()
+
+    time.sleep(0.12)
+    # 半开状态最多放行两个试探请求
+    assert breaker.available()
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()
+    breaker.record(ok=True)
+    breaker.record(ok=False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.12)
+    assert breaker.allow() and breaker.allow()
+    breaker.record(ok=True)
+    breaker.release()
+    assert breaker.allow()
+    breaker.record(ok=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.to_json()["opened"] == 2
+
+
+def test_breaker_fails_fast_when_upstream_is_down(fake_upstream):
+    broken = fake_upstream(status=500)
+    router = _router(Upstream(name="broken", api_base=broken.api_base))
+    for _ in range(2):
+        with pytest.raises(Exception):
+            _ask(router)
+    assert not router.is_available("gpt-3.5-turbo")
+    began = time.perf_counter()
+    with pytest.raises(CircuitOpenError) as e:
+        _ask(router)
+    assert time.perf_counter() - began < 0.05
+    assert e.value.retry_after > 0
+    # 熔断之后不再请求上游
+    assert len(broken.requests) == 2
+    status = router.status()["breakers"]["upstream:broken"]
+    assert status["state"] == "open"
+    assert status["rejected"] == 1
+
+
+def test_breaker_counts_slow_calls(fake_upstream):
+    slow = fake_upstream(latency=0.1)
+    fast = fake_upstream()
+    router = _router(
+        Upstream(name="slow", api_base=slow.api_base),
+        Upstream(name="fast", api_base=fast.api_base),
+        slow_call_seconds=0.05,
+    )
+    router.stats["fast"].update(1.0, True, 1.0)
+    for _ in range(2):
+        assert _ask(router)["choices"]
+    assert router.upstream_breaker(router.routes["gpt-3.5-turbo"][0]).state == "open"
+    # 慢的上游被熔断后请求转到另一个上游
+    _ask(router)
+    assert len(slow.requests) == 2
+    assert len(fast.requests) == 1
+
+
+def test_breaker_skips_broken_key(fake_upstream):
+    upstream = fake_upstream(key_errors={"sk-bad": (401, "invalid_api_key")})
+    router = _router(
+        Upstream(
+            name="pool", api_base=upstream.api_base, keys=["sk-bad", "sk-good"]
+        )
+    )
+    for _ in range(6):
+        try:
+            _ask(router)
+        except Exception:
+            pass
+    keys = [r["headers"]["Authorization"] for r in upstream.requests]
+    assert keys.count("Bearer sk-bad") == 2
+    assert keys[-2:] == ["Bearer sk-good", "Bearer sk-good"]
+    # key 的错误不影响上游的熔断器
+    assert router.upstream_breaker(router.routes["gpt-3.5-turbo"][0]).state == "closed"
+
+    router.key_breaker("sk-fallback")
+    assert router.open_keys() == ["sk-bad"]
+
+
+def test_breaker_open_returns_503(tmp_path):
+    from app import create_app
+    from app.ext import db
+    from app.model import User
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'breaker.sqlite'}",
+        "GPT_BREAKER_MIN_REQUESTS": 2,
+    })
+    with app.app_context():
+        db.create_all()
+        user = User(email="breaker@email.com", password=None)
+        user.token = "breaker-token"
+        db.session.add(user)
+        db.session.commit()
+    router = app.extensions["gpt_router"]
+    breaker = router.upstream_breaker(router.upstreams_for("gpt-3.5-turbo")[0])
+    for _ in range(2):
+        breaker.allow()
+        breaker.record(ok=False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    client = app.test_client()
+    headers = {"Authorization": "Token breaker-token"}
+    for path, body, extra in (
+        ("/gpt/competion/", {"messages": MESSAGES}, {}),
+        ("/gpt/competion/", {"messages": MESSAGES}, {"Idempotency-Key": "k1"}),
+        ("/gpt/competion/batch/", {"prompts": ["你好"]}, {}),
+    ):
+        response = client.post(path, headers={**headers, **extra}, json=body)
+        assert response.status_code == 503
+        assert response.json["code"] == 503
+        assert 1 <= int(response.headers["Retry-After"]) <= 30
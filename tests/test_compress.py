@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import zlib
+
+from flask import Response
+from werkzeug.datastructures import Accept
+
+from app import create_app
+from app.bench import seed_dataset
+from app.compress import StreamCompressor, get_cache, negotiate
+
+
+def test_negotiate_encoding():
+    accept = Accept([("gzip", 1), ("br", 1), ("zstd", 0.5)])
+    assert negotiate(accept, ["br", "zstd", "gzip"]) == "br"
+    assert negotiate(accept, ["zstd", "gzip"]) == "gzip"
+    assert negotiate(Accept([("*", 1), ("gzip", 0)]), ["gzip"]) is None
+    assert negotiate(Accept([("identity", 1)]), ["br", "gzip"]) is None
+
+
+def test_stream_compressor_flushes_each_chunk():
+    compressor = StreamCompressor("gzip", 1)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for line in ["第一行\n", "第二行\n"]:
+        # 每个分块单独可以解压，不需要等待后面的数据
+        assert decompressor.decompress(compressor.compress(line.encode())) == line.encode()
+    decompressor.decompress(compressor.finish())
+    assert decompressor.eof
+
+
+def test_compress_responses(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'compress.sqlite'}",
+    })
+    from app.ext import db
+    from app.model import User
+
+    @app.route("/test/stream/")
+    def stream():
+        return Response(
+            (f"{i}\n" for i in range(3)), mimetype="application/x-ndjson"
+        )
+
+    with app.app_context():
+        db.create_all()
+        seed_dataset(users=1, records=40, echo=lambda _: None)
+        token = User.query.first().token
+    client = app.test_client()
+    headers = {"Authorization": f"Token {token}", "Accept-Encoding": "gzip"}
+
+    response = client.post(
+        "/gpt/chat_records/", headers=headers, json={"limit": 20}
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = gzip.decompress(response.data)
+    assert len(json.loads(body)["data"]) == 20
+    assert int(response.headers["Content-Length"]) == len(response.data) < len(body)
+
+    # 小的响应不压缩
+    response = client.get("/auth/info/", headers=headers)
+    assert "Content-Encoding" not in response.headers
+    assert response.json["code"] == 200
+
+    # 按 sid 向前翻页的结果缓存，第二次直接使用缓存的压缩结果
+    before = json.loads(body)["data"][-1]["sid"]
+    pages = [
+        client.post(
+            "/gpt/chat_records/",
+            headers=headers,
+            json={"limit": 10, "before": before}
+        ).data for _ in range(2)
+    ]
+    assert pages[0] == pages[1]
+    with app.app_context():
+        cache = get_cache()
+        assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+
+    response = client.get("/test/stream/", headers=headers)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert gzip.decompress(response.data) == b"0\n1\n2\n"
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from app import create_app
+from app.disconnect import DisconnectWatcher, is_disconnected
+
+
+@pytest.fixture
+def live_server(tmp_path, fake_upstream):
+    upstream = fake_upstream(chunk_delay=0.05)
+    app = create_app({
+        "TESTING": False,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'disconnect.sqlite'}",
+        "GPT_UPSTREAMS": {
+            "*": [{
+                "name": "fake",
+                "api_base": upstream.api_base,
+                "keys": ["sk-fake"]
+            }]
+        },
+        "GPT_SIMCACHE_ENABLED": False,
+        "GPT_KEY_PROBE_INTERVAL": 0,
+        "GPT_DISCONNECT_CHECK_INTERVAL": 0,
+    })
+    from app.ext import db
+    from app.model import ChatGPTKey, User
+    with app.app_context():
+        db.create_all()
+        user = User(email="disconnect@email.com", password=None)
+        user.token = "disconnect-token"
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(ChatGPTKey(user_id=user.id, app_key="sk-disconnect"))
+        db.session.commit()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, upstream, server.server_port
+    server.shutdown()
+
+
+def _wait(predicate, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_is_disconnected():
+    server, client = socket.socketpair()
+    try:
+        watcher = DisconnectWatcher(server, interval=0)
+        assert not watcher()
+        # keep-alive 的下一个请求不是断开
+        client.sendall(b"GET")
+        assert not is_disconnected(server)
+        assert server.recv(3) == b"GET"
+        client.close()
+        assert watcher()
+        assert watcher.disconnected
+    finally:
+        server.close()
+
+
+def test_abort_on_disconnect(live_server):
+    app, upstream, port = live_server
+    body = json.dumps(
+        {"messages": [{"role": "user", "content": "慢" * 40}]}
+    ).encode("utf-8")
+    client = socket.create_connection(("127.0.0.1", port))
+    client.sendall(
+        b"POST /gpt/competion/ HTTP/1.1\r\n"
+        b"Host: 127.0.0.1\r\n"
+        b"Authorization: Token disconnect-token\r\n"
+        b"Content-Type: application/json\r\n"
+        + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+        + body
+    )
+    assert _wait(lambda: upstream.chunks_sent > 0)
+    client.close()
+
+    from app.model import ChatGPTKey, ChatRecord
+
+    def aborted() -> bool:
+        with app.app_context():
+            records = ChatRecord.query.all()
+            return len(records) == 1 and records[0].status == ChatRecord.STATUS_ABORTED
+
+    assert _wait(aborted)
+    with app.app_context():
+        key = ChatGPTKey.query.filter_by(content="sk-disconnect").first()
+        assert key.occupy_uid is None
+        assert ChatRecord.query.filter_by(role=0).count() == 0
+    # 上游的连接被关闭，没有写完全部的片段
+    assert _wait(lambda: upstream.aborted == 1)
+    assert upstream.chunks_sent < 42
+
+
+def test_abort_capable_path_keeps_tokens(live_server):
+    app, upstream, port = live_server
+    from app import router
+    from app.model import ChatRecord, UsageRollup
+
+    def ask(prompt: str) -> None:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        connection.request(
+            "POST",
+            "/gpt/competion/",
+            body=json.dumps({"messages": [{"role": "user", "content": prompt}]}),
+            headers={
+                "Authorization": "Token disconnect-token",
+                "Content-Type": "application/json",
+            },
+        )
+        response = connection.getresponse()
+        assert json.loads(response.read())["code"] == 200
+        connection.close()
+        # 可以中止的询问使用流式请求
+        assert upstream.requests[-1]["body"]["stream"] is True
+
+    # 上游在最后一个片段返回用量
+    ask("你好")
+    assert upstream.requests[-1]["body"]["stream_options"] == {"include_usage": True}
+    with app.app_context():
+        answer = ChatRecord.query.filter_by(role=0).one()
+        assert answer.tokens == len("你好") * 2 + 4
+        assert UsageRollup.query.one().tokens == answer.tokens
+
+    # 上游不支持 stream_options 时按照内容估算
+    with app.app_context():
+        router.get_router().routes["*"][0].stream_usage = False
+    ask("再见")
+    assert "stream_options" not in upstream.requests[-1]["body"]
+    with app.app_context():
+        answer = ChatRecord.query.filter_by(role=0).order_by(
+            ChatRecord.chat_id.desc()
+        ).first()
+        assert answer.tokens > 0
+        assert UsageRollup.query.one().tokens == len("你好") * 2 + 4 + answer.tokens
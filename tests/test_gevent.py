@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("gevent")
+
+SERVER = """
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import sys
+
+from gevent.pywsgi import WSGIServer
+
+from app import create_app
+from app.ext import db
+from app.model import ChatGPTKey, User
+
+app = create_app(json.loads(sys.argv[1]))
+assert app.config["GPT_COOPERATIVE"]
+with app.app_context():
+    db.create_all()
+    user = User(email="gevent@email.com", password=None)
+    user.token = "gevent-token"
+    db.session.add(user)
+    db.session.commit()
+    db.session.add(ChatGPTKey(user_id=user.id, app_key="sk-gevent"))
+    db.session.commit()
+
+server = WSGIServer(("127.0.0.1", 0), app, log=None)
+server.start()
+with open(sys.argv[2], "w") as f:
+    f.write(str(server.server_port))
+server.serve_forever()
+"""
+
+
+def test_gevent_worker_concurrency(tmp_path, fake_upstream):
+    """ 一个 gevent 进程可以同时等待多个上游回答，
+    连接池(2 + 2)小于并发数，说明等待上游期间没有占用数据库连接
+    """
+    concurrency = 10
+    upstream = fake_upstream(latency=1.0)
+    config = {
+        "TESTING": False,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'gevent.sqlite'}",
+        "GPT_UPSTREAMS": {
+            "*": [{
+                "name": "fake",
+                "api_base": upstream.api_base,
+                "keys": ["sk-fake"]
+            }]
+        },
+        "GPT_SIMCACHE_ENABLED": False,
+        "GPT_KEY_PROBE_INTERVAL": 0,
+        "GPT_WORKER_CONNECTIONS": concurrency,
+        "GPT_DB_POOL_MAX_SIZE": 2,
+        "SQLALCHEMY_ENGINE_OPTIONS": {"pool_timeout": 0.5},
+    }
+    port_file = tmp_path / "port"
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER, json.dumps(config), str(port_file)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            if port_file.exists() and port_file.read_text():
+                break
+            assert server.poll() is None
+            time.sleep(0.1)
+        port = int(port_file.read_text())
+
+        def ask(i: int) -> dict:
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{port}/gpt/competion/",
+                data=json.dumps({
+                    "messages": [{
+                        "role": "user",
+                        "content": f"问题 {i}"
+                    }]
+                }).encode("utf-8"),
+                headers={
+                    "Authorization": "Token gevent-token",
+                    "Content-Type": "application/json",
+                },
+            )
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.loads(response.read())
+
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(ask, range(concurrency)))
+        elapsed = time.perf_counter() - began
+    finally:
+        server.terminate()
+        server.wait()
+
+    assert [r["code"] for r in results] == [200] * concurrency, results
+    assert sorted(r["data"]["content"] for r in results) == sorted(
+        f"回答: 问题 {i}" for i in range(concurrency)
+    )
+    assert upstream.max_inflight == concurrency
+    assert elapsed < concurrency * upstream.latency / 2
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import time
 import typing
 import pytest
 from flask.testing import FlaskClient
@@ -10,14 +11,11 @@ def test_config():
     assert create_app({'TESTING': True}).testing
 
 
-@pytest.fixture
-def client() -> FlaskClient:
-    app = create_app(
-        {
-            'TESTING': True,
-            "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
-        }
-    )
+def _create_test_app(database_uri: str):
+    app = create_app({
+        'TESTING': True,
+        "SQLALCHEMY_DATABASE_URI": database_uri,
+    })
     from app.model import User
     from app.ext import db
     with app.app_context():
@@ -34,14 +32,26 @@ def client() -> FlaskClient:
             user = User(email="test_02@email.com", password=None)
             db.session.add(user)
             db.session.commit()
+    return app
+
 
+@pytest.fixture
+def client() -> FlaskClient:
+    app = _create_test_app("sqlite:///:memory:")
     with app.test_client() as client:
         yield client
 
 
 @pytest.fixture
-def login_in_token(client: FlaskClient) -> typing.Optional[str]:
-    from app.model import User
+def file_client(tmp_path) -> FlaskClient:
+    """ 使用文件数据库，每个线程拥有独立的连接，用于后台线程写库的测试
+    """
+    app = _create_test_app(f"sqlite:///{tmp_path / 'test.sqlite'}")
+    with app.test_client() as client:
+        yield client
+
+
+def _login(client: FlaskClient) -> typing.Optional[str]:
     response = client.post(
         '/auth/login/', json={
             "email": "test@email.com",
@@ -52,6 +62,11 @@ def login_in_token(client: FlaskClient) -> typing.Optional[str]:
     return token
 
 
+@pytest.fixture
+def login_in_token(client: FlaskClient) -> typing.Optional[str]:
+    return _login(client)
+
+
 def test_auth_login_no_password(client: FlaskClient):
     response = client.post('/auth/login/', json={
         "email": "test@email.com",
@@ -141,10 +156,11 @@ def test_chat_records(client: FlaskClient, login_in_token: str):
     )
     content = response.json["data"]
     print(f"content: {content}")
-    assert content[0]["content"] == "hello"
-    assert content[0]["create_at"] <= content[1]["create_at"]
-    assert content[0]["role"] == 1
-    assert content[1]["role"] == 0
+    # 从新到旧，回答在问题之前
+    assert content[1]["content"] == "hello"
+    assert content[0]["create_at"] >= content[1]["create_at"]
+    assert content[0]["role"] == 0
+    assert content[1]["role"] == 1
     assert len(content) == 2
 
 
@@ -199,3 +215,661 @@ def test_gpt_chat_prompt_multy(client: FlaskClient, login_in_token: str):
     print(f"response: {response.json}")
     content = response.json["data"]
     assert len(content) > 2
+
+
+def test_gpt_batch(client: FlaskClient, login_in_token: str):
+    import json
+    prompts = [
+        "你好", "hello", {
+            "messages": [{
+                "role": "user",
+                "content": "こんにちは"
+            }]
+        }
+    ]
+    response = client.post(
+        '/gpt/competion/batch/',
+        headers={'Authorization': f"Token {login_in_token}"},
+        json={'prompts': prompts}
+    )
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1, 2]
+    for line in lines:
+        assert line["content"]
+        assert line["conversation"]
+
+    response = client.post(
+        '/gpt/chat_records/',
+        headers={'Authorization': f"Token {login_in_token}"},
+        json={
+            'limit': 10,
+            'page': 0
+        }
+    )
+    assert len(response.json["data"]) == 6
+
+
+def test_gpt_batch_empty(client: FlaskClient, login_in_token: str):
+    response = client.post(
+        '/gpt/competion/batch/',
+        headers={'Authorization': f"Token {login_in_token}"},
+        json={'prompts': []}
+    )
+    assert response.json["code"] == 400
+
+
+def test_gpt_job(file_client: FlaskClient):
+    client = file_client
+    login_in_token = _login(client)
+    headers = {'Authorization': f"Token {login_in_token}"}
+    response = client.post(
+        '/gpt/jobs/',
+        headers=headers,
+        json={'messages': [{
+            "role": "user",
+            "content": "你好"
+        }]}
+    )
+    assert response.status_code == 202
+    job = response.json["data"]
+    assert job["status"] in ("pending", "running", "succeed")
+
+    response = client.get(
+        f'/gpt/jobs/{job["job"]}/?wait=5',
+        headers={
+            **headers, "If-None-Match": '"unknown"'
+        }
+    )
+    deadline = time.monotonic() + 30
+    while response.json["data"]["status"] not in ("succeed", "failed"):
+        assert time.monotonic() < deadline, "任务没有在 30 秒内结束"
+        response = client.get(
+            f'/gpt/jobs/{job["job"]}/?wait=5',
+            headers={
+                **headers, "If-None-Match": response.headers["ETag"]
+            }
+        )
+    assert response.json["data"]["status"] == "succeed"
+    assert response.json["data"]["result"]["content"]
+
+    response = client.get(
+        f'/gpt/jobs/{job["job"]}/',
+        headers={
+            **headers, "If-None-Match": response.headers["ETag"]
+        }
+    )
+    assert response.status_code == 304
+
+
+def test_gpt_job_recover(file_client: FlaskClient):
+    client = file_client
+    login_in_token = _login(client)
+    from app.ext import db
+    from app.model import ChatJob, User
+    with client.application.app_context():
+        user = User.get_user_by_email("test@email.com")
+        job = ChatJob(
+            user=user,
+            params={
+                "messages": [{
+                    "role": "user",
+                    "content": "hello"
+                }],
+                "conversation_idf": None,
+                "model": "gpt-3.5-turbo",
+                "max_token": 16,
+                "temperature": 0.2,
+            }
+        )
+        db.session.add(job)
+        db.session.commit()
+        identifier = job.identifier
+
+    # 模拟进程重启后的第一次查询，排队中的任务会被重新执行
+    response = client.get(
+        f'/gpt/jobs/{identifier}/?wait=5',
+        headers={'Authorization': f"Token {login_in_token}"}
+    )
+    status = response.json["data"]["status"]
+    deadline = time.monotonic() + 30
+    while status not in ("succeed", "failed"):
+        assert time.monotonic() < deadline, "任务没有在 30 秒内结束"
+        response = client.get(
+            f'/gpt/jobs/{identifier}/?wait=5',
+            headers={
+                'Authorization': f"Token {login_in_token}",
+                "If-None-Match": response.headers["ETag"]
+            }
+        )
+        status = response.json["data"]["status"]
+    assert status == "succeed"
+
+
+def test_gpt_job_resume_orphaned_running(file_client: FlaskClient):
+    client = file_client
+    login_in_token = _login(client)
+    app = client.application
+    from app import jobs
+    from app.ext import db
+    from app.model import ChatJob, User
+    with app.app_context():
+        # 重启后的 worker 已经执行过 recover，那时任务还没有超时
+        runner = jobs.get_runner()
+        runner.recover()
+        user = User.get_user_by_email("test@email.com")
+        job = ChatJob(
+            user=user,
+            params={
+                "messages": [{"role": "user", "content": "hello"}],
+                "conversation_idf": None,
+                "model": "gpt-3.5-turbo",
+                "max_token": 16,
+                "temperature": 0.2,
+            }
+        )
+        # 执行它的 worker 已经退出，任务停在执行中
+        job.status = ChatJob.STATUS_RUNNING
+        job.update_at = runner.stale_before() - 1000
+        db.session.add(job)
+        db.session.commit()
+        identifier = job.identifier
+
+    headers = {'Authorization': f"Token {login_in_token}"}
+    response = client.get(f'/gpt/jobs/{identifier}/?wait=5', headers=headers)
+    status = response.json["data"]["status"]
+    deadline = time.monotonic() + 30
+    while status not in ("succeed", "failed"):
+        assert time.monotonic() < deadline, "任务没有在 30 秒内结束"
+        response = client.get(
+            f'/gpt/jobs/{identifier}/?wait=5',
+            headers={**headers, "If-None-Match": response.headers["ETag"]}
+        )
+        status = response.json["data"]["status"]
+    assert status == "succeed"
+
+
+def test_gpt_job_unexpected_error(file_client: FlaskClient, monkeypatch):
+    client = file_client
+    login_in_token = _login(client)
+    from app import gpt
+
+    def broken(**kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(gpt, "complete_chat", broken)
+    headers = {'Authorization': f"Token {login_in_token}"}
+    response = client.post(
+        '/gpt/jobs/',
+        headers=headers,
+        json={'messages': [{"role": "user", "content": "你好"}]}
+    )
+    job = response.json["data"]
+    deadline = time.monotonic() + 30
+    while job["status"] not in ("succeed", "failed"):
+        assert time.monotonic() < deadline, "任务没有在 30 秒内结束"
+        job = client.get(
+            f'/gpt/jobs/{job["job"]}/?wait=1', headers=headers
+        ).json["data"]
+    assert job["status"] == "failed"
+    assert job["error_code"] == 500
+
+
+def test_gpt_similar_prompt_cache(client: FlaskClient, login_in_token: str):
+    headers = {'Authorization': f"Token {login_in_token}"}
+    first = client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{
+            "role": "user",
+            "content": "今天天气怎么样"
+        }]}
+    )
+    second = client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{
+            "role": "user",
+            "content": "今天天气怎么样？谢谢"
+        }]}
+    )
+    assert second.json["data"]["content"] == first.json["data"]["content"]
+    assert second.json["data"]["conversation"] != first.json["data"][
+        "conversation"]
+
+
+def test_chat_records_keyset(client: FlaskClient, login_in_token: str):
+    headers = {'Authorization': f"Token {login_in_token}"}
+    for prompt in ("one", "two", "three"):
+        client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={'messages': [{
+                "role": "user",
+                "content": prompt
+            }]}
+        )
+    response = client.post(
+        '/gpt/chat_records/', headers=headers, json={'limit': 2}
+    )
+    # 从新到旧，第一条是最新的回答
+    newest = response.json["data"]
+    assert [r["content"] for r in newest][1] == "three"
+    assert int(newest[0]["sid"]) > int(newest[1]["sid"])
+
+    response = client.post(
+        '/gpt/chat_records/',
+        headers=headers,
+        json={
+            'limit': 2,
+            'before': newest[-1]["sid"]
+        }
+    )
+    older = response.json["data"]
+    assert [r["content"] for r in older][1] == "two"
+    assert int(older[0]["sid"]) < int(newest[-1]["sid"])
+
+
+def test_chat_records_etag(client: FlaskClient, login_in_token: str):
+    headers = {'Authorization': f"Token {login_in_token}"}
+    client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{"role": "user", "content": "one"}]}
+    )
+    response = client.get('/gpt/chat_records/?limit=2', headers=headers)
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    response = client.get(
+        '/gpt/chat_records/?limit=2',
+        headers={**headers, 'If-None-Match': etag}
+    )
+    assert response.status_code == 304 and not response.data
+    # 分页参数不同，ETag 不同
+    response = client.get(
+        '/gpt/chat_records/?limit=3',
+        headers={**headers, 'If-None-Match': etag}
+    )
+    assert response.status_code == 200
+
+    client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{"role": "user", "content": "two"}]}
+    )
+    response = client.get(
+        '/gpt/chat_records/?limit=2',
+        headers={**headers, 'If-None-Match': etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["data"][-1]["content"] != "one"
+
+    response = client.get('/auth/info/', headers=headers)
+    response = client.get(
+        '/auth/info/',
+        headers={**headers, 'If-None-Match': response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+
+def test_gpt_conversation_cache(client: FlaskClient, login_in_token: str):
+    from sqlalchemy import event
+    from app.ext import db
+    from app.model import User
+    headers = {'Authorization': f"Token {login_in_token}"}
+    response = client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{
+            "role": "user",
+            "content": "第一轮"
+        }]}
+    )
+    conversation = response.json["data"]["conversation"]
+
+    statements: typing.List[str] = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        response = client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={
+                'conversation': conversation,
+                'messages': [{
+                    "role": "user",
+                    "content": "第二轮"
+                }]
+            }
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert response.json["data"]["conversation"] == conversation
+    # 多轮对话不再查询会话表
+    assert not [s for s in statements if "FROM conversation" in s]
+
+    # 其他用户不能使用这个会话
+    with client.application.app_context():
+        other = User(email="other@email.com", password=None)
+        other.token = "other-token"
+        db.session.add(other)
+        db.session.commit()
+    # 清掉登录用户的 session，使用 token 认证为其他用户
+    client.cookie_jar.clear()
+    response = client.post(
+        '/gpt/competion/',
+        headers={'Authorization': "Token other-token"},
+        json={
+            'conversation': conversation,
+            'messages': [{
+                "role": "user",
+                "content": "第三轮"
+            }]
+        }
+    )
+    assert response.json["code"] == 403
+
+
+def test_conversation_create_or_get_concurrent(file_client: FlaskClient):
+    from concurrent.futures import ThreadPoolExecutor
+    from app.model import Conversation, User
+    app = file_client.application
+
+    def create(_: int) -> typing.Tuple[int, int, str]:
+        with app.app_context():
+            user = User.get_user_by_email("test@email.com")
+            return Conversation.create_or_get(user=user, identifier="same-idf")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(create, range(8)))
+    assert len(set(results)) == 1
+    with app.app_context():
+        assert Conversation.query.filter_by(identifier="same-idf").count() == 1
+
+
+def test_gpt_conversations(client: FlaskClient, login_in_token: str):
+    headers = {'Authorization': f"Token {login_in_token}"}
+
+    def ask(prompt: str, conversation: typing.Optional[str] = None) -> str:
+        response = client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={
+                'conversation': conversation,
+                'messages': [{
+                    "role": "user",
+                    "content": prompt
+                }]
+            }
+        )
+        return response.json["data"]["conversation"]
+
+    first = ask("first")
+    second = ask("second")
+    third = ask("third")
+    ask("first again", conversation=first)
+
+    response = client.post(
+        '/gpt/conversations/', headers=headers, json={'limit': 2}
+    )
+    page = response.json["data"]
+    assert [c["conversation"] for c in page] == [first, third]
+    assert page[0]["message_count"] == 4
+    assert page[0]["last_message"] == "测试内容: 我是first again问题的回答"
+    assert page[1]["message_count"] == 2
+
+    response = client.post(
+        '/gpt/conversations/',
+        headers=headers,
+        json={
+            'limit': 2,
+            'before': page[-1]["last_sid"]
+        }
+    )
+    assert [c["conversation"] for c in response.json["data"]] == [second]
+
+
+def test_gpt_usage_rollup(client: FlaskClient, login_in_token: str):
+    headers = {'Authorization': f"Token {login_in_token}"}
+    for prompt in ("苹果是什么颜色", "香蕉有多长", "how far is the moon"):
+        client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={'messages': [{
+                "role": "user",
+                "content": prompt
+            }]}
+        )
+    client.post(
+        '/gpt/competion/batch/',
+        headers=headers,
+        json={'prompts': ["batch one", "batch two"]}
+    ).get_data()
+
+    response = client.post('/gpt/usage/', headers=headers, json={})
+    usage = response.json["data"]
+    assert len(usage["days"]) == 1
+    assert usage["days"][0]["model"] == "gpt-3.5-turbo"
+    assert usage["total"]["message_count"] == 10
+    assert usage["total"]["prompt_chars"] == len(
+        "苹果是什么颜色香蕉有多长how far is the moonbatch onebatch two"
+    )
+
+    # 从聊天记录重新汇总的结果与增量结果一致
+    from app.model import UsageRollup
+    with client.application.app_context():
+        UsageRollup.query.delete()
+    result = client.application.test_cli_runner().invoke(
+        args=["usage", "rollup", "--days", "1"]
+    )
+    assert result.exit_code == 0, result.output
+    response = client.post('/gpt/usage/', headers=headers, json={})
+    assert response.json["data"] == usage
+
+    response = client.post(
+        '/gpt/usage/',
+        headers=headers,
+        json={
+            'start': "2020-01-01",
+            'end': "2026-01-01"
+        }
+    )
+    assert response.json["code"] == 413
+
+
+def test_gpt_idempotency_key(client: FlaskClient, login_in_token: str):
+    from app.model import ChatRecord
+    headers = {
+        'Authorization': f"Token {login_in_token}",
+        'Idempotency-Key': "retry-1",
+    }
+    payload = {'messages': [{"role": "user", "content": "只回答一次"}]}
+    first = client.post('/gpt/competion/', headers=headers, json=payload)
+    with client.application.app_context():
+        count = ChatRecord.query.count()
+    second = client.post('/gpt/competion/', headers=headers, json=payload)
+    assert first.json["code"] == 200
+    assert second.json["data"] == first.json["data"]
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    with client.application.app_context():
+        assert ChatRecord.query.count() == count
+
+    # 同一个 key 用于不同的请求
+    other = client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{"role": "user", "content": "另一个问题"}]}
+    )
+    assert other.json["code"] == 400
+
+
+def test_gpt_request_validation(client: FlaskClient, login_in_token: str):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    headers = {'Authorization': f"Token {login_in_token}"}
+    config = client.application.config
+    statements: typing.List[str] = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def ask(**kwargs: typing.Any) -> typing.Dict[str, typing.Any]:
+        return client.post('/gpt/competion/', headers=headers, **kwargs).json
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        message = {"role": "user", "content": "你好"}
+        too_many = ask(
+            json={'messages': [message] * (config["GPT_MAX_MESSAGES"] + 1)}
+        )
+        too_large = ask(
+            data="x" * (config["GPT_MAX_BODY_BYTES"] + 1),
+            content_type="application/json"
+        )
+        bad_token = ask(json={'messages': [message], 'max_token': "abc"})
+        bad_role = ask(json={'messages': [{"role": "robot", "content": "你好"}]})
+        # 超过大小的表单在解析之前返回
+        too_large_form = ask(
+            data={"messages": "x" * (config["GPT_MAX_BODY_BYTES"] + 1)}
+        )
+        bad_json = ask(data="{", content_type="application/json")
+        too_long = ask(json={'messages': [{
+            "role": "user",
+            "content": "x" * (config["GPT_MAX_PROMPT_LENGTH"] + 1)
+        }]})
+        nan_json = ask(
+            data='{"messages": [{"role": "user", "content": "你好"}], '
+            '"temperature": NaN}',
+            content_type="application/json"
+        )
+        infinity = ask(json={'messages': [message], 'temperature': "Infinity"})
+        nan = ask(json={'messages': [message], 'temperature': "nan"})
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+    assert [too_many["code"], too_large["code"], too_large_form["code"]
+           ] == [413, 413, 413]
+    assert [
+        r["code"] for r in (
+            bad_token, bad_role, bad_json, too_long, nan_json, infinity, nan
+        )
+    ] == [400] * 7
+    # 不合法的请求在查询用户之前返回
+    assert statements == []
+
+    response = ask(
+        json={
+            'messages': [message],
+            'max_token': "100",
+            'temperature': "0.5"
+        }
+    )
+    assert response["code"] == 200
+
+
+def test_gpt_query_budget(client: FlaskClient, query_budget):
+    """ 热点接口的 SQL 数量，新增查询时需要同时调整预算
+    """
+    app = client.application
+    with query_budget(app, 2):
+        token = _login(client)
+    headers = {'Authorization': f"Token {token}"}
+    with query_budget(app, 14):
+        response = client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={'messages': [{"role": "user", "content": "你好"}]},
+        )
+    conversation = response.json["data"]["conversation"]
+    with query_budget(app, 9):
+        client.post(
+            '/gpt/competion/',
+            headers=headers,
+            json={
+                'messages': [{"role": "user", "content": "今天天气怎么样"}],
+                'conversation': conversation,
+            },
+        )
+    with query_budget(app, 3):
+        response = client.post(
+            '/gpt/chat_records/',
+            headers=headers,
+            json={'conversation': conversation},
+        )
+    assert len(response.json["data"]) == 4
+    # 没有变化的轮询只查询用户与记录的版本
+    with query_budget(app, 2):
+        response = client.post(
+            '/gpt/chat_records/',
+            headers={**headers, 'If-None-Match': response.headers["ETag"]},
+            json={'conversation': conversation},
+        )
+    assert response.status_code == 304
+    with query_budget(app, 1):
+        client.get('/auth/info/', headers=headers)
+
+
+def test_gpt_auth_batch(client: FlaskClient, query_budget):
+    from app.ext import db
+    from app.model import ChatAuth, User
+    from app.ratelimit import get_tier_resolver
+    app = client.application
+    headers = {'Authorization': f"Token {_login(client)}"}
+    body = {'days': 30, 'grants': [{'idf': 'nobody'}]}
+    response = client.post('/gpt/auth/batch/', headers=headers, json=body)
+    assert response.json["code"] == 403
+
+    with app.app_context():
+        admin = User.get_user_by_email("test@email.com")
+        admin.identifier = app.config["ADMIN_USER_IDENTIFIER"]
+        users = [User(email=f"grant{i}@email.com", password=None) for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        idfs = [u.identifier for u in users]
+        existing = ChatAuth.auth_by_endtime(idfs[0], 1)
+        began_at = existing.began_at
+        get_tier_resolver()._entries["user:1"] = (float("inf"), "pro")
+
+    body = {
+        'days': 30,
+        'grants': [
+            {'idf': idfs[0], 'days': 10},
+            {'idf': idfs[1]},
+            {'idf': 'nobody'},
+            {'idf': idfs[2]},
+            {'idf': idfs[1], 'days': 5},
+        ]
+    }
+    # 用户、授权各查询一次，插入(在保存点中)与更新各一条批量语句
+    with query_budget(app, 7):
+        response = client.post('/gpt/auth/batch/', headers=headers, json=body)
+    data = response.json["data"]
+    assert [r["status"] for r in data["results"]] == [
+        "updated", "duplicate", "unknown_user", "created", "created"
+    ]
+    assert (
+        data["created"], data["updated"], data["unknown_user"], data["duplicate"]
+    ) == (2, 1, 1, 1)
+    with app.app_context():
+        assert not get_tier_resolver()._entries
+        auths = {a.user_idf: a for a in ChatAuth.query}
+        assert len(auths) == 3 and "nobody" not in auths
+        assert auths[idfs[0]].began_at == began_at
+        assert auths[idfs[0]].end_at == data["results"][0]["end_at"]
+        assert auths[idfs[1]].end_at == data["results"][4]["end_at"]
+        assert auths[idfs[1]].is_auth() and auths[idfs[2]].is_auth()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=["auth", "grant", "--days", "7"],
+        input=f"# class A\n{idfs[2]}\n{idfs[0]},3\nnobody\n",
+    )
+    assert result.exit_code == 0, result.output
+    assert "created 0, updated 2, unknown_user 1, duplicate 0" in result.output
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import typing
+
+from app.httpclient import DNSCache, UpstreamClient
+from app.router import UpstreamRouter
+
+
+def _router(api_base: str, client: UpstreamClient) -> UpstreamRouter:
+    router = UpstreamRouter.from_config(
+        {"GPT_UPSTREAMS": {
+            "*": [{
+                "name": "fake",
+                "api_base": api_base,
+                "keys": ["sk-fake"]
+            }]
+        }}
+    )
+    router.client = client
+    return router
+
+
+def _ask(router: UpstreamRouter, prompt: str) -> str:
+    resp = router.create_chat_completion(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=16,
+        temperature=0.2,
+        timeout=5,
+    )
+    return resp["choices"][0]["message"]["content"]
+
+
+def test_upstream_client_reuses_connections(fake_upstream):
+    upstream = fake_upstream()
+    client = UpstreamClient(pool_maxsize=4)
+    router = _router(upstream.api_base, client)
+    assert client.warmup([upstream.api_base]) == 1
+
+    answers: typing.List[str] = []
+    # 每个线程第一次请求时，openai 默认会创建新的会话与连接
+    for i in range(3):
+        thread = threading.Thread(
+            target=lambda i=i: answers.append(_ask(router, f"问题 {i}"))
+        )
+        thread.start()
+        thread.join()
+
+    assert sorted(answers) == [f" 回答: 问题 {i} " for i in range(3)]
+    clients = {r["client"] for r in upstream.requests}
+    assert clients == upstream.connections and len(clients) == 1
+    assert client.timeout(5) == (3.05, 5)
+
+
+def test_dns_cache_scoped_to_upstream_session(fake_upstream, monkeypatch):
+    import requests
+    calls: typing.List[str] = []
+    original = socket.getaddrinfo
+
+    def counting_getaddrinfo(host, *args, **kwargs):
+        calls.append(host)
+        return original(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", counting_getaddrinfo)
+    upstream = fake_upstream()
+    api_base = upstream.api_base.replace("127.0.0.1", "localhost")
+    client = UpstreamClient(dns_cache=DNSCache(ttl=60))
+    # 每次都关闭连接，重新建立的连接使用缓存的地址
+    for _ in range(3):
+        response = client.session.get(
+            f"{api_base}/models", headers={"Connection": "close"}, timeout=5
+        )
+        assert response.status_code == 200
+    assert calls.count("localhost") == 1
+    assert len(upstream.requests) == 3
+
+    # 进程中的其他连接不使用缓存
+    assert socket.getaddrinfo is counting_getaddrinfo
+    requests.get(f"{api_base}/models", timeout=5)
+    assert calls.count("localhost") == 2
+
+
+def test_private_hooks_exist():
+    """ install_openai 与 DNS 缓存依赖的私有接口，升级 openai 或 urllib3 时需要同时修改
+    """
+    from openai import api_requestor
+    from urllib3.connection import HTTPConnection
+    assert callable(api_requestor._make_session)
+    assert callable(api_requestor._requests_proxies_arg)
+    assert callable(HTTPConnection._new_conn)
+    assert HTTPConnection("api.example.com", 443)._dns_host == "api.example.com"
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import create_app
+from app.idempotency import IdempotencyStore
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'idempotency.sqlite'}",
+    })
+    from app.ext import db
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _wait_duplicates(app, store: IdempotencyStore, count: int) -> typing.List:
+    """ 并发发起重复请求，返回每个请求等待结束后看到的结果
+    """
+
+    def duplicate(_: int):
+        with app.app_context():
+            entry, is_owner = store.begin(1, "key", "fp")
+            assert not is_owner
+            assert store.wait(entry, 5)
+            return entry.result
+
+    executor = ThreadPoolExecutor(max_workers=count)
+    futures = [executor.submit(duplicate, i) for i in range(count)]
+    executor.shutdown(wait=False)
+    return futures
+
+
+def test_idempotency_duplicates_wait_for_original(app):
+    store = IdempotencyStore(ttl=60)
+    # 另一个 worker 进程的存储，只能通过数据库看到结果
+    other = IdempotencyStore(ttl=60, poll_interval=0.05)
+    with app.app_context():
+        entry, is_owner = store.begin(1, "key", "fp")
+        assert is_owner
+        futures = _wait_duplicates(app, store, 2) + _wait_duplicates(app, other, 2)
+        time.sleep(0.1)
+        assert not any(f.done() for f in futures)
+
+        store.finish(entry, {"content": "answer"})
+        assert [f.result(timeout=5) for f in futures] == [
+            {"content": "answer"}
+        ] * 4
+        replay, is_owner = other.begin(1, "key", "fp")
+        assert not is_owner and replay.result == {"content": "answer"}
+        # 不同用户的同一个 key 互不影响
+        _, is_owner = other.begin(2, "key", "fp")
+        assert is_owner
+
+
+def test_idempotency_abandon_and_expire(app):
+    store = IdempotencyStore(ttl=0.05)
+    with app.app_context():
+        entry, _ = store.begin(1, "key", "fp")
+        futures = _wait_duplicates(app, store, 2)
+        time.sleep(0.1)
+        store.abandon(entry)
+        # 原请求失败后不保存结果，下一次请求重新执行
+        assert [f.result(timeout=5) for f in futures] == [None, None]
+        entry, is_owner = store.begin(1, "key", "fp")
+        assert is_owner
+
+        store.finish(entry, {"content": "answer"})
+        time.sleep(0.1)
+        _, is_owner = store.begin(1, "key", "fp")
+        assert is_owner
+
+
+def test_idempotency_lease_and_purge(app):
+    from app.model import IdempotencyKey
+    store = IdempotencyStore(ttl=0.05, lease=0.05)
+    with app.app_context():
+        # 执行原请求的进程退出，租约过期后由其他请求接手
+        store.begin(1, "lost", "fp")
+        time.sleep(0.1)
+        entry, is_owner = store.begin(1, "lost", "fp")
+        assert is_owner
+        store.finish(entry, {"content": "answer"})
+        for i in range(3):
+            entry, _ = store.begin(1, f"key-{i}", "fp")
+            store.finish(entry, {})
+        time.sleep(0.1)
+        # 过期的结果在下一次 begin 时删除
+        store.begin(2, "key", "fp")
+        assert [row.key for row in IdempotencyKey.query.all()] == ["key"]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from app import create_app
+
+
+def _create_app(api_base: str, **config):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "GPT_KEY_PROBE_API_BASE": api_base,
+        "GPT_KEY_PROBE_CONCURRENCY": 10,
+        **config,
+    })
+    from app.ext import db
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+KEY_ERRORS = {
+    "sk-invalid": (401, "invalid_api_key"),
+    "sk-quota": (429, "insufficient_quota"),
+    "sk-limited": (429, "rate_limit_exceeded"),
+}
+
+
+def test_probe_keys_in_parallel(fake_upstream):
+    upstream = fake_upstream(latency=0.2, key_errors=KEY_ERRORS)
+    app = _create_app(upstream.api_base)
+    from app.keyprobe import KeyProber
+    prober = KeyProber(app)
+    keys = [f"sk-{i}" for i in range(17)] + list(KEY_ERRORS)
+
+    began = time.perf_counter()
+    results = prober.probe(keys)
+    elapsed = time.perf_counter() - began
+
+    assert upstream.max_inflight == 10
+    assert elapsed < len(keys) * upstream.latency / 3
+    assert all(r.is_live and r.definitive for r in results[:17])
+    assert results[0].remaining_requests == 99
+    invalid, quota, limited = results[17:]
+    assert not invalid.is_live and "invalid_api_key" in invalid.error
+    assert not quota.is_live
+    assert limited.is_live
+
+
+def test_probe_stored_keys(fake_upstream):
+    upstream = fake_upstream(key_errors=KEY_ERRORS)
+    app = _create_app(upstream.api_base)
+    from app.ext import db
+    from app.keyprobe import get_prober
+    from app.model import ChatGPTKey
+    with app.app_context():
+        for content in ["sk-ok", "sk-invalid", "sk-quota"]:
+            db.session.add(ChatGPTKey(user_id=1, app_key=content))
+        db.session.commit()
+
+        stats = get_prober().probe_stored()
+        assert stats == {"checked": 3, "live": 1, "dead": 2, "unknown": 0}
+        live = {
+            k.content: k.is_live
+            for k in ChatGPTKey.query.all() if k.last_checked_at
+        }
+        assert live == {"sk-ok": True, "sk-invalid": False, "sk-quota": False}
+        # 刚检测过的 key 在间隔内不会重复检测
+        assert get_prober().probe_stored()["checked"] == 0
+        assert get_prober().probe_stored(force=True)["checked"] == 3
+
+
+def test_probe_unreachable_upstream_keeps_state():
+    app = _create_app("http://127.0.0.1:1/v1", GPT_KEY_PROBE_TIMEOUT=1)
+    from app.ext import db
+    from app.keyprobe import get_prober
+    from app.model import ChatGPTKey
+    with app.app_context():
+        db.session.add(ChatGPTKey(user_id=1, app_key="sk-ok"))
+        db.session.commit()
+        assert get_prober().probe_stored()["unknown"] == 1
+        key = ChatGPTKey.query.first()
+        assert key.is_live and key.last_error
+
+
+def test_keys_import_command(fake_upstream, tmp_path):
+    upstream = fake_upstream(key_errors=KEY_ERRORS)
+    app = _create_app(upstream.api_base)
+    from app.ext import db
+    from app.model import ChatGPTKey
+    with app.app_context():
+        db.session.add(ChatGPTKey(user_id=1, app_key="sk-exists"))
+        db.session.commit()
+    path = tmp_path / "keys.txt"
+    path.write_text(
+        "\n".join(["sk-a", "sk-b", "sk-a", "sk-exists", "sk-invalid", ""])
+    )
+
+    result = app.test_cli_runner().invoke(
+        args=["keys", "import", str(path), "--user-id", "1"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "'imported': 2" in result.output
+    with app.app_context():
+        contents = sorted(k.content for k in ChatGPTKey.query.all())
+    assert contents == ["sk-a", "sk-b", "sk-exists"]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from app import create_app
+from app.profiler import SamplingProfiler
+
+
+def _busy() -> None:
+    time.sleep(0.05)
+
+
+def test_sampling_profiler_folded_stacks():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    _busy()
+    profiler.stop()
+    assert profiler.elapsed >= 0.05
+    lines = profiler.folded(root="GET /test/ 50ms")
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    frames = stack.split(";")
+    assert frames[0] == "GET /test/ 50ms"
+    assert any(frame.startswith("_busy (test_profiler.py:") for frame in frames)
+
+
+def test_profiler_disabled_registers_nothing():
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+    })
+    hooks = [f.__name__ for f in app.before_request_funcs.get(None, [])]
+    assert "start_profiler" not in hooks
+
+
+def test_profiler_token(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'profiler.sqlite'}",
+        "PROFILER_TOKEN": "secret",
+        "PROFILER_INTERVAL": 0.001,
+    })
+    app.instance_path = str(tmp_path)
+    from app.ext import db
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    response = client.post(
+        "/auth/login/",
+        json={"email": "nobody@email.com", "password": "x"},
+        headers={"X-Profile": "wrong"},
+    )
+    assert "X-Profile" not in response.headers
+    assert not os.path.exists(tmp_path / "profiles")
+
+    response = client.post(
+        "/auth/login/",
+        json={"email": "nobody@email.com", "password": "x"},
+        headers={"X-Profile": "secret"},
+    )
+    name = response.headers["X-Profile"]
+    assert "-auth.login-" in name and name.endswith("ms.folded")
+    with open(tmp_path / "profiles" / name, encoding="utf-8") as f:
+        lines = [line for line in f.read().splitlines() if line]
+    assert all(line.startswith("POST /auth/login/ ") for line in lines)
+
+
+def test_profiled_completion_succeeds(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'profiler.sqlite'}",
+        "PROFILER_TOKEN": "secret",
+        "PROFILER_INTERVAL": 0.001,
+    })
+    app.instance_path = str(tmp_path)
+    from app.ext import db
+    from app.model import User
+    with app.app_context():
+        db.create_all()
+        user = User(email="profiler@email.com", password=None)
+        user.token = "profiler-token"
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    headers = {"Authorization": "Token profiler-token", "X-Profile": "secret"}
+    # 采样的请求与普通请求的结果一致，JSON 请求体正常读取
+    response = client.post(
+        "/gpt/competion/",
+        json={"messages": [{"role": "user", "content": "你好"}]},
+        headers=headers,
+    )
+    assert response.json["code"] == 200
+    assert "你好" in response.json["data"]["content"]
+    assert os.path.exists(tmp_path / "profiles" / response.headers["X-Profile"])
+
+    # query 参数不再触发采样
+    response = client.post(
+        "/gpt/competion/?__profile=secret",
+        json={"messages": [{"role": "user", "content": "你好"}]},
+        headers={"Authorization": "Token profiler-token"},
+    )
+    assert "X-Profile" not in response.headers
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from app import create_app
+
+
+def test_query_stats_logs_slow_and_repeated_queries(tmp_path, capsys):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'stats.sqlite'}",
+        "SQL_SLOW_QUERY_SECONDS": 0,
+        "SQL_NPLUS1_THRESHOLD": 2,
+        "SQL_SERVER_TIMING": True,
+    })
+    from app.ext import db
+    from app.model import User
+    with app.app_context():
+        db.create_all()
+        user = User(email="stats@email.com", password=None)
+        user.token = "stats-token"
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    headers = {'Authorization': "Token stats-token"}
+
+    response = client.get('/auth/info/', headers=headers)
+    assert response.headers["Server-Timing"].endswith('desc="1 queries"')
+    assert "slow query" in capsys.readouterr().out
+
+    response = client.post(
+        '/gpt/competion/',
+        headers=headers,
+        json={'messages': [{"role": "user", "content": "你好"}]},
+    )
+    assert response.json["code"] == 200
+    output = capsys.readouterr().out
+    assert "possible N+1 query POST /gpt/competion/: 2 x INSERT INTO chat_record" in output
+
+
+def test_query_stats_disabled(tmp_path):
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "SQL_QUERY_STATS_ENABLED": False,
+    })
+    hooks = [f.__name__ for f in app.teardown_request_funcs.get(None, [])]
+    assert "report_queries" not in hooks
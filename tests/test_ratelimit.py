@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import typing
+
+import pytest
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app
+
+
+@pytest.fixture
+def limited_client() -> FlaskClient:
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "RATELIMIT_BLUEPRINTS": {
+            "gpt": "3/minute",
+            "auth": "2/minute"
+        },
+        "RATELIMIT_TIERS": {
+            "pro": {
+                "gpt": "5/minute"
+            }
+        },
+    })
+    from app.ext import db
+    from app.model import ChatAuth, User
+    with app.app_context():
+        db.create_all()
+        for name in ("free", "pro"):
+            user = User(email=f"{name}@email.com", password=None)
+            user.token = f"{name}-token"
+            db.session.add(user)
+            db.session.commit()
+            auth = ChatAuth.auth_by_endtime(
+                user_idf=user.identifier, endtime=2**62
+            )
+            auth.tier = name
+            db.session.commit()
+    with app.test_client() as client:
+        yield client
+
+
+def _ask(client: FlaskClient, token: str):
+    return client.post(
+        "/gpt/conversations/", headers={"Authorization": f"Token {token}"}
+    )
+
+
+def test_rate_limit_per_token(limited_client: FlaskClient):
+    statements: typing.List[str] = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # 第一次请求验证 token 之前按 IP 计数，之后按用户计数
+    codes = [_ask(limited_client, "free-token").status_code for _ in range(4)]
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        response = _ask(limited_client, "free-token")
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+    assert codes == [200] * 4
+    assert response.status_code == 429
+    assert response.json["code"] == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 61
+    # 超出限制的请求不查询数据库
+    assert statements == []
+    # 其他 token 单独计数，pro 档位的限制更高
+    codes = [_ask(limited_client, "pro-token").status_code for _ in range(7)]
+    assert codes == [200] * 6 + [429]
+
+
+def test_rate_limit_unverified_token_by_ip(limited_client: FlaskClient):
+    statements: typing.List[str] = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # 每次换一个伪造的 token 仍然按 IP 计数
+    codes = [
+        _ask(limited_client, f"bogus-{i}").status_code for i in range(3)
+    ]
+    assert 429 not in codes
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        response = _ask(limited_client, "bogus-3")
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    assert response.status_code == 429
+    assert statements == []
+    # 登录接口的 IP 限制同样不能通过 token 绕过
+    codes = [
+        limited_client.post(
+            "/auth/login/",
+            json={
+                "email": "free@email.com",
+                "password": "wrong"
+            },
+            headers={
+                "Authorization": f"Token bogus-login-{i}"
+            }
+        ).status_code for i in range(3)
+    ]
+    assert codes == [200, 200, 429]
+
+
+def test_rate_limit_anonymous_by_ip(limited_client: FlaskClient):
+    codes = [
+        limited_client.post(
+            "/auth/login/", json={
+                "email": "free@email.com",
+                "password": "wrong"
+            }
+        ).status_code for _ in range(3)
+    ]
+    assert codes == [200, 200, 429]
+    other = limited_client.post(
+        "/auth/login/",
+        json={"email": "free@email.com"},
+        environ_base={"REMOTE_ADDR": "10.0.0.2"}
+    )
+    assert other.status_code == 200
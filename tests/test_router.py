@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from app.router import UpstreamRouter
+from app.upstream import Upstream
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def _router(*upstreams: Upstream, **kwargs) -> UpstreamRouter:
+    kwargs.setdefault("explore_ratio", 0.0)
+    return UpstreamRouter(
+        routes={"gpt-3.5-turbo": list(upstreams)},
+        rand=random.Random(0),
+        **kwargs
+    )
+
+
+def test_router_prefers_low_latency(fake_upstream):
+    fast = fake_upstream(latency=0.01)
+    slow = fake_upstream(latency=0.2)
+    router = _router(
+        Upstream(name="slow", api_base=slow.api_base),
+        Upstream(name="fast", api_base=fast.api_base),
+    )
+    for _ in range(10):
+        resp = router.create_chat_completion(
+            model="gpt-3.5-turbo",
+            messages=MESSAGES,
+            max_tokens=16,
+            temperature=0.2,
+            api_key="sk-test",
+        )
+        assert resp["choices"][0]["message"]["content"].strip() == "回答: 你好"
+
+    # 两个上游各探测一次之后，剩余的请求都应该落在快的上游
+    assert len(slow.requests) == 1
+    assert len(fast.requests) == 9
+    stats = router.to_json()
+    assert stats["fast"]["latency"] < stats["slow"]["latency"]
+
+
+def test_router_avoids_failing_upstream(fake_upstream):
+    broken = fake_upstream(status=500)
+    healthy = fake_upstream(latency=0.05)
+    router = _router(
+        Upstream(name="broken", api_base=broken.api_base),
+        Upstream(name="healthy", api_base=healthy.api_base),
+    )
+    for _ in range(5):
+        router.create_chat_completion(
+            model="gpt-3.5-turbo",
+            messages=MESSAGES,
+            max_tokens=16,
+            temperature=0.2,
+            api_key="sk-test",
+        )
+    assert len(broken.requests) == 1
+    assert len(healthy.requests) == 5
+    assert router.to_json()["broken"]["error_rate"] == 1.0
+
+
+def test_router_raises_when_all_upstreams_fail(fake_upstream):
+    broken = fake_upstream(status=500)
+    router = _router(Upstream(name="broken", api_base=broken.api_base))
+    with pytest.raises(Exception):
+        router.create_chat_completion(
+            model="gpt-3.5-turbo",
+            messages=MESSAGES,
+            max_tokens=16,
+            temperature=0.2,
+            api_key="sk-test",
+        )
+
+
+def test_router_key_pool_round_robin(fake_upstream):
+    upstream = fake_upstream()
+    router = _router(
+        Upstream(
+            name="pool", api_base=upstream.api_base, keys=["sk-a", "sk-b"]
+        )
+    )
+    for _ in range(4):
+        router.create_chat_completion(
+            model="gpt-3.5-turbo",
+            messages=MESSAGES,
+            max_tokens=16,
+            temperature=0.2,
+            api_key="sk-fallback",
+        )
+    keys = [r["headers"]["Authorization"] for r in upstream.requests]
+    assert keys == ["Bearer sk-a", "Bearer sk-b", "Bearer sk-a", "Bearer sk-b"]
+
+
+def test_router_from_config_default_route():
+    router = UpstreamRouter.from_config(
+        {"GPT_UPSTREAMS": {
+            "gpt-4": ["http://127.0.0.1:1/v1"]
+        }}
+    )
+    assert router.select("gpt-4").api_base == "http://127.0.0.1:1/v1"
+    assert router.select("gpt-3.5-turbo").name == "default"
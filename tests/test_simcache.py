@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+
+import pytest
+
+from app.simcache import SimilarityCache, normalize_prompt
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("你好， 世界！谢谢") == "你好世界"
+    assert normalize_prompt("Hello,  World. Thanks!") == "helloworld"
+    assert normalize_prompt("谢谢") == "谢谢"
+    # 运算符、比较符号、小数点与时间保留
+    assert normalize_prompt("x > 5？") == "x>5"
+    assert normalize_prompt("3.5 和 35") == "3.5和35"
+    assert normalize_prompt("10:30 开会吗：") == "10:30开会吗"
+
+
+def test_similar_prompt_hit():
+    cache = SimilarityCache(threshold=0.95)
+    cache.put("gpt-3.5-turbo", "今天北京的天气怎么样？", "晴")
+    assert cache.get("gpt-3.5-turbo", "今天北京的天气怎么样  谢谢") == "晴"
+    assert cache.get("gpt-3.5-turbo", "今天北京的天气怎么样?") == "晴"
+    assert cache.get("gpt-3.5-turbo", "怎样用 Python 读取文件") is None
+    assert cache.get("gpt-4", "今天北京的天气怎么样？") is None
+
+
+@pytest.mark.parametrize(("cached", "other"), (
+    ("1+1等于几", "1-1等于几"),
+    ("2+3", "2*3"),
+    ("x > 5", "x < 5"),
+    ("请帮我计算 123+456 的结果", "请帮我计算 123-456 的结果"),
+    ("明天 10:30 提醒我开会", "明天 11:30 提醒我开会"),
+))
+def test_different_operators_miss(cached, other):
+    cache = SimilarityCache(threshold=0.95)
+    cache.put("m", cached, "answer")
+    assert cache.get("m", cached) == "answer"
+    assert cache.get("m", other) is None
+
+
+def test_threshold_limit():
+    # 阈值 0.85 允许汉明距离 9，需要 10 段，超过 MAX_BANDS 时无法保证不漏掉相似问题
+    with pytest.raises(ValueError):
+        SimilarityCache(threshold=0.85)
+    assert SimilarityCache(threshold=0.89).bands == 8
+
+
+def test_lookup_with_one_million_entries():
+    rng = random.Random(0)
+    cache = SimilarityCache(threshold=0.95, max_entries=1000000)
+    fingerprints = [rng.getrandbits(64) for _ in range(1000000)]
+    for fingerprint in fingerprints:
+        cache.put_fingerprint("m", fingerprint, "answer")
+    # 汉明距离不超过 3 的查询都能命中
+    queries = [
+        rng.choice(fingerprints) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+        for _ in range(2000)
+    ]
+    began = time.perf_counter()
+    for query in queries:
+        assert cache.get_fingerprint("m", query) == "answer"
+    assert (time.perf_counter() - began) / len(queries) < 0.001
+
+
+def test_cache_eviction():
+    cache = SimilarityCache(threshold=0.95, max_entries=2)
+    cache.put("m", "第一个问题是什么", "1")
+    cache.put("m", "第二个问题是什么呢", "2")
+    assert cache.get("m", "第一个问题是什么") == "1"
+    cache.put("m", "完全不同的第三个问题", "3")
+    assert len(cache) == 2
+    # 第二个问题最久没有被使用，被淘汰
+    assert cache.get("m", "第二个问题是什么呢") is None
+    assert cache.get("m", "第一个问题是什么") == "1"
+    assert cache.get("m", "完全不同的第三个问题") == "3"
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from app.utils import (
+    SnowflakeGenerator, MonotonicClock, configure_id_generator, get_unix_time_tuple
+)
+
+
+def test_unix_time_tuple_is_current():
+    first = int(get_unix_time_tuple(millisecond=True))
+    second = int(get_unix_time_tuple(millisecond=True))
+    assert second >= first
+    assert int(get_unix_time_tuple()) == second // 1000
+
+
+def test_monotonic_clock_never_goes_back(monkeypatch):
+    import app.utils as utils
+    clock = MonotonicClock()
+    monkeypatch.setattr(utils.time, "time", lambda: 2000.0)
+    assert clock.now_ms() == 2000000
+    monkeypatch.setattr(utils.time, "time", lambda: 1000.0)
+    assert clock.now_ms() == 2000000
+
+
+def test_snowflake_ids_are_unique_and_sorted():
+    generator = SnowflakeGenerator(worker_id=3)
+    ids = [generator.next_id() for _ in range(10000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all((i >> 12) & 0x3FF == 3 for i in ids)
+
+
+def test_snowflake_ids_unique_across_threads():
+    generator = SnowflakeGenerator(worker_id=1)
+    results = []
+
+    def work():
+        results.extend(generator.next_id() for _ in range(2000))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(results)) == 8000
+
+
+def test_gunicorn_worker_ids(monkeypatch, tmp_path):
+    import os
+    import runpy
+    from types import SimpleNamespace
+
+    from app import create_app
+    config = runpy.run_path(
+        os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py")
+    )
+    monkeypatch.setenv("GUNICORN_WORKER_ID_BASE", "100")
+    monkeypatch.setenv("GPT_WORKER_ID", "")
+    worker_ids = []
+    for age in (1, 2, 3):
+        config["post_fork"](None, SimpleNamespace(age=age))
+        worker_ids.append(os.environ["GPT_WORKER_ID"])
+    assert worker_ids == ["101", "102", "103"]
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'worker.sqlite'}",
+    })
+    assert app.config["WORKER_ID"] == 103
+    configure_id_generator(None)
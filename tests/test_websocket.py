@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import json
+import threading
+import typing
+
+import pytest
+
+pytest.importorskip("flask_sock")
+
+from simple_websocket import Client, ConnectionClosed
+from werkzeug.serving import make_server
+
+from app import create_app
+
+
+@pytest.fixture
+def ws_server(tmp_path, fake_upstream):
+    upstream = fake_upstream()
+    app = create_app({
+        "TESTING": False,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'ws.sqlite'}",
+        "GPT_UPSTREAMS": {
+            "*": [{
+                "name": "fake",
+                "api_base": upstream.api_base,
+                "keys": ["sk-fake"]
+            }]
+        },
+        "GPT_SIMCACHE_ENABLED": False,
+        "GPT_KEY_PROBE_INTERVAL": 0,
+    })
+    from app.ext import db
+    from app.model import ChatGPTKey, User
+    with app.app_context():
+        db.create_all()
+        user = User(email="ws@email.com", password=None)
+        user.token = "ws-token"
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(ChatGPTKey(user_id=user.id, app_key="sk-ws"))
+        db.session.commit()
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield app, upstream, f"ws://127.0.0.1:{server.server_port}/gpt/ws/"
+    server.shutdown()
+
+
+def _receive(ws: Client) -> typing.Dict[str, typing.Any]:
+    return json.loads(ws.receive(timeout=5))
+
+
+def _ask(ws: Client, content: str) -> typing.Tuple[str, typing.Dict[str, typing.Any]]:
+    ws.send(json.dumps({"type": "ask", "content": content}))
+    deltas: typing.List[str] = []
+    while True:
+        message = _receive(ws)
+        if message["type"] != "delta":
+            return "".join(deltas), message
+        deltas.append(message["content"])
+
+
+def test_websocket_conversation(ws_server):
+    app, upstream, url = ws_server
+    ws = Client.connect(url, headers={"Authorization": "Token ws-token"})
+    try:
+        ready = _receive(ws)
+        assert ready["type"] == "ready"
+        streamed, done = _ask(ws, "你好")
+        assert done == {
+            "type": "done",
+            "conversation": ready["conversation"],
+            "content": "回答: 你好",
+        }
+        assert streamed == " 回答: 你好 "
+        _, done = _ask(ws, "再见")
+        assert done["content"] == "回答: 再见"
+    finally:
+        ws.close()
+
+    # 第二轮只发送了新的问题，上下文来自连接内存
+    assert upstream.requests[-1]["body"]["messages"] == [
+        {"role": "user", "content": "你好"},
+        {"role": "assistant", "content": "回答: 你好"},
+        {"role": "user", "content": "再见"},
+    ]
+    from app.model import ChatRecord, Conversation
+    with app.app_context():
+        conversation = Conversation.get_conversation_by_identifier(
+            ready["conversation"]
+        )
+        assert conversation.message_count == 4
+        assert ChatRecord.query.filter_by(
+            conversation=conversation.cov_id
+        ).count() == 4
+
+    # 重新连接同一个会话时从聊天记录恢复上下文，第一条消息认证
+    ws = Client.connect(f"{url}?conversation={ready['conversation']}")
+    try:
+        ws.send(json.dumps({"type": "auth", "token": "ws-token"}))
+        assert _receive(ws)["conversation"] == ready["conversation"]
+        _ask(ws, "还在吗")
+    finally:
+        ws.close()
+    assert len(upstream.requests[-1]["body"]["messages"]) == 5
+
+
+def test_websocket_rejects_bad_token(ws_server):
+    _, upstream, url = ws_server
+    ws = Client.connect(url)
+    try:
+        ws.send(json.dumps({"type": "auth", "token": "wrong"}))
+        assert _receive(ws)["code"] == 410
+    finally:
+        # 服务端发送错误后主动关闭连接
+        with contextlib.suppress(ConnectionClosed):
+            ws.close()
+    assert upstream.requests == []